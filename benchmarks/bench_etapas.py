@@ -0,0 +1,185 @@
+import pandas as pd
+import numpy as np
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import tempfile
+import platform
+import argparse
+import subprocess
+import contextlib
+import warnings
+from datetime import datetime
+
+## Pasta do repositório no sys.path: os estágios mudam a pasta de trabalho, pois os caminhos do
+## tratamento (../../../dataset) e do load_data (dataset/...) são relativos
+RAIZ_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ_REPO)
+
+from benchmarks.gerar_dataset import gerar_dataset, pasta_tratamento
+from modules.Colher_tratar_dados.Dados_Fund.Tratar_dados import (endereco_arquivos, Func_Classe_acao, tratar_Fund, tratar_cot,
+                                                                 tratar_prov, tratar_even, tratar_subs, normalizar_dados_fund,
+                                                                 ajuste_cotacoes, ajuste_prov, multiplos_diarios, Func_CAGR,
+                                                                 Tratar_dados_diarios)
+from modules.Colher_tratar_dados.load_data import load_data
+from example.Estrategia_retorno import main_ret
+
+warnings.filterwarnings("ignore")
+
+## Mede o tempo de cada estágio do pipeline em universos sintéticos (ver gerar_dataset.py) de vários tamanhos:
+## as funções tratar_*, normalizar_dados_fund, ajuste_cotacoes, multiplos_diarios e Func_CAGR (somadas sobre os ativos),
+## o Tratar_dados_diarios completo (com a gravação dos arquivos), load_data e main_ret em algumas datas de simulação
+## (ver datas_simulacao_dataset).
+## O resultado é gravado em JSON, com o ambiente e o commit, para acompanhar os ganhos entre versões.
+##
+## Uso: python -m benchmarks.bench_etapas --tamanhos 10 50 100 --repeticoes 3 --saida resultados.json
+
+N_DATAS_SIMULACAO = 3
+
+
+def ambiente():
+    ## Versões e máquina, para comparar resultados de execuções diferentes
+    import pyarrow
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=RAIZ_REPO, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"Commit": commit, "Python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+            "pyarrow": pyarrow.__version__, "Plataforma": platform.platform(), "CPUs": os.cpu_count(),
+            "Data": datetime.now().isoformat(timespec="seconds")}
+
+
+def datas_simulacao_dataset(raiz, n_datas=N_DATAS_SIMULACAO):
+    ## Datas de simulação igualmente espaçadas entre o primeiro e o último mês da matriz de elegibilidade do universo
+    ## com algum ativo elegível: todas as datas têm ativos, qualquer que seja o número de anos do universo
+    df_elegiveis = pd.read_parquet(os.path.join(raiz, "dataset", "BR", "ACOES", "IBOV_Elegivel.parquet"))
+    meses = df_elegiveis.index[df_elegiveis.to_numpy().any(axis=1)]
+    if len(meses) == 0:
+        return []
+    posicoes = pd.unique(np.linspace(0, len(meses) - 1, n_datas).round().astype(int))
+    return [meses[posicao].to_pydatetime() for posicao in posicoes]
+
+
+def etapas_ativo(Ticker):
+    ## Executa os estágios do Tratar_dados_diarios para um ativo, sem gravar arquivos, e retorna o tempo de cada um
+    tempos = {}
+
+    def medir(nome, funcao, *args):
+        inicio = time.perf_counter()
+        resultado = funcao(*args)
+        tempos[nome] = time.perf_counter() - inicio
+        return resultado
+
+    arquivo_Fund, arquivo_Cot, arquivo_Prov, arquivo_Eventos, arquivo_Subscricao = endereco_arquivos(Ticker)
+    Classe_acao = Func_Classe_acao(Ticker)
+    df_fund = medir("tratar_Fund", tratar_Fund, arquivo_Fund)
+    df_cot = medir("tratar_cot", tratar_cot, arquivo_Cot)
+    df_prov, Existe_prov = medir("tratar_prov", tratar_prov, arquivo_Prov, Classe_acao)
+    df_eventos, Existe_eventos = medir("tratar_even", tratar_even, arquivo_Eventos, Classe_acao)
+    medir("tratar_subs", tratar_subs, arquivo_Subscricao)
+    df_Tratar_por_Acao = medir("normalizar_dados_fund", normalizar_dados_fund, df_fund, df_eventos, Existe_eventos, Ticker)
+    df_cot_tratado = medir("ajuste_cotacoes", ajuste_cotacoes, df_cot, df_Tratar_por_Acao, df_eventos, Existe_eventos, Ticker)
+    medir("ajuste_prov", ajuste_prov, df_prov, df_eventos, Existe_prov, Existe_eventos)
+    medir("multiplos_diarios", multiplos_diarios, df_Tratar_por_Acao, df_cot_tratado, Ticker)
+    medir("Func_CAGR", Func_CAGR, df_Tratar_por_Acao, Ticker)
+    return tempos
+
+
+def medir_universo(raiz, lista_ativos, repeticoes=3, datas_simulacao=None):
+    ## Tempos de cada estágio, em segundos, somados sobre o universo, em cada repetição: dict etapa -> lista de tempos.
+    ## Com datas_simulacao=None, as datas vêm de datas_simulacao_dataset
+    if datas_simulacao is None:
+        datas_simulacao = datas_simulacao_dataset(raiz)
+    tempos = {}
+
+    def registrar(nome, tempo, repeticao):
+        tempos.setdefault(nome, [0.0]*repeticoes)[repeticao] += tempo
+
+    pasta_original = os.getcwd()
+    try:
+        for repeticao in range(repeticoes):
+            ## Estágios do tratamento, executados da pasta onde Tratar_dados.py roda
+            os.chdir(pasta_tratamento(raiz))
+            with contextlib.redirect_stdout(io.StringIO()):
+                for Ticker in lista_ativos:
+                    for nome, tempo in etapas_ativo(Ticker).items():
+                        registrar(nome, tempo, repeticao)
+                for Ticker in lista_ativos:
+                    inicio = time.perf_counter()
+                    Tratar_dados_diarios(Ticker)
+                    registrar("Tratar_dados_diarios", time.perf_counter() - inicio, repeticao)
+
+            ## Leitura e estratégia, executadas da raiz do dataset
+            os.chdir(raiz)
+            with contextlib.redirect_stdout(io.StringIO()):
+                for data_simulacao in datas_simulacao:
+                    inicio = time.perf_counter()
+                    dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal = load_data(data_simulacao)
+                    registrar("load_data", time.perf_counter() - inicio, repeticao)
+
+                    inicio = time.perf_counter()
+                    main_ret(dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal, renderizar=False)
+                    registrar("main_ret", time.perf_counter() - inicio, repeticao)
+    finally:
+        os.chdir(pasta_original)
+
+    return tempos
+
+
+def executar_benchmarks(tamanhos, anos=15, n_eventos=3, repeticoes=3, semente=0, pasta=None):
+    ## Gera um universo para cada tamanho, mede os estágios e retorna o dicionário gravado no JSON.
+    ## Com pasta=None, os universos são gerados em pastas temporárias, apagadas no fim
+    resultados = []
+    dict_datas_simulacao = {}
+    for n_ativos in tamanhos:
+        if pasta is not None:
+            raiz = os.path.abspath(os.path.join(pasta, f"universo_{n_ativos}"))
+        else:
+            raiz = tempfile.mkdtemp(prefix=f"bench_{n_ativos}_")
+        try:
+            inicio = time.perf_counter()
+            lista_ativos = gerar_dataset(raiz, n_ativos, anos, n_eventos, semente)
+            tempo_gerar = time.perf_counter() - inicio
+
+            datas_simulacao = datas_simulacao_dataset(raiz)
+            dict_datas_simulacao[str(n_ativos)] = [data.date().isoformat() for data in datas_simulacao]
+            tempos = medir_universo(raiz, lista_ativos, repeticoes, datas_simulacao)
+            for etapa, lista_tempos in tempos.items():
+                resultados.append({"N_ativos": n_ativos, "Etapa": etapa, "Tempos": lista_tempos,
+                                   "Minimo": min(lista_tempos), "Mediana": float(np.median(lista_tempos)),
+                                   "Minimo_por_ativo": min(lista_tempos)/n_ativos})
+            ## Sem ativos elegíveis (universo muito curto), load_data e main_ret não são medidos
+            print(f"{n_ativos} ativos: dataset gerado em {tempo_gerar:.1f}s, "
+                  + ", ".join(f"{etapa} {min(tempos[etapa]):.2f}s" for etapa in ["Tratar_dados_diarios", "load_data", "main_ret"]
+                              if etapa in tempos))
+        finally:
+            if pasta is None:
+                shutil.rmtree(raiz, ignore_errors=True)
+
+    return {"Ambiente": ambiente(),
+            "Parametros": {"Tamanhos": list(tamanhos), "Anos": anos, "Eventos": n_eventos, "Repeticoes": repeticoes,
+                           "Semente": semente, "Datas_simulacao": dict_datas_simulacao},
+            "Resultados": resultados}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark dos estágios do pipeline em universos sintéticos")
+    parser.add_argument("--tamanhos", type=int, nargs="+", default=[10, 50, 100], help="Números de ativos dos universos")
+    parser.add_argument("--anos", type=int, default=15, help="Anos de cotações")
+    parser.add_argument("--eventos", type=int, default=3, help="Eventos por ativo")
+    parser.add_argument("--repeticoes", type=int, default=3, help="Repetições de cada medida")
+    parser.add_argument("--semente", type=int, default=0, help="Semente do gerador")
+    parser.add_argument("--pasta", default=None, help="Pasta onde os universos são gerados e mantidos (padrão: temporária)")
+    parser.add_argument("--saida", default=None, help="Arquivo JSON de saída (padrão: benchmarks/resultados/bench_<data>.json)")
+    args = parser.parse_args()
+
+    relatorio = executar_benchmarks(args.tamanhos, args.anos, args.eventos, args.repeticoes, args.semente, args.pasta)
+
+    saida = args.saida or os.path.join(RAIZ_REPO, "benchmarks", "resultados", f"bench_{datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(saida)), exist_ok=True)
+    with open(saida, "w") as arquivo:
+        json.dump(relatorio, arquivo, indent=2, ensure_ascii=False)
+    print(f"Resultados gravados em {saida}")
@@ -0,0 +1,73 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+## Pasta do repositório, de onde os módulos são importados nos processos de medida
+RAIZ_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+## Mede o tempo de importação "a frio" (em um processo Python novo) dos módulos do carregamento e da estratégia,
+## e falha (código de saída 1) se algum passar do orçamento ou importar uma dependência pesada que só deveria ser
+## importada nas funções que a usam (regressões do statsmodels, gráficos do matplotlib).
+##
+## Uso: python -m benchmarks.bench_importacao --orcamento 1.5 --repeticoes 5
+
+MODULOS = ["modules.Colher_tratar_dados.load_data", "example.Estrategia_retorno", "example.Backtest"]
+DEPENDENCIAS_PESADAS = ["statsmodels", "matplotlib", "scipy"]
+
+_CODIGO_MEDIDA = """
+import sys, time, json
+sys.path.insert(0, {raiz!r})
+inicio = time.perf_counter()
+import {modulo}
+tempo = time.perf_counter() - inicio
+pesadas = sorted({{nome.split(".")[0] for nome in sys.modules}} & set({pesadas!r}))
+print(json.dumps({{"Tempo": tempo, "Pesadas": pesadas}}))
+"""
+
+
+def medir_importacao(modulo, repeticoes=5):
+    ## Tempos de importação do módulo, em segundos, cada um em um processo novo, e as dependências pesadas carregadas
+    tempos = []
+    pesadas = []
+    codigo = _CODIGO_MEDIDA.format(raiz=RAIZ_REPO, modulo=modulo, pesadas=DEPENDENCIAS_PESADAS)
+    for _ in range(repeticoes):
+        saida = subprocess.run([sys.executable, "-c", codigo], cwd=RAIZ_REPO, capture_output=True, text=True, check=True)
+        resultado = json.loads(saida.stdout.strip().splitlines()[-1])
+        tempos.append(resultado["Tempo"])
+        pesadas = resultado["Pesadas"]
+    return tempos, pesadas
+
+
+def verificar_importacoes(modulos=MODULOS, orcamento=1.5, repeticoes=5):
+    ## Retorna a lista de resultados por módulo e se todos ficaram dentro do orçamento (tempo mínimo das repetições)
+    ## e sem dependências pesadas
+    resultados = []
+    for modulo in modulos:
+        tempos, pesadas = medir_importacao(modulo, repeticoes)
+        resultados.append({"Modulo": modulo, "Tempos": tempos, "Minimo": min(tempos), "Pesadas": pesadas,
+                           "Ok": min(tempos) <= orcamento and not pesadas})
+    return resultados, all(resultado["Ok"] for resultado in resultados)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tempo de importação a frio dos módulos do carregamento e da estratégia")
+    parser.add_argument("--modulos", nargs="+", default=MODULOS, help="Módulos medidos")
+    parser.add_argument("--orcamento", type=float, default=1.5, help="Tempo máximo de importação, em segundos")
+    parser.add_argument("--repeticoes", type=int, default=5, help="Repetições de cada medida (vale o menor tempo)")
+    parser.add_argument("--saida", default=None, help="Arquivo JSON com os resultados")
+    args = parser.parse_args()
+
+    resultados, ok = verificar_importacoes(args.modulos, args.orcamento, args.repeticoes)
+    for resultado in resultados:
+        pesadas = f", importa {', '.join(resultado['Pesadas'])}" if resultado["Pesadas"] else ""
+        print(f"{'ok   ' if resultado['Ok'] else 'FALHA'} {resultado['Modulo']}: {resultado['Minimo']:.2f}s{pesadas}")
+
+    if args.saida is not None:
+        with open(args.saida, "w") as arquivo:
+            json.dump({"Orcamento": args.orcamento, "Resultados": resultados}, arquivo, indent=2, ensure_ascii=False)
+
+    if not ok:
+        print(f"Importação acima do orçamento de {args.orcamento}s ou com dependências pesadas")
+        sys.exit(1)
@@ -0,0 +1,180 @@
+import pandas as pd
+import numpy as np
+import os
+import argparse
+
+## Gera uma árvore dataset/BR/... sintética, no mesmo formato dos dados brutos lidos por Tratar_dados.py
+## (endereco_arquivos) e por load_data.py: arquivos _Fund, _Cot, _Prov e _Eventos de cada ativo, com números
+## e datas em texto no formato brasileiro, Lista_Ativos_Busca, IBOV_Elegivel, Selic e Expectativa_Selic_Diaria.
+## Os dados são aleatórios, mas com a forma dos reais: preços com passeio aleatório, balanços trimestrais com
+## crescimento, proventos semestrais, desdobramentos/grupamentos e uma matriz de elegibilidade que muda a cada mês.
+##
+## Uso: python -m benchmarks.gerar_dataset <raiz> --ativos 50 --anos 15 --eventos 3 --semente 0
+
+SETORES = ["Construção e Imóveis", "Bancos e Serviços Financeiros", "Energia e Serviços Básicos",
+           "Biocombustíveis, Gás e Petróleo", "Mineração", "Serviços", "Celulose, Papel e Madeira", "Indústria"]
+
+COLUNAS_FUND_PCT = ['DY_12m', "DY_24m", "DY_36m", "DY_48m", "DY_60m",
+                    'ret_12meses', 'ret_1mes_aa', 'ret_ano', 'ret_CDI_1m', 'ret_CDI_12m', 'ret_CDI_ano',
+                    'ret_IBOV_1mes', 'ret_IBOV_12m', 'ret_IBOV_ano']
+
+
+def texto_br(valores, casas):
+    ## Números em texto com vírgula decimal, como nos arquivos brutos
+    return [f"{valor:.{casas}f}".replace(".", ",") for valor in valores]
+
+
+def nome_ativo(i):
+    ## AAAA3, AAAB4, AAAC3, ...: quatro letras e a classe (3 para ON, 4 para PN)
+    letras = ""
+    resto_i = i
+    for _ in range(4):
+        resto_i, resto = divmod(resto_i, 26)
+        letras = chr(65 + resto) + letras
+    return letras + ("3" if i % 2 == 0 else "4")
+
+
+def pasta_tratamento(raiz):
+    ## Pasta de onde Tratar_dados.py deve ser executado: os arquivos são endereçados como ../../../dataset
+    pasta = os.path.join(raiz, "modules", "Colher_tratar_dados", "Dados_Fund")
+    os.makedirs(pasta, exist_ok=True)
+    return pasta
+
+
+def gerar_cotacoes(rng, dias, fatores_eventos):
+    ## Cotações diárias. O fechamento histórico é o ajustado dividido pelo fator acumulado dos eventos posteriores
+    retornos = rng.normal(0.0003, 0.02, len(dias))
+    fech_ajustado = 10*np.exp(np.cumsum(retornos))
+    fator_historico = np.ones(len(dias))
+    for data, fator in fatores_eventos:
+        fator_historico[dias < data] *= fator
+    df_cot = pd.DataFrame(index=dias.strftime("%d/%m/%Y"))
+    df_cot["Fech_Ajustado"] = texto_br(fech_ajustado, 2)
+    df_cot["Variação(%)"] = texto_br(retornos*100, 4)
+    df_cot["Fech_Historico"] = texto_br(fech_ajustado*fator_historico, 2)
+    for coluna, escala in [("Abertura_Ajustado", 1.0), ("Min_Ajustado", 0.98), ("Medio_Ajustado", 1.0), ("Max_Ajustado", 1.02)]:
+        df_cot[coluna] = texto_br(fech_ajustado*escala, 2)
+    df_cot["Vol(MM_R$)"] = texto_br(rng.lognormal(3, 1, len(dias)), 2)
+    df_cot["Negocios"] = [str(n) for n in rng.integers(100, 10000, len(dias))]
+    df_cot["Fator"] = "1"
+    ## Alguns dias sem negociação, como nos dados reais
+    df_cot.iloc[rng.integers(0, len(dias), max(1, len(dias)//500)), 2] = ""
+    return df_cot
+
+
+def gerar_fundamentos(rng, trimestres, setor, num_acoes):
+    ## Balanços trimestrais, com as datas de divulgação algumas semanas depois do fim do trimestre
+    n = len(trimestres)
+    crescimento = np.exp(np.cumsum(rng.normal(0.02, 0.05, n)))
+    df_fund = pd.DataFrame(index=trimestres.strftime("%d/%m/%Y"))
+    df_fund["Data_balanco"] = (trimestres + pd.Timedelta(days=45)).strftime("%d/%m/%Y")
+    df_fund["Data_demonstracao"] = (trimestres + pd.Timedelta(days=40)).strftime("%d/%m/%Y")
+    df_fund["Data_analise"] = (trimestres + pd.Timedelta(days=50)).strftime("%d/%m/%Y")
+    df_fund["Setor_Comdinheiro"] = setor
+    colunas = {'Num_acoes': num_acoes, 'Fator_equivalencia_acoes': np.ones(n),
+               'Market_value': crescimento*1e10*rng.uniform(0.8, 1.2, n), 'PL': crescimento*5e9,
+               'RL': crescimento*1e9*rng.uniform(0.9, 1.1, n), 'EBITDA': crescimento*3e8*rng.uniform(0.5, 1.5, n),
+               'D&A': crescimento*1e7, 'EBIT': crescimento*2e8, 'LL': crescimento*1e8*rng.normal(1, 0.8, n),
+               'LL_controlador': crescimento*1e8, 'LL_nao_controlador': crescimento*1e6,
+               'ROIC': rng.uniform(0, 20, n), 'ROE': rng.uniform(0, 20, n), 'Div_Bruta': crescimento*2e9,
+               'Div_liq': crescimento*1e9*rng.uniform(-0.5, 1.5, n), 'Div_Arrendamento': crescimento*1e8,
+               'FCO': crescimento*2e8, 'FCI': -crescimento*1e8, 'FCF': crescimento*1e8, 'Preco_fechamento': 10*crescimento,
+               'Payout': rng.uniform(0, 100, n), 'Proventos': crescimento*5e7*rng.uniform(0.5, 1.5, n), 'JCP': crescimento*1e7}
+    for coluna in COLUNAS_FUND_PCT:
+        colunas[coluna] = rng.uniform(0, 10, n)
+    colunas['meses'] = np.full(n, 3.0)
+    for coluna, valores in colunas.items():
+        df_fund[coluna] = texto_br(valores, 4)
+    ## Um balanço sem número de ações, que o tratamento descarta
+    df_fund.iloc[min(2, n-1), df_fund.columns.get_loc("Num_acoes")] = None
+    return df_fund
+
+
+def gerar_proventos(rng, data_inicial, data_final, classe):
+    datas = pd.date_range(data_inicial, data_final, freq="6M")
+    df_prov = pd.DataFrame(index=datas.strftime("%d/%m/%Y"))
+    df_prov["Valor_do_Provento"] = texto_br(rng.uniform(0.1, 1, len(datas)), 4)
+    df_prov["Último_preco_com"] = texto_br(rng.uniform(5, 20, len(datas)), 2)
+    df_prov["Provento_por"] = "1"
+    df_prov["Tipo"] = np.where(rng.uniform(size=len(datas)) < 0.5, "todas", classe)
+    df_prov["Tipo_do_Provento"] = np.where(rng.uniform(size=len(datas)) < 0.5, "JCP", "Dividendo")
+    return df_prov
+
+
+def gerar_dataset(raiz, n_ativos=50, anos=15, n_eventos=3, semente=0, data_final=pd.Timestamp("2023-12-29")):
+    ## Gera a árvore em raiz/dataset e retorna a lista de ativos.
+    ## n_eventos é o número de desdobramentos/grupamentos de cada ativo (um em cada quatro ativos não tem eventos)
+    rng = np.random.default_rng(semente)
+    pasta_brutos = os.path.join(raiz, "dataset", "BR", "ACOES", "Dados_Brutos")
+    pasta_selic = os.path.join(raiz, "dataset", "BR", "Selic")
+    for pasta in [pasta_brutos, pasta_selic, os.path.join(raiz, "dataset", "BR", "ACOES", "Dados_Tratados")]:
+        os.makedirs(pasta, exist_ok=True)
+
+    data_final = pd.Timestamp(data_final)
+    data_inicial = pd.Timestamp(data_final.year - anos, 1, 1)
+    dias = pd.bdate_range(data_inicial, data_final)
+    ## Os balanços começam três anos antes das cotações, para o CAGR
+    trimestres = pd.date_range(pd.Timestamp(data_inicial.year - 3, 3, 31), data_final, freq="Q")
+
+    lista_ativos = []
+    for i in range(n_ativos):
+        Ticker = nome_ativo(i)
+        lista_ativos.append(Ticker)
+        classe = "ON" if Ticker.endswith("3") else "PN"
+
+        ## Eventos: desdobramentos, grupamentos e bonificações
+        fatores_eventos = []
+        if i % 4 != 3 and n_eventos > 0:
+            datas_eventos = pd.DatetimeIndex(np.sort(rng.choice(dias[1:], n_eventos, replace=False)))
+            fatores = rng.choice([2, 0.5, 1.1, 10], n_eventos)
+            fatores_eventos = list(zip(datas_eventos, fatores))
+            df_eventos = pd.DataFrame(index=datas_eventos.strftime("%d/%m/%Y"))
+            df_eventos["Fator"] = [f"{fator:g}".replace(".", ",") for fator in fatores]
+            df_eventos["ClasseAcao"] = np.where(np.arange(n_eventos) % 2 == 0, "todas", classe)
+            df_eventos.to_parquet(os.path.join(pasta_brutos, f"{Ticker}_Eventos.parquet"))
+
+        ## Número de ações dos balanços, já com os eventos posteriores a cada balanço desfeitos
+        num_acoes = np.full(len(trimestres), 1e9)
+        for data, fator in fatores_eventos:
+            num_acoes[trimestres + pd.Timedelta(days=45) < data] /= fator
+
+        gerar_cotacoes(rng, dias, fatores_eventos).to_parquet(os.path.join(pasta_brutos, f"{Ticker}_Cot.parquet"))
+        gerar_fundamentos(rng, trimestres, SETORES[i % len(SETORES)], num_acoes).to_parquet(
+            os.path.join(pasta_brutos, f"{Ticker}_Fund.parquet"))
+        gerar_proventos(rng, data_inicial, data_final, classe).to_parquet(os.path.join(pasta_brutos, f"{Ticker}_Prov.parquet"))
+
+    pd.DataFrame({"Ticker": lista_ativos}).to_parquet(os.path.join(pasta_brutos, "Lista_Ativos_Busca.parquet"))
+
+    ## Matriz de elegibilidade mensal: cerca de 80% dos ativos em cada mês, nenhum nos dois primeiros anos
+    meses = pd.date_range(data_inicial, data_final, freq="M")
+    elegiveis = (rng.uniform(size=(len(meses), n_ativos)) < 0.8).astype(int)
+    elegiveis[:24, :] = 0
+    pd.DataFrame(elegiveis, index=meses, columns=lista_ativos).to_parquet(
+        os.path.join(raiz, "dataset", "BR", "ACOES", "IBOV_Elegivel.parquet"))
+
+    ## Selic diária (em texto, como no arquivo bruto) e a sua expectativa para os próximos 12 meses
+    datas_selic = pd.date_range(data_inicial, data_final, freq="D")
+    selic = np.clip(10 + np.cumsum(rng.normal(0, 0.05, len(datas_selic))), 2, 16)
+    df_Selic = pd.DataFrame({"data": datas_selic.strftime("%d/%m/%Y"),
+                             "anula100": texto_br(selic, 2), "diario": texto_br(selic/252, 6)})
+    df_Selic.to_parquet(os.path.join(pasta_selic, "Selic.parquet"))
+
+    df_Expectativa_Selic = pd.DataFrame({"Valor": selic}, index=pd.DatetimeIndex(datas_selic, name="Data"))
+    for mes in range(1, 13):
+        df_Expectativa_Selic[f"{mes}_mes"] = selic + 0.01*mes
+    df_Expectativa_Selic.to_parquet(os.path.join(pasta_selic, "Expectativa_Selic_Diaria.parquet"))
+
+    return lista_ativos
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gera um dataset sintético no formato dos dados brutos")
+    parser.add_argument("raiz", help="Pasta onde a árvore dataset/BR/... é criada")
+    parser.add_argument("--ativos", type=int, default=50, help="Número de ativos")
+    parser.add_argument("--anos", type=int, default=15, help="Anos de cotações")
+    parser.add_argument("--eventos", type=int, default=3, help="Eventos (desdobramentos/grupamentos) por ativo")
+    parser.add_argument("--semente", type=int, default=0, help="Semente dos números aleatórios")
+    args = parser.parse_args()
+
+    lista_ativos = gerar_dataset(args.raiz, args.ativos, args.anos, args.eventos, args.semente)
+    print(f"{len(lista_ativos)} ativos gerados em {os.path.join(args.raiz, 'dataset')}")
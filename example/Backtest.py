@@ -0,0 +1,238 @@
+import pandas as pd
+import numpy as np
+from datetime import datetime
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from example.Estrategia_retorno import main_ret
+from modules.Colher_tratar_dados.load_data import ArmazemSnapshot, ler_acoes, ler_indice_elegibilidade, montar_painel_precos
+from modules.Colher_tratar_dados.cache_arrow import construir_cache_arrow
+
+
+# Funções
+
+## Armazém de dados do processo: o histórico é carregado uma única vez por processo
+_armazem = None
+_cache_arrow = False
+
+def _armazem_do_processo():
+    global _armazem
+    if _armazem is None:
+        _armazem = ArmazemSnapshot(cache_arrow=_cache_arrow)
+    return _armazem
+
+def _iniciar_processo(cache_arrow=False):
+    ## Os processos do pool não mostram figuras
+    global _cache_arrow
+    import matplotlib
+    matplotlib.use("Agg")
+    _cache_arrow = cache_arrow
+
+
+def calendario_rebalanceamento(data_inicio, data_fim, frequencia="BM"):
+    """
+    Cria o calendário de datas de rebalanceamento da carteira.
+
+    Parâmetros:
+    data_inicio (datetime): Primeira data do calendário.
+    data_fim (datetime): Última data do calendário.
+    frequencia (str): Frequência das datas, no formato do pandas. Padrão é 'BM' (último dia útil de cada mês).
+
+    Retorna:
+    datas (list): Lista de datas de rebalanceamento.
+
+    Exemplo de uso:
+    datas = calendario_rebalanceamento(datetime(2010,1,1), datetime(2023,12,31))
+    """
+    return list(pd.date_range(data_inicio, data_fim, freq=frequencia))
+
+
+def pesos_carteira(expec_retorno, cotacoes, setores, metodo="max_sharpe"):
+    """
+    Calcula os pesos da carteira a partir do retorno esperado e das cotações dos ativos.
+
+    Parâmetros:
+    expec_retorno (pd.Series): Retorno anual esperado de cada ativo (info_main[0] do main_ret).
+    cotacoes (pd.DataFrame): Cotações ajustadas dos ativos (info_main[1] do main_ret).
+    setores (pd.Series): Setor de cada ativo (info_main[2] do main_ret).
+    metodo (str): 'max_sharpe' para a fronteira eficiente do pypfopt, com as mesmas restrições do main.ipynb
+                  (peso entre 0 e 10%, setores entre 5% e 40% e regularização L2 com gamma 0.1),
+                  ou 'igual' para pesos iguais. Padrão é 'max_sharpe'.
+
+    Retorna:
+    pesos (pd.Series): Peso de cada ativo, sem os ativos com peso nulo.
+
+    Exemplo de uso:
+    pesos = pesos_carteira(expec_retorno, cotacoes, setores, 'igual')
+    """
+    if len(expec_retorno) == 0:
+        return pd.Series(dtype=float)
+
+    if metodo == "igual":
+        return pd.Series(1/len(expec_retorno), index=expec_retorno.index)
+
+    ## pypfopt só é necessário para a fronteira eficiente
+    from pypfopt import risk_models, EfficientFrontier, objective_functions
+
+    setores_dic = setores.to_dict()
+    unique_sectors = list(set(setores))
+    sector_lower = {setor: 0.05 for setor in unique_sectors}
+    sector_upper = {setor: 0.4 for setor in unique_sectors}
+
+    S = risk_models.CovarianceShrinkage(cotacoes).ledoit_wolf()
+    ef = EfficientFrontier(expec_retorno, S, weight_bounds=(0, 0.1))
+    ef.add_sector_constraints(setores_dic, sector_lower, sector_upper)
+    ef.add_objective(objective_functions.L2_reg, gamma=0.1)
+    ef.max_sharpe()
+    pesos = pd.Series(ef.clean_weights(), dtype=float)
+
+    return pesos[pesos != 0]
+
+
+def pesos_na_data(data_simulacao, metodo="max_sharpe"):
+    """
+    Calcula o retorno esperado e os pesos da carteira em uma data de rebalanceamento.
+
+    Parâmetros:
+    data_simulacao (datetime): Data de rebalanceamento.
+    metodo (str): Método de cálculo dos pesos (ver pesos_carteira).
+
+    Retorna:
+    resultado (dict): Data, pesos (pd.Series), status ('ok' ou 'erro'), erro, traceback e tempo gasto.
+
+    Os dados são lidos do armazém do processo, que carrega o histórico uma única vez. Se o cálculo falhar,
+    a carteira da data fica vazia (em caixa) e o erro é devolvido no resultado.
+
+    Exemplo de uso:
+    resultado = pesos_na_data(datetime(2021,6,10), 'igual')
+    """
+    resultado = {"Data": pd.Timestamp(data_simulacao), "Pesos": pd.Series(dtype=float),
+                 "Status": "ok", "Erro": None, "Traceback": None, "Tempo": np.nan}
+    inicio = time.perf_counter()
+    try:
+        dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal = _armazem_do_processo().visao(data_simulacao)
+        info_main, info_verificao = main_ret(dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal, renderizar=False)
+        expec_retorno, cotacoes, setores = info_main
+        resultado["Pesos"] = pesos_carteira(expec_retorno, cotacoes, setores, metodo)
+    except Exception as erro:
+        resultado["Status"] = "erro"
+        resultado["Erro"] = repr(erro)
+        resultado["Traceback"] = traceback.format_exc()
+    resultado["Tempo"] = time.perf_counter() - inicio
+
+    return resultado
+
+
+def painel_fechamento_ajustado(data_inicio, data_fim, n_threads=8):
+    """
+    Monta o painel de cotações ajustadas (datas x ativos) dos ativos elegíveis em alguma data do período (ver IndiceElegibilidade.uniao).
+
+    Parâmetros:
+    data_inicio (datetime): Data inicial do painel.
+    data_fim (datetime): Data final do painel.
+    n_threads (int): Número de leituras em paralelo. Padrão é 8.
+
+    Retorna:
+    df_precos (pd.DataFrame): Fech_Ajustado em ordem crescente de data, com a última cotação repetida nos dias sem negociação.
+
+    Exemplo de uso:
+    df_precos = painel_fechamento_ajustado(datetime(2010,1,1), datetime(2023,12,31))
+    """
+    lista_ativos = ler_indice_elegibilidade().uniao(data_inicio, data_fim)
+    dict_df_acoes, dict_nao_encontrados = ler_acoes(lista_ativos, data_inicio, data_fim, n_threads)
+
+    df_precos = montar_painel_precos({ativo: dict_df_acoes[ativo][1]["Fech_Ajustado"] for ativo in dict_df_acoes})
+
+    return df_precos.ffill()
+
+
+def backtest_walk_forward(datas_rebalanceamento, metodo="max_sharpe", n_processos=1, custo_transacao=0.0, cache_arrow=False):
+    """
+    Backtest walk-forward da estratégia: em cada data de rebalanceamento calcula o retorno esperado (main_ret)
+    e os pesos da carteira, e mede o retorno realizado com o Fech_Ajustado até a próxima data.
+
+    Parâmetros:
+    datas_rebalanceamento (list): Datas de rebalanceamento, em ordem crescente. A carteira montada em cada data é mantida
+                                  até a data seguinte; a última data apenas encerra o último período.
+    metodo (str): Método de cálculo dos pesos (ver pesos_carteira). Padrão é 'max_sharpe'.
+    n_processos (int): Número de processos para calcular as datas em paralelo. Com 1, as datas são calculadas em sequência. Padrão é 1.
+    custo_transacao (float): Custo por unidade de valor negociado, descontado do capital em cada rebalanceamento. Padrão é 0.
+    cache_arrow (bool): Com n_processos > 1, os processos leem os dados do cache Arrow mapeado em memória
+                        (ver construir_cache_arrow), que é construído ou atualizado antes de iniciar o pool:
+                        todos os processos compartilham uma única cópia dos dados. Padrão é False.
+
+    Retorna:
+    curva_capital (pd.Series): Capital diário da carteira, começando em 1.
+    df_pesos (pd.DataFrame): Pesos de cada ativo (colunas) em cada data de rebalanceamento (índice).
+    df_relatorio (pd.DataFrame): Para cada data de rebalanceamento, número de ativos, turnover, custo, retorno do período,
+                                 capital ao final do período, status, erro e tempo gasto.
+
+    Os pesos que não somam 1 ficam em caixa, sem rendimento. O turnover é o de uma ponta, 0,5*soma(|peso novo - peso anterior|),
+    com o peso anterior já corrigido pela variação dos preços no período.
+
+    Exemplo de uso:
+    datas = calendario_rebalanceamento(datetime(2010,1,1), datetime(2023,12,31))
+    curva_capital, df_pesos, df_relatorio = backtest_walk_forward(datas, 'max_sharpe', n_processos=8, cache_arrow=True)
+    """
+    datas_rebalanceamento = [pd.Timestamp(data) for data in datas_rebalanceamento]
+
+    ## Pesos em cada data de rebalanceamento
+    datas_carteira = datas_rebalanceamento[:-1]
+    if n_processos == 1:
+        ## Os ativos de todas as datas são lidos de uma vez, com as leituras em paralelo
+        if datas_carteira:
+            _armazem_do_processo().precarregar(datas_carteira[0], datas_carteira[-1])
+        lista_resultados = [pesos_na_data(data, metodo) for data in datas_carteira]
+    else:
+        if cache_arrow:
+            construir_cache_arrow()
+        with ProcessPoolExecutor(max_workers=n_processos, initializer=_iniciar_processo, initargs=(cache_arrow,)) as executor:
+            lista_resultados = list(executor.map(pesos_na_data, datas_carteira, [metodo]*len(datas_carteira)))
+
+    for resultado in lista_resultados:
+        if resultado["Status"] != "ok":
+            print(f"Data: {resultado['Data'].date()} ficou em caixa: {resultado['Erro']}")
+
+    df_pesos = pd.DataFrame([resultado["Pesos"] for resultado in lista_resultados], index=datas_carteira).fillna(0)
+    df_pesos = df_pesos.reindex(columns=sorted(df_pesos.columns))
+    df_pesos.index.name = "Data"
+
+    ## Retorno realizado
+    df_precos = painel_fechamento_ajustado(datas_rebalanceamento[0] - pd.DateOffset(days=10), datas_rebalanceamento[-1])
+    capital = 1.0
+    pesos_anteriores = pd.Series(dtype=float)
+    lista_curva = [pd.Series([capital], index=[datas_rebalanceamento[0]])]
+    lista_relatorio = []
+    for i, data in enumerate(datas_carteira):
+        pesos = df_pesos.loc[data]
+        pesos = pesos[pesos != 0]
+
+        ## Turnover contra os pesos anteriores corrigidos pelos preços
+        ativos = pesos.index.union(pesos_anteriores.index)
+        turnover = 0.5*np.abs(pesos.reindex(ativos, fill_value=0) - pesos_anteriores.reindex(ativos, fill_value=0)).sum()
+        custo = custo_transacao*2*turnover
+        capital = capital*(1 - custo)
+
+        ## Valor diário da carteira no período, mantendo as quantidades compradas na data
+        precos_periodo = df_precos.loc[(df_precos.index >= df_precos.index[df_precos.index <= data].max())
+                                       & (df_precos.index <= datas_rebalanceamento[i+1]), pesos.index]
+        variacao = (precos_periodo/precos_periodo.iloc[0]).fillna(1)
+        valor = variacao.to_numpy() @ pesos.to_numpy() + (1 - pesos.sum())
+        curva_periodo = pd.Series(capital*valor, index=precos_periodo.index)
+        lista_curva.append(curva_periodo.iloc[1:])
+
+        retorno_periodo = valor[-1] - 1
+        capital = capital*valor[-1]
+        pesos_anteriores = pesos*variacao.iloc[-1]/valor[-1]
+
+        lista_relatorio.append({"Data": data, "N_ativos": len(pesos), "Turnover": turnover, "Custo": custo,
+                                "Retorno_periodo": retorno_periodo, "Capital": capital,
+                                "Status": lista_resultados[i]["Status"], "Erro": lista_resultados[i]["Erro"],
+                                "Tempo": lista_resultados[i]["Tempo"]})
+
+    curva_capital = pd.concat(lista_curva)
+    curva_capital = curva_capital[~curva_capital.index.duplicated(keep="last")]
+    df_relatorio = pd.DataFrame(lista_relatorio).set_index("Data")
+
+    return curva_capital, df_pesos, df_relatorio
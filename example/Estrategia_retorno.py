@@ -1,98 +1,207 @@
 
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from datetime import datetime
-import statsmodels.api as sm
 import os
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from modules.Colher_tratar_dados.load_data import montar_painel_precos, inicio_janela, calendario_negociacao
+from modules.Colher_tratar_dados.instrumentacao import instrumentar
+## statsmodels, scipy e matplotlib são importados nas funções que os usam (regressões e gráficos): importados aqui,
+## somariam alguns segundos ao início de cada processo, mesmo nas execuções que não desenham nem resumem nada
 
 
 # Funções
 
-def Regressao_linear(df,x_label,y_label,prev_n_steps_meses,ticker, tipo="linear"):
+@instrumentar()
+def regressao_em_lote(dict_df_regressao, x_label, y_label, prev_n_steps_meses):
     """
-    Realiza uma regressão linear de um múltiplo em relação à expectativa da SELIC.
+    Realiza, de uma só vez, as regressões linear e logarítmica de um múltiplo em relação à expectativa da SELIC para vários ativos.
 
     Parâmetros:
-    df (DataFrame): DataFrame contendo os dados.
+    dict_df_regressao (dict): Dicionário com chaves sendo os ativos e valores sendo os DataFrames de cada regressão.
     x_label (str): Nome da coluna que contém a expectativa de SELIC no eixo x.
     y_label (str): Nome da coluna que contém o múltiplo no eixo y.
     prev_n_steps_meses (float): Previsão da expectativa da SELIC para 'n' meses no futuro.
-    ticker (str): Ticker da ação.
-    tipo (str): Tipo de regressão ('linear' ou 'log'). Padrão é 'linear'.
 
     Retorna:
-    fig_regressao (Figure): Gráfico da regressão linear.
-    fig_residuos (Figure): Gráfico de resíduos da regressão.
-    r_squared (float): Coeficiente de determinação (R²) da regressão.
-    y_ultimo_prev (float): Valor previsto do múltiplo para a expectativa de SELIC fornecida.
-    summary (str): Resumo estatístico do modelo de regressão.
+    df_regressoes (pd.DataFrame): Para cada ativo (índice) e cada tipo de regressão (sufixo '_linear' ou '_log'): coeficiente,
+    intercepto, R², p-valor do coeficiente (texto, como na tabela do statsmodels), desvio padrão dos resíduos e valor previsto
+    do múltiplo; e a melhor regressão ('Melhor'), com o seu valor previsto, p-valor e R².
 
-    A função realiza uma regressão linear ou logarítmica dos valores do múltiplo em relação à expectativa da SELIC.
-    Em seguida, calcula o valor previsto do múltiplo para a expectativa de SELIC fornecida e cria gráficos da regressão
-    e dos resíduos. Retorna o R², o valor previsto e um resumo estatístico do modelo.
+    As séries de todos os ativos são empilhadas em matrizes (ativos x meses) e as regressões são resolvidas pelas fórmulas fechadas
+    do OLS com uma variável. A melhor regressão segue a mesma regra de Func_definir_melhor_regressao: a linear, se o seu R² for
+    maior ou igual ao da logarítmica. Ativos com algum valor inválido (por exemplo, log de múltiplo negativo) ficam com NaN.
 
     Exemplo de uso:
-    fig_regressao, fig_residuos, r_squared, y_ultimo_prev, summary = Regressao_linear(df, 'Expectativa_SELIC', 'Multiplo', 12, 'PETR4', 'linear')
+    df_regressoes = regressao_em_lote({'PETR4': df_regressao}, 'Valor', 'PVPA', 12)
     """
+    from scipy.special import stdtr
+    ativos = list(dict_df_regressao)
+    n_max = max([len(df) for df in dict_df_regressao.values()], default=0)
+    X = np.zeros((len(ativos), n_max))
+    Y = np.ones((len(ativos), n_max))
+    W = np.zeros((len(ativos), n_max))
+    for i, df in enumerate(dict_df_regressao.values()):
+        X[i, :len(df)] = df[x_label].to_numpy(dtype=float)
+        Y[i, :len(df)] = df[y_label].to_numpy(dtype=float)
+        W[i, :len(df)] = 1
+
+    df_regressoes = pd.DataFrame(index=ativos)
+    n = W.sum(axis=1)
+    for tipo in ["linear", "log"]:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            Y_tipo = Y if tipo == "linear" else np.log(Y)
+            invalido = ((W > 0) & ~(np.isfinite(X) & np.isfinite(Y_tipo))).any(axis=1)
+            X_tipo = np.where(W > 0, X, 0)
+            Y_tipo = np.where(W > 0, Y_tipo, 0)
+
+            ## Médias, somas de quadrados e coeficientes
+            media_x = X_tipo.sum(axis=1)/n
+            media_y = Y_tipo.sum(axis=1)/n
+            dx = (X_tipo - media_x[:, None])*W
+            dy = (Y_tipo - media_y[:, None])*W
+            Sxx = (dx*dx).sum(axis=1)
+            coef_x = (dx*dy).sum(axis=1)/Sxx
+            intercept = media_y - coef_x*media_x
+
+            ## Resíduos, R² e p-valor do coeficiente (teste t com n-2 graus de liberdade)
+            residuos = (Y_tipo - intercept[:, None] - coef_x[:, None]*X_tipo)*W
+            SSR = (residuos*residuos).sum(axis=1)
+            r_squared = 1 - SSR/(dy*dy).sum(axis=1)
+            erro_padrao = np.sqrt(SSR/(n - 2)/Sxx)
+            p_valor = 2*stdtr(n - 2, -np.abs(coef_x/erro_padrao))
+            desvio_padrao_residuos = np.sqrt(((residuos - (residuos.sum(axis=1)/n)[:, None]*W)**2).sum(axis=1)/n)
+
+            ## Valor previsto do múltiplo para a expectativa de SELIC
+            y_ultimo_prev = coef_x*prev_n_steps_meses + intercept
+            if tipo == "log":
+                y_ultimo_prev = np.exp(y_ultimo_prev)
+            y_ultimo_prev = np.round(y_ultimo_prev, 3)
+
+        for nome, valores in [("Coef", coef_x), ("Intercepto", intercept), ("R2", r_squared),
+                              ("Desvio_residuos", desvio_padrao_residuos), ("Y_prev", y_ultimo_prev)]:
+            df_regressoes[f"{nome}_{tipo}"] = np.where(invalido, np.nan, valores)
+        df_regressoes[f"P_valor_{tipo}"] = ["%#6.3f" % valor for valor in np.where(invalido, np.nan, p_valor)]
 
-    
-    x = df[[x_label]]
+    ## Ver qual regressão teve o melhor R^2
+    linear_melhor = (df_regressoes["R2_linear"] >= df_regressoes["R2_log"]).to_numpy()
+    df_regressoes["Melhor"] = np.where(linear_melhor, "linear", "log")
+    for nome in ["Y_prev", "P_valor", "R2"]:
+        df_regressoes[nome] = np.where(linear_melhor, df_regressoes[f"{nome}_linear"], df_regressoes[f"{nome}_log"])
 
-    if tipo=="linear":
-        y = df[y_label]
-    elif tipo=="log":
-        logy = np.log(df[y_label])
-        y = logy
-    
-    # with statsmodels
-    x = sm.add_constant(x) # adding a constant
-    try:
-        # modelo 
-        model = sm.OLS(y, x).fit()
-    except:
-        raise
-    parametros = model.params
-    r_squared = model.rsquared
-    intercept = parametros["const"]
-    coef_x = parametros[x_label] 
-    # Calcule os resíduos
-    residuos = model.resid
-    # Calcule o desvio padrão dos resíduos
-    desvio_padrao_residuos = np.std(residuos)
-
-    # Obtenha o resumo do modelo
-    summary = model.summary()
+    return df_regressoes
+
+
+class SumarioOLS:
+    """
+    Resumo estatístico do statsmodels de uma regressão, construído apenas quando for usado.
+
+    Parâmetros:
+    df (DataFrame): DataFrame contendo os dados.
+    x_label (str): Nome da coluna do eixo x.
+    y_label (str): Nome da coluna do eixo y.
+    tipo (str): Tipo de regressão ('linear' ou 'log'). Padrão é 'linear'.
+
+    O objeto se comporta como o resumo do statsmodels (tables, as_text, exibição no notebook etc.): o modelo OLS e o resumo
+    são criados no primeiro acesso e guardados.
+
+    Exemplo de uso:
+    summary = SumarioOLS(df, 'Valor', 'PVPA', 'log')
+    p_valor = summary.tables[1].data[2][4]
+    """
+    def __init__(self, df, x_label, y_label, tipo="linear"):
+        self.df = df
+        self.x_label = x_label
+        self.y_label = y_label
+        self.tipo = tipo
+        self._summary = None
+
+    def summary(self):
+        if self._summary is None:
+            import statsmodels.api as sm
+            x = sm.add_constant(self.df[[self.x_label]])
+            if self.tipo=="linear":
+                y = self.df[self.y_label]
+            elif self.tipo=="log":
+                y = np.log(self.df[self.y_label])
+            self._summary = sm.OLS(y, x).fit().summary()
+        return self._summary
+
+    def __getattr__(self, nome):
+        if nome.startswith("__") or "_summary" not in self.__dict__:
+            raise AttributeError(nome)
+        return getattr(self.summary(), nome)
+
+    def __str__(self):
+        return str(self.summary())
+
+    def __repr__(self):
+        return repr(self.summary())
+
+
+def _figura_multiplo_selic(espec):
+    ## Gráfico do múltiplo e da expectativa da SELIC no tempo
+    import matplotlib.pyplot as plt
+    x_label, y_label, ticker = espec["x_label"], espec["y_label"], espec["Ticker"]
+    datas, x, y = espec["Datas"], espec["x"], espec["y"]
+
+    fig_multiplo_selic, ax = plt.subplots(figsize=(15,6))
+    ax.plot(datas, x,label=x_label)
+    # Plotar no eixo secundário
+    ax2 = ax.twinx()
+    ax2.plot(datas, y,color="red", label=y_label)
+    ax2.axhline(y=espec["Media"], color='r', linestyle='--', label=f'Média do{y_label}')
+    # Adicione linhas tracejadas em múltiplos desvios padrão (por exemplo, 1 e 2 desvios padrão)
+    ax2.axhline(y=espec["Media"]+espec["Desvio"], color='g', linestyle='-.', label='1 Desvio Padrão')
+    ax2.axhline(y=espec["Media"]-espec["Desvio"], color='g', linestyle='-.')
+
+    # Ativar a legenda
+    ax.legend(loc=2)
+    ax2.legend(loc=1)
+    # Adicione um título ao gráfico
+    ax.set_title(f"{ticker}, análise de {x_label} e {y_label}.")
+    # Especifique os valores de x (datas) que você deseja exibir no eixo x (por exemplo, a cada ano)
+    valores_xticks = pd.date_range(start=datas.min(), end=datas.max(), freq="A")
+    # Atribua rótulos formatados para os valores de x
+    rotulos_xticks = [data.strftime("%Y") for data in valores_xticks]
+    # Configure os valores e rótulos no eixo x
+    ax.set_xticks(valores_xticks)
+    ax.set_xticklabels(rotulos_xticks, rotation=45)  # A rotação é opcional para melhor legibilidade
+
+    plt.close(fig_multiplo_selic)
+    return fig_multiplo_selic
+
+
+def _figura_regressao(espec):
+    ## Gráfico da regressão, com a reta e um desvio padrão dos resíduos
+    import matplotlib.pyplot as plt
+    y_label, ticker = espec["y_label"], espec["Ticker"]
+    coef_x, intercept, desvio_padrao_residuos = espec["Coef"], espec["Intercepto"], espec["Desvio_residuos"]
+    y_ultimo_prev, r_squared = espec["Y_prev"], espec["R2"]
 
     # Fazendo uma reta com os parâmetros encontrados
     x_RANGE = np.linspace(1.5,17,100)
     y = x_RANGE*coef_x+ intercept
-    y_ultimo_prev = coef_x*prev_n_steps_meses+ intercept
 
     ## Desvio padrão do plot
     um_desvio_sup = y + desvio_padrao_residuos
     um_desvio_inf = y - desvio_padrao_residuos
 
-
-
-    if tipo=="log":
-        y_ultimo_prev = np.exp(y_ultimo_prev)
+    if espec["Tipo"]=="log":
         um_desvio_sup = np.exp(um_desvio_sup)
         um_desvio_inf = np.exp(um_desvio_inf)
         y = np.exp(y)
 
-    y_ultimo_prev = round(y_ultimo_prev,3)
-
-    # Gráfico da regressão linear
-
     fig_regressao, ax = plt.subplots(figsize=(15,8))
 
-    ax.scatter(df[x_label],df[y_label])
-    ax.scatter(df[x_label][-1],df[y_label][-1],color='red', label="Último Ponto")
+    ax.scatter(espec["x"],espec["y"])
+    ax.scatter(espec["x"][-1],espec["y"][-1],color='red', label="Último Ponto")
 
-    
-    # Adicione uma linha vertical em x = 3
-    ultm_prev_SELIC = prev_n_steps_meses
+    # Adicione uma linha vertical na previsão da SELIC
+    ultm_prev_SELIC = espec["Prev_selic"]
     ax.axvline(x=ultm_prev_SELIC, color='green', linestyle='--', label=f'Linha Vertical, {round(ultm_prev_SELIC,2)} %')
     ax.axhline(y=y_ultimo_prev, color='red', linestyle='--', label=f'Linha Horizontal, {y_ultimo_prev}')
     ax.plot(x_RANGE,y,color='black',label=f'Regressão Linear')
@@ -104,14 +213,19 @@ def Regressao_linear(df,x_label,y_label,prev_n_steps_meses,ticker, tipo="linear"
     plt.ylabel(f"{y_label}")
     plt.title(f"Ticker: {ticker}, {y_label} x Expectativa de SELIC com R² = {round(r_squared,3)}")
     plt.close(fig_regressao)
+    return fig_regressao
+
+
+def _figura_residuos(espec):
+    ## Gráfico de dispersão de resíduos versus valores previstos
+    import matplotlib.pyplot as plt
+    desvio_padrao_residuos = espec["Desvio_residuos"]
 
-    ## Plote do resíduos lineares
-    # Crie um gráfico de dispersão de resíduos versus valores previstos
     fig_residuos, ax = plt.subplots(figsize=(15,8))
-    ax.scatter(model.fittedvalues, residuos)
+    ax.scatter(espec["Valores_previstos"], espec["Residuos"])
     ax.set_xlabel("Valores Previstos")
     ax.set_ylabel("Resíduos")
-    ax.set_title(f"Ticker: {ticker},Gráfico de Resíduos")
+    ax.set_title(f"Ticker: {espec['Ticker']},Gráfico de Resíduos")
 
     # Adicione linhas tracejadas em múltiplos desvios padrão (por exemplo, 1 e 2 desvios padrão)
     ax.axhline(y=desvio_padrao_residuos, color='r', linestyle='--', label='1 Desvio Padrão')
@@ -125,12 +239,163 @@ def Regressao_linear(df,x_label,y_label,prev_n_steps_meses,ticker, tipo="linear"
     # Adicione uma legenda
     plt.legend()
     plt.close(fig_residuos)
+    return fig_residuos
+
+
+## Funções de desenho de cada tipo de gráfico
+_FIGURAS = {"multiplo_selic": _figura_multiplo_selic, "regressao": _figura_regressao, "residuos": _figura_residuos}
+
+
+def renderizar_figura(espec):
+    """
+    Desenha a figura descrita por uma especificação de gráfico.
+
+    Parâmetros:
+    espec (dict ou Figure): Especificação do gráfico (dados e parâmetros ajustados), como devolvida pelas funções
+                            de estratégia com renderizar=False. Uma Figure é devolvida sem alteração.
+
+    Retorna:
+    fig (Figure): Figura do matplotlib.
+
+    Exemplo de uso:
+    fig = renderizar_figura(info_verificao[2]['PETR4'][0])
+    """
+    if not isinstance(espec, dict):
+        return espec
+    return _FIGURAS[espec["Grafico"]](espec)
+
+
+def figuras_do_ativo(dic_figuras, ticker):
+    """
+    Desenha as figuras de um ativo a partir do dicionário de figuras do main_ret.
+
+    Parâmetros:
+    dic_figuras (dict): Dicionário de figuras (ou especificações de gráficos) por ativo, info_verificao[2] do main_ret.
+    ticker (str): Ticker da ação.
+
+    Retorna:
+    lista_figuras (list): Lista de figuras do matplotlib do ativo.
+
+    Exemplo de uso:
+    lista_figuras = figuras_do_ativo(info_verificao[2], 'PETR4')
+    """
+    return [renderizar_figura(espec) for espec in dic_figuras[ticker]]
+
+
+def _salvar_png(espec, arquivo):
+    import matplotlib.pyplot as plt
+    fig = renderizar_figura(espec)
+    fig.savefig(arquivo)
+    plt.close(fig)
+    return arquivo
+
+
+def _iniciar_processo_figuras():
+    ## Os processos do pool só salvam as figuras em arquivo
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+def salvar_figuras_png(dic_figuras, diretorio, lista_ativos=None, n_processos=1):
+    """
+    Desenha e salva em PNG as figuras dos ativos, opcionalmente em paralelo.
+
+    Parâmetros:
+    dic_figuras (dict): Dicionário de figuras (ou especificações de gráficos) por ativo, info_verificao[2] do main_ret.
+    diretorio (str): Pasta onde os arquivos serão salvos. É criada se não existir.
+    lista_ativos (list): Ativos a salvar. Padrão é None (todos os ativos do dicionário).
+    n_processos (int): Número de processos para desenhar as figuras em paralelo. Com 1, desenha em sequência. Padrão é 1.
+
+    Retorna:
+    lista_arquivos (list): Caminhos dos arquivos salvos, no formato '<diretorio>/<ticker>_<n>_<gráfico>.png'.
+
+    Exemplo de uso:
+    lista_arquivos = salvar_figuras_png(info_verificao[2], 'Figuras', ['PETR4', 'VALE3'], n_processos=4)
+    """
+    if lista_ativos is None:
+        lista_ativos = list(dic_figuras.keys())
+    os.makedirs(diretorio, exist_ok=True)
 
+    lista_especs = []
+    lista_arquivos = []
+    for ticker in lista_ativos:
+        for i, espec in enumerate(dic_figuras[ticker]):
+            nome = espec["Grafico"] if isinstance(espec, dict) else "figura"
+            lista_especs.append(espec)
+            lista_arquivos.append(os.path.join(diretorio, f"{ticker}_{i}_{nome}.png"))
+
+    if n_processos == 1:
+        return [_salvar_png(espec, arquivo) for espec, arquivo in zip(lista_especs, lista_arquivos)]
+
+    with ProcessPoolExecutor(max_workers=n_processos, initializer=_iniciar_processo_figuras) as executor:
+        return list(executor.map(_salvar_png, lista_especs, lista_arquivos))
+
+
+def Regressao_linear(df,x_label,y_label,prev_n_steps_meses,ticker, tipo="linear", resultado=None, renderizar=True):
+    """
+    Realiza uma regressão linear de um múltiplo em relação à expectativa da SELIC.
+
+    Parâmetros:
+    df (DataFrame): DataFrame contendo os dados.
+    x_label (str): Nome da coluna que contém a expectativa de SELIC no eixo x.
+    y_label (str): Nome da coluna que contém o múltiplo no eixo y.
+    prev_n_steps_meses (float): Previsão da expectativa da SELIC para 'n' meses no futuro.
+    ticker (str): Ticker da ação.
+    tipo (str): Tipo de regressão ('linear' ou 'log'). Padrão é 'linear'.
+    resultado (pd.Series): Linha do ativo em regressao_em_lote, se as regressões já foram feitas. Padrão é None (faz a regressão).
+    renderizar (bool): Se False, os gráficos não são desenhados e são devolvidas apenas as suas especificações
+                       (dados e parâmetros ajustados), que podem ser desenhadas depois com renderizar_figura. Padrão é True.
+
+    Retorna:
+    fig_regressao (Figure ou dict): Gráfico da regressão linear.
+    fig_residuos (Figure ou dict): Gráfico de resíduos da regressão.
+    r_squared (float): Coeficiente de determinação (R²) da regressão.
+    y_ultimo_prev (float): Valor previsto do múltiplo para a expectativa de SELIC fornecida.
+    summary (SumarioOLS): Resumo estatístico do modelo de regressão, construído apenas quando for usado.
+
+    A função realiza uma regressão linear ou logarítmica dos valores do múltiplo em relação à expectativa da SELIC.
+    Em seguida, calcula o valor previsto do múltiplo para a expectativa de SELIC fornecida e cria gráficos da regressão
+    e dos resíduos. Retorna o R², o valor previsto e um resumo estatístico do modelo.
+
+    Exemplo de uso:
+    fig_regressao, fig_residuos, r_squared, y_ultimo_prev, summary = Regressao_linear(df, 'Expectativa_SELIC', 'Multiplo', 12, 'PETR4', 'linear')
+    """
+    if resultado is None:
+        resultado = regressao_em_lote({ticker: df}, x_label, y_label, prev_n_steps_meses).iloc[0]
+
+    r_squared = resultado[f"R2_{tipo}"]
+    intercept = resultado[f"Intercepto_{tipo}"]
+    coef_x = resultado[f"Coef_{tipo}"]
+    # Desvio padrão dos resíduos
+    desvio_padrao_residuos = resultado[f"Desvio_residuos_{tipo}"]
+    y_ultimo_prev = resultado[f"Y_prev_{tipo}"]
+
+    # Resumo do modelo, construído só se for usado
+    summary = SumarioOLS(df, x_label, y_label, tipo)
+
+    # Valores previstos e resíduos
+    if tipo=="linear":
+        y_modelo = df[y_label]
+    elif tipo=="log":
+        y_modelo = np.log(df[y_label])
+    valores_previstos = coef_x*df[x_label] + intercept
+    residuos = y_modelo - valores_previstos
+
+    # Especificações dos gráficos da regressão e dos resíduos
+    fig_regressao = {"Grafico": "regressao", "Ticker": ticker, "Tipo": tipo, "x_label": x_label, "y_label": y_label,
+                     "x": df[x_label].to_numpy(), "y": df[y_label].to_numpy(), "Prev_selic": prev_n_steps_meses,
+                     "Y_prev": y_ultimo_prev, "Coef": coef_x, "Intercepto": intercept,
+                     "Desvio_residuos": desvio_padrao_residuos, "R2": r_squared}
+    fig_residuos = {"Grafico": "residuos", "Ticker": ticker, "Valores_previstos": valores_previstos.to_numpy(),
+                    "Residuos": residuos.to_numpy(), "Desvio_residuos": desvio_padrao_residuos}
+    if renderizar:
+        fig_regressao = renderizar_figura(fig_regressao)
+        fig_residuos = renderizar_figura(fig_residuos)
 
     return fig_regressao, fig_residuos, r_squared, y_ultimo_prev, summary
 
 
-def Func_definir_melhor_regressao(df,x_label,y_label,prev_n_steps_meses, ticker):
+def Func_definir_melhor_regressao(df,x_label,y_label,prev_n_steps_meses, ticker, resultado=None, renderizar=True):
     """
     Analisa e compara duas regressões lineares (linear e logarítmica) entre a expectativa da SELIC e um múltiplo desejado.
 
@@ -140,13 +405,15 @@ def Func_definir_melhor_regressao(df,x_label,y_label,prev_n_steps_meses, ticker)
     y_label (str): Nome da coluna que contém o múltiplo desejado no eixo y.
     prev_n_steps_meses (float): Previsão da expectativa da SELIC para 'n' meses no futuro.
     ticker (str): Ticker da ação.
+    resultado (pd.Series): Linha do ativo em regressao_em_lote, se as regressões já foram feitas. Padrão é None (faz as regressões).
+    renderizar (bool): Se False, devolve as especificações dos gráficos em vez das figuras (ver Regressao_linear). Padrão é True.
 
     Retorna:
-    lista_figuras (list): Lista de figuras geradas (gráficos).
+    lista_figuras (list): Lista de figuras geradas (gráficos), ou das suas especificações.
     y_ultimo_prev (float): Valor previsto do múltiplo com base na melhor regressão.
-    p_valor (float): P-valor do coeficiente do melhor modelo de regressão.
+    p_valor (str): P-valor do coeficiente do melhor modelo de regressão, como na tabela do statsmodels.
     r_squared (float): Coeficiente de determinação (R²) do melhor modelo de regressão.
-    summary (str): Resumo estatístico do melhor modelo de regressão.
+    summary (SumarioOLS): Resumo estatístico do melhor modelo de regressão, construído apenas quando for usado.
 
     A função cria gráficos da expectativa da SELIC e do múltiplo desejado, realiza regressões lineares (linear e logarítmica),
     compara os R² das regressões e retorna os resultados da melhor regressão.
@@ -154,73 +421,41 @@ def Func_definir_melhor_regressao(df,x_label,y_label,prev_n_steps_meses, ticker)
     Exemplo de uso:
     lista_figuras, y_ultimo_prev, p_valor, r_squared, summary = Func_definir_melhor_regressao(df, 'Expectativa_SELIC', 'Multiplo', 12, 'PETR4')
     """
+    if resultado is None:
+        resultado = regressao_em_lote({ticker: df}, x_label, y_label, prev_n_steps_meses).iloc[0]
     
     ## Lista de figuras
     lista_figuras = []
-    
     ## Gráfico do múltiplo
-    try:
-        fig_multiplo_selic, ax = plt.subplots(figsize=(15,6))
-        ax.plot(df.index, df[x_label],label=x_label)
-        # Plotar no eixo secundário
-        ax2 = ax.twinx()
-        ax2.plot(df.index, df[y_label],color="red", label=y_label)
-        ax2.axhline(y=df[y_label].mean(), color='r', linestyle='--', label=f'Média do{y_label}')
-        # Adicione linhas tracejadas em múltiplos desvios padrão (por exemplo, 1 e 2 desvios padrão)
-        ax2.axhline(y=df["PVPA"].mean()+df["PVPA"].std(), color='g', linestyle='-.', label='1 Desvio Padrão')
-        ax2.axhline(y=df["PVPA"].mean()-df["PVPA"].std(), color='g', linestyle='-.')
-        
-        # Ativar a legenda
-        ax.legend(loc=2)
-        ax2.legend(loc=1)
-        # Adicione um título ao gráfico
-        ax.set_title(f"{ticker}, análise de {x_label} e {y_label}.")
-        # Especifique os valores de x (datas) que você deseja exibir no eixo x (por exemplo, a cada ano)
-        valores_xticks = pd.date_range(start=df.index.min(), end=df.index.max(), freq="A")
-        # Atribua rótulos formatados para os valores de x
-        rotulos_xticks = [data.strftime("%Y") for data in valores_xticks]
-         # Configure os valores e rótulos no eixo x
-        ax.set_xticks(valores_xticks)
-        ax.set_xticklabels(rotulos_xticks, rotation=45)  # A rotação é opcional para melhor legibilidade
-
-        plt.close(fig_multiplo_selic)
-        lista_figuras.append(fig_multiplo_selic)
-    except:
-        raise
+    fig_multiplo_selic = {"Grafico": "multiplo_selic", "Ticker": ticker, "x_label": x_label, "y_label": y_label,
+                          "Datas": df.index, "x": df[x_label].to_numpy(), "y": df[y_label].to_numpy(),
+                          "Media": df[y_label].mean(), "Desvio": df[y_label].std()}
+    if renderizar:
+        fig_multiplo_selic = renderizar_figura(fig_multiplo_selic)
+    lista_figuras.append(fig_multiplo_selic)
 
     ## (FIM) Gráfico do Múltiplo
 
-     ## Fazendo a regressão Linear
+    ## Gráficos das regressões linear e log
     fig_regressao, fig_residuos, r_squared_lin, y_ultimo_prev_lin, summary_lin = \
-        Regressao_linear(df,x_label,y_label,prev_n_steps_meses, ticker,tipo="linear")
+        Regressao_linear(df,x_label,y_label,prev_n_steps_meses, ticker,tipo="linear", resultado=resultado, renderizar=renderizar)
     lista_figuras.append(fig_regressao)
     lista_figuras.append(fig_residuos)
-    # P-valor do coeficiente Valor
-    p_valor_coeficiente_lin = summary_lin.tables[1].data[2][4]
-    ## Fazendo a regressão Log
     fig_regressao, fig_residuos, r_squared_log, y_ultimo_prev_log, summary_log = \
-        Regressao_linear(df,x_label,y_label,prev_n_steps_meses, ticker, tipo="log")
+        Regressao_linear(df,x_label,y_label,prev_n_steps_meses, ticker, tipo="log", resultado=resultado, renderizar=renderizar)
     lista_figuras.append(fig_regressao)
     lista_figuras.append(fig_residuos)
-    # P-valor do coeficiente Valor
-    p_valor_coeficiente_log = summary_log.tables[1].data[2][4]
 
 
-    ## Ver qual regressão teve o melhor R^2
-    if r_squared_lin>=r_squared_log:
-        y_ultimo_prev = y_ultimo_prev_lin
-        p_valor = p_valor_coeficiente_lin
-        r_squared = r_squared_lin
-        summary = summary_lin
-       
-    else:
-        y_ultimo_prev = y_ultimo_prev_log
-        p_valor = p_valor_coeficiente_log
-        r_squared = r_squared_log
-        summary = summary_log
+    ## Melhor regressão, pela regra do maior R^2
+    y_ultimo_prev = resultado["Y_prev"]
+    p_valor = resultado["P_valor"]
+    r_squared = resultado["R2"]
+    summary = summary_lin if resultado["Melhor"] == "linear" else summary_log
 
     return lista_figuras, y_ultimo_prev, p_valor, r_squared, summary
 
+
 def weighted_mean_and_std(series):
     """
     Calcula a média ponderada e o desvio padrão ponderado de uma série temporal com base no tempo.
@@ -259,7 +494,201 @@ def weighted_mean_and_std(series):
 
     return weighted_mean, weighted_std
 
-def Dados_iniciais(df_acao, df_multiplos, df_CAGR, Fundamento, multiplo):
+
+def _dias(datas):
+    ## Datas em número de dias (inteiro), como as diferenças .days de weighted_mean_and_std
+    return np.asarray(pd.DatetimeIndex(datas).values.astype("datetime64[D]").astype(np.int64))
+
+
+class MediaPonderadaExponencial:
+    """
+    Média e desvio padrão ponderados no tempo, como em weighted_mean_and_std, atualizados a cada nova data em tempo constante.
+
+    Parâmetros:
+    anos (int): Tamanho da janela: são consideradas as observações dos últimos 'anos' anos até a última data
+                (ver inicio_janela). Padrão é 8, como em Dados_iniciais.
+    fator (float): Redução do peso a cada 365 dias. Padrão é 0.9.
+
+    O acumulador guarda as somas ponderadas dos valores e dos seus quadrados em relação à última data. Uma nova data
+    multiplica as somas pela redução do peso no intervalo, soma o novo valor e retira as observações que saíram da janela.
+    Para não acumular erros de arredondamento, as somas são refeitas a partir das observações da janela depois de
+    tantas atualizações quantas forem as observações da janela. Se houver algum NaN na janela, a média e o desvio são NaN,
+    como em weighted_mean_and_std.
+
+    Exemplo de uso:
+    acumulador = MediaPonderadaExponencial()
+    acumulador.atualizar_serie(df_multiplos["PVPA"])
+    acumulador.atualizar(datetime(2023,11,30), 1.35)
+    Multiplo_medio, STD_multiplo = acumulador.media_desvio()
+    """
+    def __init__(self, anos=8, fator=0.9):
+        self.anos = anos
+        self.fator = fator
+        self.ultima_data = None
+        self._observacoes = deque()  # (dia, valor)
+        self._referencia = None  # valor subtraído de todas as observações, para reduzir o erro da variância
+        self._somas = [0.0, 0.0, 0.0]  # soma dos pesos, dos pesos*valor e dos pesos*valor^2
+        self._n_nan = 0
+        self._n_atualizacoes = 0
+
+    def _peso(self, dias):
+        return self.fator ** (dias / 365)
+
+    def _recalcular(self):
+        ## Somas refeitas a partir das observações da janela
+        dias = np.array([dia for dia, valor in self._observacoes])
+        valores = np.array([valor for dia, valor in self._observacoes]) - self._referencia
+        validos = ~np.isnan(valores)
+        pesos = self._peso(dias[-1] - dias[validos])
+        self._somas = [pesos.sum(), (pesos*valores[validos]).sum(), (pesos*valores[validos]**2).sum()]
+        self._n_atualizacoes = 0
+
+    def atualizar(self, data, valor):
+        ## Acrescenta a observação de uma nova data, posterior à última
+        data = pd.Timestamp(data)
+        self._atualizar(data, valor, inicio_janela(data, self.anos).value // 86_400_000_000_000)
+
+    def _atualizar(self, data, valor, dia_limite):
+        ## dia_limite: dia de inicio_janela(data); as observações até ele saem da janela
+        dia = data.value // 86_400_000_000_000
+        if self._observacoes and dia <= self._observacoes[-1][0]:
+            raise ValueError(f"Data {data.date()} não é posterior à última data {self.ultima_data.date()}")
+        valor = float(valor)
+        if self._referencia is None and valor == valor:
+            self._referencia = valor
+
+        soma_pesos, soma_x, soma_x2 = self._somas
+        if self._observacoes:
+            reducao = self._peso(dia - self._observacoes[-1][0])
+            soma_pesos, soma_x, soma_x2 = soma_pesos*reducao, soma_x*reducao, soma_x2*reducao
+        self._observacoes.append((dia, valor))
+        if valor != valor:  # NaN
+            self._n_nan += 1
+        else:
+            x = valor - self._referencia
+            soma_pesos, soma_x, soma_x2 = soma_pesos + 1, soma_x + x, soma_x2 + x*x
+
+        while self._observacoes[0][0] <= dia_limite:
+            dia_antigo, valor_antigo = self._observacoes.popleft()
+            if valor_antigo != valor_antigo:
+                self._n_nan -= 1
+            else:
+                x = valor_antigo - self._referencia
+                peso = self._peso(dia - dia_antigo)
+                soma_pesos, soma_x, soma_x2 = soma_pesos - peso, soma_x - peso*x, soma_x2 - peso*x*x
+        self._somas = [soma_pesos, soma_x, soma_x2]
+
+        self.ultima_data = data
+        self._n_atualizacoes += 1
+        if self._n_atualizacoes >= len(self._observacoes) and self._referencia is not None:
+            self._recalcular()
+
+    def atualizar_serie(self, series):
+        ## Acrescenta as observações de uma série, em ordem crescente de data
+        series = series.sort_index()
+        if self.ultima_data is not None:
+            series = series.loc[series.index > self.ultima_data]
+        dias_limite = _dias(inicio_janela(series.index, self.anos))
+        for data, valor, dia_limite in zip(series.index, series.values, dias_limite):
+            self._atualizar(data, valor, dia_limite)
+
+    def media_desvio(self):
+        ## Média e desvio padrão ponderados das observações da janela
+        if not self._observacoes or self._n_nan > 0:
+            return np.nan, np.nan
+        soma_pesos, soma_x, soma_x2 = self._somas
+        media = soma_x/soma_pesos
+        variancia = max(soma_x2/soma_pesos - media**2, 0)
+        return self._referencia + media, np.sqrt(variancia)
+
+
+## Múltiplos das estratégias (ver ESTRATEGIAS), acompanhados pelos acumuladores
+MULTIPLOS_ACUMULADOS = ("PVPA", "PE", "EV_EBITDA")
+
+
+def acumuladores_multiplos(dict_df_acoes, lista_multiplos=MULTIPLOS_ACUMULADOS, acumuladores=None, anos=8, fator=0.9):
+    """
+    Cria ou atualiza os acumuladores da média ponderada dos múltiplos de cada ativo.
+
+    Parâmetros:
+    dict_df_acoes (dict): Dicionário com chaves sendo os ativos e valores contendo (df_acao, df_multiplos, df_CAGR).
+    lista_multiplos (tuple): Múltiplos acompanhados. Padrão é MULTIPLOS_ACUMULADOS ('PVPA', 'PE' e 'EV_EBITDA').
+    acumuladores (dict): Acumuladores já existentes, que recebem apenas as datas novas. Padrão é None (cria todos).
+    anos (int): Tamanho da janela de cada acumulador, em anos. Padrão é 8.
+    fator (float): Redução do peso a cada 365 dias. Padrão é 0.9.
+
+    Retorna:
+    acumuladores (dict): Dicionário com chaves (ativo, múltiplo) e valores MediaPonderadaExponencial.
+
+    Exemplo de uso:
+    acumuladores = acumuladores_multiplos(dict_df_acoes)
+    info_main, info_verificao = main_ret(dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal, acumuladores=acumuladores)
+    """
+    if acumuladores is None:
+        acumuladores = {}
+    for ativo, (df_acao, df_multiplos, df_CAGR) in dict_df_acoes.items():
+        for multiplo in lista_multiplos:
+            if multiplo not in df_multiplos.columns:
+                continue
+            if (ativo, multiplo) not in acumuladores:
+                acumuladores[(ativo, multiplo)] = MediaPonderadaExponencial(anos, fator)
+            acumuladores[(ativo, multiplo)].atualizar_serie(df_multiplos[multiplo])
+    return acumuladores
+
+
+def media_desvio_ponderados_em_lote(dict_series, datas, anos=8, fator=0.9):
+    """
+    Calcula, para várias datas e vários ativos de uma vez, a média e o desvio padrão ponderados de weighted_mean_and_std
+    sobre as observações de cada série nos últimos 'anos' anos até cada data (ver inicio_janela).
+
+    Parâmetros:
+    dict_series (dict): Dicionário com chaves sendo os ativos e valores sendo as séries do múltiplo (índice de datas).
+    datas (list): Datas de avaliação.
+    anos (int): Tamanho da janela, em anos. Padrão é 8.
+    fator (float): Redução do peso a cada 365 dias. Padrão é 0.9.
+
+    Retorna:
+    df_media (pd.DataFrame): Média ponderada de cada ativo (colunas) em cada data (índice).
+    df_desvio (pd.DataFrame): Desvio padrão ponderado de cada ativo (colunas) em cada data (índice).
+
+    Como os pesos são exponenciais no tempo, o peso de cada observação em relação a qualquer data é o produto de um termo
+    da observação por um termo da data, que se cancela na média. Assim as somas de cada janela saem de somas acumuladas
+    da série inteira, sem recalcular os pesos em cada data.
+
+    Exemplo de uso:
+    df_media, df_desvio = media_desvio_ponderados_em_lote({'PETR4': df_multiplos['PE']}, calendario_rebalanceamento(inicio, fim))
+    """
+    datas = pd.DatetimeIndex(datas)
+    dias_avaliacao = _dias(datas)
+    dias_limite = _dias(inicio_janela(datas, anos))
+    df_media = pd.DataFrame(np.nan, index=datas, columns=list(dict_series))
+    df_desvio = df_media.copy()
+    for ativo, series in dict_series.items():
+        series = series.sort_index()
+        if len(series) == 0:
+            continue
+        dias = _dias(series.index)
+        valores = series.to_numpy(dtype=float)
+        nan = np.isnan(valores)
+        referencia = valores[~nan][0] if (~nan).any() else 0.0
+        x = np.where(nan, 0, valores - referencia)
+        ## Peso de cada observação em relação à primeira data, zerado nos NaN
+        pesos = np.where(nan, 0, fator ** (-(dias - dias[0]) / 365))
+        S0, S1, S2, N_nan = [np.concatenate([[0], np.cumsum(valores)]) for valores in [pesos, pesos*x, pesos*x*x, nan]]
+
+        fim = np.searchsorted(dias, dias_avaliacao, side="right")
+        inicio = np.searchsorted(dias, dias_limite, side="right")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            soma_pesos = S0[fim] - S0[inicio]
+            media = (S1[fim] - S1[inicio])/soma_pesos
+            variancia = np.maximum((S2[fim] - S2[inicio])/soma_pesos - media**2, 0)
+        invalido = (fim == 0) | (N_nan[fim] - N_nan[inicio] > 0)
+        df_media[ativo] = np.where(invalido, np.nan, referencia + media)
+        df_desvio[ativo] = np.where(invalido, np.nan, np.sqrt(variancia))
+
+    return df_media, df_desvio
+
+def Dados_iniciais(df_acao, df_multiplos, df_CAGR, Fundamento, multiplo, acumulador=None):
     """
     Coleta dados iniciais necessários para o cálculo de outras funções.
 
@@ -269,6 +698,8 @@ def Dados_iniciais(df_acao, df_multiplos, df_CAGR, Fundamento, multiplo):
     df_CAGR (pd.DataFrame): DataFrame contendo a taxa de crescimento de dados fundamentalistas.
     Fundamento (str): Fundamento de crescimento a ser analisado (por exemplo, 'RL' para receita líquida).
     multiplo (str): Múltiplo a ser avaliado (por exemplo, 'PE' para price earnings, 'EV_EBITDA' para EV/EBITDA).
+    acumulador (MediaPonderadaExponencial): Acumulador do múltiplo do ativo. Se estiver na data da simulação, fornece o
+                                            múltiplo médio e o desvio sem recalcular os pesos. Padrão é None.
 
     Retorna:
     dados_iniciais (list): Lista de dados iniciais coletados para uso em outras funções.
@@ -298,9 +729,19 @@ def Dados_iniciais(df_acao, df_multiplos, df_CAGR, Fundamento, multiplo):
 
     # Multiplo médio
     
-    datas_recentes = df_multiplos.index.sort_values(ascending=False)[:8*252] # 8 anos
-    serie = df_multiplos.loc[datas_recentes,multiplo]
-    Multiplo_medio, STD_multiplo = weighted_mean_and_std(serie)
+    if acumulador is not None and acumulador.ultima_data == data_simulacao:
+        Multiplo_medio, STD_multiplo = acumulador.media_desvio()
+    else:
+        # Últimos 8 anos de datas (ver inicio_janela), sem ordenar o índice quando ele já está em ordem
+        limite = np.datetime64(inicio_janela(data_simulacao, anos=8), "ns")
+        datas = df_multiplos.index.values
+        if df_multiplos.index.is_monotonic_decreasing:
+            serie = df_multiplos[multiplo].iloc[:len(datas) - np.searchsorted(datas[::-1], limite, side="right")]
+        elif df_multiplos.index.is_monotonic_increasing:
+            serie = df_multiplos[multiplo].iloc[np.searchsorted(datas, limite, side="right"):][::-1]
+        else:
+            serie = df_multiplos.loc[df_multiplos.index > limite, multiplo].sort_index(ascending=False)
+        Multiplo_medio, STD_multiplo = weighted_mean_and_std(serie)
 
     
     # Quanto que desviou do múltiplo médio
@@ -321,35 +762,97 @@ def Dados_iniciais(df_acao, df_multiplos, df_CAGR, Fundamento, multiplo):
 
     return [data_simulacao, Setor, ROE, DY_medio, ticker, CAGR_Medio, Multiplo_atual, Multiplo_medio, Desvio_multiplo, Expansao_Multiplo]
 
-## Estratégia baseada em VPA
-def ret_VPA(df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal, prev_n_steps_meses):
+## Estratégias por setor
+
+## Penalizações: cada uma é uma rampa linear por partes sobre uma variável do ativo, dada por (pontos x, multiplicadores)
+## e constante fora dos pontos. O retorno esperado é multiplicado pelas rampas, na ordem da tabela
+PENALIZACOES_VPA = {
+    ## Razão entre a previsão e a expectativa atual da SELIC: em alta de juros (razão acima de 1.03) não investir no setor
+    "Razao_Selic": ([1, 1.03], [1, 0]),
+    ## Dívida bruta/PL: sem penalização até 0.5, zera a partir de 1
+    "Multiplo_Divida": ([0.5, 1], [1, 0]),
+    ## R² da regressão do PVPA contra a SELIC: zera até 0.1, sem penalização a partir de 0.5
+    "R2": ([0.1, 0.5], [0, 1]),
+}
+
+PENALIZACOES_PE = {
+    ## ROE: zera até 0.05, sem penalização a partir de 0.15
+    "ROE": ([0.05, 0.15], [0, 1]),
+    ## Crescimento do lucro contabilizando o DY, (CAGR_Medio+1)*(DY_medio+1): zera até 1, sem penalização a partir de 1.15
+    "Crescimento_DY": ([1, 1.15], [0, 1]),
+}
+
+
+def penalizacoes_EBITDA(limite_ROE_inf, limite_ROE_sup, limite_divida):
     """
-    Calcula o retorno esperado de ativos com base na relação entre o VPA (Valor Patrimonial por Ação) de uma ação e a expectativa da taxa SELIC.
+    Monta as penalizações da estratégia por EBITDA.
 
     Parâmetros:
-    df_acao (pd.DataFrame): DataFrame contendo dados fundamentalistas da ação normalizados pelo número de ações ex-tesouraria.
-    df_multiplos (pd.DataFrame): DataFrame contendo os múltiplos da empresa (dados diários).
-    df_CAGR (pd.DataFrame): DataFrame contendo a taxa de crescimento de dados fundamentalistas.
-    df_Expectativa_Selic_mensal (pd.DataFrame): DataFrame contendo as expectativas mensais da taxa SELIC.
-    prev_n_steps_meses (float): Valor previsto para a próxima expectativa da taxa SELIC.
+    limite_ROE_inf (float): Limite inferior de ROE para penalização.
+    limite_ROE_sup (float): Limite superior de ROE onde não há mais penalização.
+    limite_divida (float): Valor a partir do qual começa a penalização de dívida líquida/EBITDA.
 
     Retorna:
-    lista_return (list): Lista de informações, incluindo setor, retorno anual esperado, ROE, dívida bruta/PL, DY médio, CAGR médio, expansão do múltiplo, múltiplo atual, múltiplo médio e desvio do múltiplo.
-    lista_figuras (list): Lista de figuras geradas durante a análise.
+    penalizacoes (dict): ROE (zera até limite_ROE_inf, sem penalização a partir de limite_ROE_sup) e dívida líquida/EBITDA
+                         (sem penalização até limite_divida, zera a partir de 2*limite_divida).
+
+    Exemplo de uso:
+    penalizacoes = penalizacoes_EBITDA(0.02, 0.1, 3)
+    """
+    return {"ROE": ([limite_ROE_inf, limite_ROE_sup], [0, 1]),
+            "Multiplo_Divida": ([limite_divida, 2*limite_divida], [1, 0])}
+
+
+## Estratégia e penalizações de cada setor. Setores fora da tabela não entram na carteira.
+## Para acrescentar um setor ou mudar um limite basta alterar a tabela, ou passar outra tabela ao main_ret
+ESTRATEGIAS_SETORES = {
+    "Construção e Imóveis": {"Estrategia": "VPA", "Penalizacoes": PENALIZACOES_VPA},
+    "Bancos e Serviços Financeiros": {"Estrategia": "PE", "Penalizacoes": PENALIZACOES_PE},
+    "Energia e Serviços Básicos": {"Estrategia": "EBITDA", "Penalizacoes": penalizacoes_EBITDA(0.02, 0.1, 3)},
+    "Biocombustíveis, Gás e Petróleo": {"Estrategia": "EBITDA", "Penalizacoes": penalizacoes_EBITDA(0.15, 0.3, 1.5)},
+    "Mineração": {"Estrategia": "EBITDA", "Penalizacoes": penalizacoes_EBITDA(0.15, 0.3, 1.5)},
+    "Serviços": {"Estrategia": "EBITDA", "Penalizacoes": penalizacoes_EBITDA(0.01, 0.05, 2.5)},
+    "Celulose, Papel e Madeira": {"Estrategia": "EBITDA", "Penalizacoes": penalizacoes_EBITDA(0.01, 0.05, 2.5)},
+    "Indústria": {"Estrategia": "EBITDA", "Penalizacoes": penalizacoes_EBITDA(0.01, 0.05, 2.5)},
+}
+
+## Colunas do DataFrame de retorno
+COLUNAS_RETORNO = ["Setor","Retorno_anual_esperado", "ROE", "Multiplo_Divida",
+                   "DY_medio", "CAGR_Medio", "Expansao_Multiplo", "Multiplo_atual","Multiplo_medio","Desvio_multiplo"]
 
-    A função calcula o retorno esperado dos ativos com base na relação entre o VPA de uma ação e a expectativa da taxa SELIC, considerando penalizações para setores de alta de juros, empresas com muita dívida e r_squared alto.
+
+def rampa(valores, pontos_x, multiplicadores):
+    """
+    Rampa linear por partes, aplicada a um array de valores de uma vez.
+
+    Parâmetros:
+    valores (array): Valores da variável.
+    pontos_x (list): Pontos x da rampa, em ordem crescente.
+    multiplicadores (list): Multiplicador em cada ponto. Abaixo do primeiro e acima do último ponto o multiplicador é constante.
+
+    Retorna:
+    betas (np.ndarray): Multiplicador de cada valor (NaN para valores NaN).
 
     Exemplo de uso:
-    dados_return, figuras = ret_VPA(df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal, prev_n_steps_meses)
+    beta_ROE = rampa(df_dados["ROE"], [0.05, 0.15], [0, 1])
     """
-    ## Coletando dados iniciais
-    [data_simulacao, Setor, ROE, DY_medio, ticker, CAGR_Medio, Multiplo_atual, 
-     Multiplo_medio, Desvio_multiplo, Expansao_Multiplo] = \
-        Dados_iniciais(df_acao, df_multiplos, df_CAGR, "LL", "PVPA")
+    return np.interp(np.asarray(valores, dtype=float), pontos_x, multiplicadores)
 
-    
 
-    ## Compilando os dados para fazer a regressão
+def dados_regressao_VPA(df_multiplos, df_Expectativa_Selic_mensal):
+    """
+    Compila os dados da regressão do PVPA contra a expectativa da SELIC usada na estratégia VPA.
+
+    Parâmetros:
+    df_multiplos (pd.DataFrame): DataFrame contendo os múltiplos da empresa (dados diários).
+    df_Expectativa_Selic_mensal (pd.DataFrame): DataFrame contendo as expectativas mensais da taxa SELIC.
+
+    Retorna:
+    df_regressao (pd.DataFrame): PVPA médio mensal e expectativa da SELIC ('Valor') dos últimos 8 anos.
+
+    Exemplo de uso:
+    df_regressao = dados_regressao_VPA(df_multiplos, df_Expectativa_Selic_mensal)
+    """
     df_regressao = df_multiplos[["PVPA"]].copy()
     ## Resample mensal
     df_regressao = df_regressao.resample("M").mean()
@@ -359,114 +862,167 @@ def ret_VPA(df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal, prev_n_
     ## Filtrar os últimos 8 anos
     n = 12*8
     df_regressao = df_regressao.iloc[-n:,:] # últimos 8 anos
-    # Obtendo os dados da Regressão
-    lista_figuras, Expansao_multiplo, p_valor, r_squared, summary = \
-        Func_definir_melhor_regressao(df_regressao,"Valor","PVPA",prev_n_steps_meses, ticker)
-   
 
+    return df_regressao
 
-    ## Lucro Futuro = Lucro Passado
-    ultm_data_balanco = df_acao.index.max()
-    LL_ANO = df_acao.loc[ultm_data_balanco, "LL"]
 
-    # Use esses índices para localizar os valores da coluna "PL"
-    PL_dia = df_acao.loc[ultm_data_balanco,"PL"]
+def _coletar_VPA(dados, data_simulacao, df_acao, df_multiplos, df_Expectativa_Selic_mensal, prev_n_steps_meses,
+                 regressao, renderizar):
+    ## Regressão do PVPA contra a expectativa da SELIC
+    df_regressao = dados_regressao_VPA(df_multiplos, df_Expectativa_Selic_mensal)
+    lista_figuras, Expansao_multiplo, p_valor, r_squared, summary = \
+        Func_definir_melhor_regressao(df_regressao,"Valor","PVPA",prev_n_steps_meses, dados["Ticker"],
+                                      resultado=regressao, renderizar=renderizar)
+    dados["Expansao_Multiplo"] = Expansao_multiplo
+    dados["R2"] = r_squared
 
+    ## Lucro Futuro = Lucro Passado e PL Futuro = PL Atual + Lucro Futuro
+    ultm_data_balanco = df_acao.index.max()
+    dados["PL_Futuro"] = df_acao.loc[ultm_data_balanco,"PL"] + df_acao.loc[ultm_data_balanco, "LL"]
     ## Última cotação
-    Preco_atual = df_multiplos.loc[data_simulacao,"Fechamento_Equivalente"]
+    dados["Preco_atual"] = df_multiplos.loc[data_simulacao,"Fechamento_Equivalente"]
+
+    # Razao entre a expectativa da selic e o valor previsto pelo arima
+    dados["Razao_Selic"] = prev_n_steps_meses/df_Expectativa_Selic_mensal.loc[df_Expectativa_Selic_mensal.index.max(),"Valor"]
+    ## Mensurando a dívida
+    dados["Multiplo_Divida"] = df_multiplos.loc[data_simulacao,"DIV_Bruta_PL"]
 
-    ## PL Futuro = PL Atual + Lucro Futuro
-    PL_Futuro = PL_dia + LL_ANO
+    return lista_figuras
 
-    ## Previsão de preço
-    Preco_previsao = PL_Futuro*Expansao_multiplo**2  # Expansão do múltiplo ao quadrado, portanto, demora 6 meses para se concretizar 
 
+def _coletar_divida_liquida(dados, data_simulacao, df_acao, df_multiplos, df_Expectativa_Selic_mensal, prev_n_steps_meses,
+                            regressao, renderizar):
+    ## Dívida Líquida / EBITDA
+    dados["Multiplo_Divida"] = df_multiplos.loc[data_simulacao,"DIV_liq_EBITDA"]
+    return []
+
+
+def _retorno_VPA(df_dados):
+    ## Previsão de preço: expansão do múltiplo ao quadrado, portanto, demora 6 meses para se concretizar
+    Preco_previsao = df_dados["PL_Futuro"].to_numpy(dtype=float)*df_dados["Expansao_Multiplo"].to_numpy(dtype=float)**2
     # Retorno é o preço previsto dividido pelo preço atual
-    Retorno = Preco_previsao/Preco_atual
-    # Retorno esperado anual
-    Retorno_anual_esperado = (Retorno - 1 )
-
-    ## Agora é necessário realizar algumas penalizações, são elas:
-    ## penalizacao_hike -> Evitar investimentos neste setor e alta de juros
-    ## penalizacao_divida -> Evitar investimentos em empresas com muita dívida
-    ## penalizacao_r_squared -> Evitar investimentos em empresas com r_squared muito alto
-    
-    ## Multiplicador para evitar investir em empresas do setor imobiliário com aumento da SELIC
-    ## Desta forma, quando a razão entre Previsto e Atual for maior que 1.03, o beta será 0;
-    ## Portanto em momento de hikes deve-se evitar investir em empresas do setor imobiliário
-    def penalizacao_hike(razao):
-        if razao<=1:
-            beta = 1
-        elif razao>=1.03:
-            beta = 0
-        else:
-            beta = 1-((razao-1)/(1.03-1))
-        return beta
-    ## Fim da função beta
-
-    ## Multiplicador para evitar investir em empresas com muita dívida
-    ## Se for menor que 0.5, o beta é 1
-    ## Se for maior que 1, o beta é 0
-    ## Se for entre 0.5 e 1, o beta é 1-((razao-0.5)/(1-0.5))
-    def penalizacao_divida(Div_Bruta_por_PL):
-        if Div_Bruta_por_PL<=0.5:
-            beta = 1
-        elif Div_Bruta_por_PL>=1:
-            beta = 0
-        else:
-            beta = 1-((Div_Bruta_por_PL-0.5)/(1-0.5))
-        return beta
-    
-    ## Multiplicador para evitar investir em empresas com r_squared muito alto
-    ## Se for maior que 0.5, o beta é 1
-    ## Se for menor que 0.1, o beta é 0
-    ## Se for entre 0.1 e 0.5, o beta é 1-((razao-0.1)/(0.5-0.1))
-    def penalizacao_r_squared(r_squared):
-        if r_squared>=0.5:
-            beta = 1
-        elif r_squared<=0.1:
-            beta = 0
-        else:
+    return Preco_previsao/df_dados["Preco_atual"].to_numpy(dtype=float) - 1
 
-            beta = (r_squared-0.1)/(0.5-0.1)
-        return beta
-    
 
-    ## Função beta    
-    # Razao entre a expectativa da selic e o valor previsto pelo arima
-    razao = prev_n_steps_meses/df_Expectativa_Selic_mensal.loc[df_Expectativa_Selic_mensal.index.max(),"Valor"]
+def _retorno_PE(df_dados):
+    ## Earning Yield, zero para múltiplos menores que 0.1
+    Multiplo_atual = df_dados["Multiplo_atual"].to_numpy(dtype=float)
+    with np.errstate(divide="ignore"):
+        return np.where(Multiplo_atual>0.1, 1/Multiplo_atual, 0)
 
-    ## Mensurando a dívida
-    Div_Bruta_por_PL = df_multiplos.loc[data_simulacao,"DIV_Bruta_PL"]
 
-    # Retorno esperado anual
-    Retorno_anual_esperado = Retorno_anual_esperado*\
-        penalizacao_hike(razao)*penalizacao_divida(Div_Bruta_por_PL)*penalizacao_r_squared(r_squared)
-    
-    if Retorno_anual_esperado<0:
-        Retorno_anual_esperado = 0
-    
-    Retorno_anual_esperado_percentual = round((Retorno_anual_esperado)*100,2)
+def _retorno_EBITDA(df_dados):
+    ## Regressão do EV/EBITDA à média histórica, crescimento do EBITDA e DY médio
+    return (df_dados["Expansao_Multiplo"].to_numpy(dtype=float)*(1+df_dados["CAGR_Medio"].to_numpy(dtype=float))
+            *(1+df_dados["DY_medio"].to_numpy(dtype=float)) - 1)
 
 
+## Estratégias: fundamento do CAGR e múltiplo usados em Dados_iniciais, coleta dos dados próprios de um ativo
+## e retorno esperado do corte transversal, antes das penalizações
+ESTRATEGIAS = {
+    "VPA": {"Fundamento": "LL", "Multiplo": "PVPA", "Coletar": _coletar_VPA, "Retorno": _retorno_VPA},
+    "PE": {"Fundamento": "LL", "Multiplo": "PE", "Coletar": _coletar_divida_liquida, "Retorno": _retorno_PE},
+    "EBITDA": {"Fundamento": "EBITDA", "Multiplo": "EV_EBITDA", "Coletar": _coletar_divida_liquida, "Retorno": _retorno_EBITDA},
+}
 
-    ## Coletando os dados para a lista de retorno
 
-    ## Lista com os returns
+@instrumentar(entrada="df_multiplos")
+def dados_ativo(estrategia, df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal, prev_n_steps_meses,
+                regressao=None, renderizar=True, acumulador=None):
+    """
+    Coleta os dados de um ativo usados pela estratégia para calcular o retorno esperado.
 
-    lista_return = [Setor , Retorno_anual_esperado, ROE, Div_Bruta_por_PL,
-                    DY_medio, CAGR_Medio, Expansao_multiplo, Multiplo_atual, Multiplo_medio, Desvio_multiplo]
+    Parâmetros:
+    estrategia (str): Nome da estratégia em ESTRATEGIAS ('VPA', 'PE' ou 'EBITDA').
+    df_acao (pd.DataFrame): DataFrame contendo dados fundamentalistas da ação normalizados pelo número de ações ex-tesouraria.
+    df_multiplos (pd.DataFrame): DataFrame contendo os múltiplos da empresa (dados diários).
+    df_CAGR (pd.DataFrame): DataFrame contendo a taxa de crescimento de dados fundamentalistas.
+    df_Expectativa_Selic_mensal (pd.DataFrame): DataFrame contendo as expectativas mensais da taxa SELIC.
+    prev_n_steps_meses (float): Valor previsto para a próxima expectativa da taxa SELIC.
+    regressao (pd.Series): Linha do ativo em regressao_em_lote (estratégia VPA). Padrão é None (faz as regressões).
+    renderizar (bool): Se False, devolve as especificações dos gráficos em vez das figuras (ver Regressao_linear). Padrão é True.
+    acumulador (MediaPonderadaExponencial): Acumulador do múltiplo do ativo (ver Dados_iniciais). Padrão é None.
 
+    Retorna:
+    dados (dict): Setor, ticker, ROE, DY médio, CAGR médio, múltiplo atual, médio e desvio, expansão do múltiplo,
+                  múltiplo de dívida, crescimento com DY e os dados próprios da estratégia.
+    lista_figuras (list): Lista de figuras geradas durante a análise.
 
+    Exemplo de uso:
+    dados, figuras = dados_ativo('PE', df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal, prev_n_steps_meses)
+    """
+    info = ESTRATEGIAS[estrategia]
 
-    return lista_return, lista_figuras
+    ## Coletando dados iniciais
+    [data_simulacao, Setor, ROE, DY_medio, ticker, CAGR_Medio, Multiplo_atual,
+     Multiplo_medio, Desvio_multiplo, Expansao_Multiplo] = \
+        Dados_iniciais(df_acao, df_multiplos, df_CAGR, info["Fundamento"], info["Multiplo"], acumulador)
+    dados = {"Setor": Setor, "Ticker": ticker, "ROE": ROE, "DY_medio": DY_medio, "CAGR_Medio": CAGR_Medio,
+             "Expansao_Multiplo": Expansao_Multiplo, "Multiplo_atual": Multiplo_atual, "Multiplo_medio": Multiplo_medio,
+             "Desvio_multiplo": Desvio_multiplo, "Crescimento_DY": (CAGR_Medio+1)*(DY_medio+1)}
 
+    ## Dados próprios da estratégia
+    lista_figuras = info["Coletar"](dados, data_simulacao, df_acao, df_multiplos, df_Expectativa_Selic_mensal,
+                                    prev_n_steps_meses, regressao, renderizar)
+
+    return dados, lista_figuras
 
-## Estratégia Baseada em Earnins Yield
 
-def ret_PE(df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal, prev_n_steps_meses):
+@instrumentar()
+def retorno_esperado_setores(dict_dados, estrategias_setores=ESTRATEGIAS_SETORES):
     """
-    Calcula a rentabilidade esperada de ativos com base no Earning Yields (Lucro/Preço), considerando penalizações para baixo ROE, crescimento e pagamento de dividendos.
+    Calcula o retorno esperado de todos os ativos de uma vez, com a estratégia e as penalizações do setor de cada um.
+
+    Parâmetros:
+    dict_dados (dict): Dicionário com chaves sendo os ativos e valores sendo os dados de dados_ativo.
+    estrategias_setores (dict): Estratégia e penalizações de cada setor. Padrão é ESTRATEGIAS_SETORES.
+
+    Retorna:
+    df_retorno (pd.DataFrame): DataFrame de retorno com as colunas COLUNAS_RETORNO, na ordem de dict_dados.
+
+    Para cada setor, o retorno antes das penalizações e cada rampa de penalização são calculados sobre o array de todos
+    os ativos do setor. Retornos negativos são zerados.
+
+    Exemplo de uso:
+    df_retorno = retorno_esperado_setores({'PETR4': dados})
+    """
+    if len(dict_dados) == 0:
+        return pd.DataFrame(columns=COLUNAS_RETORNO, index=pd.Index([], dtype=object))
+
+    df_dados = pd.DataFrame.from_dict(dict_dados, orient="index")
+    Retorno_anual_esperado = np.full(len(df_dados), np.nan)
+    for Setor, config in estrategias_setores.items():
+        condicao = (df_dados["Setor"] == Setor).to_numpy()
+        if not condicao.any():
+            continue
+        df_setor = df_dados.loc[condicao]
+        Retorno = ESTRATEGIAS[config["Estrategia"]]["Retorno"](df_setor)
+        for variavel, (pontos_x, multiplicadores) in config["Penalizacoes"].items():
+            Retorno = Retorno*rampa(df_setor[variavel], pontos_x, multiplicadores)
+        Retorno_anual_esperado[condicao] = np.where(Retorno<0, 0, Retorno)
+
+    df_retorno = df_dados.reindex(columns=COLUNAS_RETORNO)
+    df_retorno["Retorno_anual_esperado"] = Retorno_anual_esperado
+    ## Mesmo tipo (object) do DataFrame montado linha a linha
+    return df_retorno.astype(object)
+
+
+def _ret_ativo(estrategia, penalizacoes, df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal=None,
+               prev_n_steps_meses=None, regressao=None, renderizar=True, acumulador=None):
+    ## Retorno esperado de um único ativo, pela mesma rotina do corte transversal
+    dados, lista_figuras = dados_ativo(estrategia, df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal,
+                                       prev_n_steps_meses, regressao, renderizar, acumulador)
+    df_retorno = retorno_esperado_setores({dados["Ticker"]: dados},
+                                          {dados["Setor"]: {"Estrategia": estrategia, "Penalizacoes": penalizacoes}})
+    lista_return = df_retorno.iloc[0].tolist()
+
+    return lista_return, lista_figuras
+
+
+def ret_VPA(df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal, prev_n_steps_meses, regressao=None, renderizar=True,
+            acumulador=None):
+    """
+    Calcula o retorno esperado de ativos com base na relação entre o VPA (Valor Patrimonial por Ação) de uma ação e a expectativa da taxa SELIC.
 
     Parâmetros:
     df_acao (pd.DataFrame): DataFrame contendo dados fundamentalistas da ação normalizados pelo número de ações ex-tesouraria.
@@ -474,87 +1030,53 @@ def ret_PE(df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal, prev_n_s
     df_CAGR (pd.DataFrame): DataFrame contendo a taxa de crescimento de dados fundamentalistas.
     df_Expectativa_Selic_mensal (pd.DataFrame): DataFrame contendo as expectativas mensais da taxa SELIC.
     prev_n_steps_meses (float): Valor previsto para a próxima expectativa da taxa SELIC.
+    regressao (pd.Series): Linha do ativo em regressao_em_lote, se as regressões já foram feitas. Padrão é None (faz as regressões).
+    renderizar (bool): Se False, devolve as especificações dos gráficos em vez das figuras (ver Regressao_linear). Padrão é True.
+    acumulador (MediaPonderadaExponencial): Acumulador do múltiplo do ativo (ver Dados_iniciais). Padrão é None.
 
     Retorna:
-    lista_return (list): Lista de informações, incluindo setor, retorno anual esperado, ROE, dívida líquida/EBITDA, DY médio, CAGR médio, expansão do múltiplo, múltiplo atual, múltiplo médio e desvio do múltiplo.
+    lista_return (list): Lista de informações, incluindo setor, retorno anual esperado, ROE, dívida bruta/PL, DY médio, CAGR médio, expansão do múltiplo, múltiplo atual, múltiplo médio e desvio do múltiplo.
     lista_figuras (list): Lista de figuras geradas durante a análise.
 
-    A função calcula o retorno esperado dos ativos com base no Earning Yields (Lucro/Preço), considerando penalizações para baixo ROE, crescimento e pagamento de dividendos.
+    A função calcula o retorno esperado dos ativos com base na relação entre o VPA de uma ação e a expectativa da taxa SELIC, considerando penalizações para setores de alta de juros, empresas com muita dívida e r_squared alto.
 
     Exemplo de uso:
-    dados_return, figuras = ret_PE(df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal, prev_n_steps_meses)
+    dados_return, figuras = ret_VPA(df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal, prev_n_steps_meses)
     """
-    ## Coletando dados iniciais
-    [data_simulacao, Setor, ROE, DY_medio, ticker, CAGR_Medio, 
-     Multiplo_atual, Multiplo_medio, Desvio_multiplo, Expansao_Multiplo] = \
-        Dados_iniciais(df_acao, df_multiplos, df_CAGR, "LL", "PE")
-    lista_figuras = []
-
-    # Retorno esperado anual
-    if Multiplo_atual>0.1:
-        Retorno_anual_esperado = 1/Multiplo_atual
-    else:
-        Retorno_anual_esperado = 0
-
-
+    return _ret_ativo("VPA", PENALIZACOES_VPA, df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal,
+                      prev_n_steps_meses, regressao, renderizar, acumulador)
 
-    ## Agora é necessário realizar algumas penalizações, são elas:
-    ## ROE -> Retorno sobre o patrimônio líquido
-    ## Crescimento de lucro -> CAGR
-    ## Dividend Yield -> DY
 
 
+## Estratégia Baseada em Earnins Yield
+def ret_PE(df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal, prev_n_steps_meses, acumulador=None):
+    """
+    Calcula a rentabilidade esperada de ativos com base no Earning Yields (Lucro/Preço), considerando penalizações para baixo ROE, crescimento e pagamento de dividendos.
 
-    ## Multiplicador para penalizar o ROE, se for menor que 0.05, o beta é 0
-    ## Se for maior que 0.15, o beta é 1
-    ## Se for entre 0.05 e 0.15, o beta é ((razao-0.05)/(0.15-0.05))
-    def penalizacao_ROE(razao):
-        if razao<=0.05:
-            beta = 0
-        elif razao>=0.15:
-            beta = 1
-        else:
-            beta = ((razao-0.05)/(0.15-0.05))
-        return beta
- 
-    ## Fim da função penalizacao_ROE
-
-    ## A Penalização do CAGR Lucro será feita contabilizando o DY
-    ## Multiplicador para penalizar o Crescimento,
-    ## Se o (CAGR_Medio+1)*(DY_medio+1) for menor que 1, o beta é 0
-    ## Se o (CAGR_Medio+1)*(DY_medio+1) for maior que 1.15, o beta é 1
-
-    def penalizacao_Crescimento(CAGR_Medio,DY_medio):
-        if (CAGR_Medio+1)*(DY_medio+1)<=1:
-            beta = 0
-        elif (CAGR_Medio+1)*(DY_medio+1)>=1.15:
-            beta = 1
-        else:
-            beta = ((CAGR_Medio+1)*(DY_medio+1)-1)/(1.15-1)
-        return beta
-    
-    ## Fim da função penalizacao_Crescimento
-   
-    ## Calculando as penalizações
-    beta_ROE = penalizacao_ROE(ROE)
-    beta_Crescimento = penalizacao_Crescimento(CAGR_Medio,DY_medio)
+    Parâmetros:
+    df_acao (pd.DataFrame): DataFrame contendo dados fundamentalistas da ação normalizados pelo número de ações ex-tesouraria.
+    df_multiplos (pd.DataFrame): DataFrame contendo os múltiplos da empresa (dados diários).
+    df_CAGR (pd.DataFrame): DataFrame contendo a taxa de crescimento de dados fundamentalistas.
+    df_Expectativa_Selic_mensal (pd.DataFrame): DataFrame contendo as expectativas mensais da taxa SELIC.
+    prev_n_steps_meses (float): Valor previsto para a próxima expectativa da taxa SELIC.
+    acumulador (MediaPonderadaExponencial): Acumulador do múltiplo do ativo (ver Dados_iniciais). Padrão é None.
 
-    ## Retorno esperado anual
-    Retorno_anual_esperado = Retorno_anual_esperado*beta_ROE*beta_Crescimento
+    Retorna:
+    lista_return (list): Lista de informações, incluindo setor, retorno anual esperado, ROE, dívida líquida/EBITDA, DY médio, CAGR médio, expansão do múltiplo, múltiplo atual, múltiplo médio e desvio do múltiplo.
+    lista_figuras (list): Lista de figuras geradas durante a análise.
 
-    ## Dívida Líquida / EBITDA
-    Div_Liq_EBITDA = df_multiplos.loc[data_simulacao,"DIV_liq_EBITDA"]
+    A função calcula o retorno esperado dos ativos com base no Earning Yields (Lucro/Preço), considerando penalizações para baixo ROE, crescimento e pagamento de dividendos.
 
-    ## Lista com os returns
-    lista_return = [Setor , Retorno_anual_esperado, ROE, Div_Liq_EBITDA,
-                    DY_medio, CAGR_Medio, Expansao_Multiplo, Multiplo_atual, Multiplo_medio, Desvio_multiplo]
-    
+    Exemplo de uso:
+    dados_return, figuras = ret_PE(df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal, prev_n_steps_meses)
+    """
+    return _ret_ativo("PE", PENALIZACOES_PE, df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal,
+                      prev_n_steps_meses, acumulador=acumulador)
 
-    return lista_return, lista_figuras
 
 
 ## Estratégia por EBITDA
-def ret_EBITDA(df_acao, df_multiplos, df_CAGR, limite_ROE_inf, limite_ROE_sup, limite_divida):
+def ret_EBITDA(df_acao, df_multiplos, df_CAGR, limite_ROE_inf, limite_ROE_sup, limite_divida, acumulador=None):
     """
     Calcula a rentabilidade esperada de ativos baseada no crescimento do EBITDA, DY e expansão do múltiplo, com penalizações para baixo ROE e alta dívida líquida/EBITDA.
 
@@ -565,6 +1087,7 @@ def ret_EBITDA(df_acao, df_multiplos, df_CAGR, limite_ROE_inf, limite_ROE_sup, l
     limite_ROE_inf (float): Limite inferior de ROE para penalização.
     limite_ROE_sup (float): Limite superior de ROE onde não há mais penalização.
     limite_divida (float): Valor a partir do qual começa a penalização de dívida líquida/EBITDA.
+    acumulador (MediaPonderadaExponencial): Acumulador do múltiplo do ativo (ver Dados_iniciais). Padrão é None.
 
     Retorna:
     lista_return (list): Lista de informações, incluindo setor, retorno anual esperado, ROE, dívida líquida/EBITDA, DY médio, CAGR médio, expansão do múltiplo, múltiplo atual, múltiplo médio e desvio do múltiplo.
@@ -575,80 +1098,68 @@ def ret_EBITDA(df_acao, df_multiplos, df_CAGR, limite_ROE_inf, limite_ROE_sup, l
     Exemplo de uso:
     dados_return, figuras = ret_EBITDA(df_acao, df_multiplos, df_CAGR, limite_ROE_inf, limite_ROE_sup, limite_divida)
     """
-    ## Coletando dados iniciais
-    [data_simulacao, Setor, ROE, DY_medio, ticker, CAGR_Medio, Multiplo_atual,
-      Multiplo_medio, Desvio_multiplo, Expansao_Multiplo] = \
-        Dados_iniciais(df_acao, df_multiplos, df_CAGR, "EBITDA", "EV_EBITDA")
-    
-    
-    ## Lista de figuras
-    lista_figuras = []
+    return _ret_ativo("EBITDA", penalizacoes_EBITDA(limite_ROE_inf, limite_ROE_sup, limite_divida),
+                      df_acao, df_multiplos, df_CAGR, acumulador=acumulador)
 
-    ## Impressão dos dados
-    
 
-    # Retorno esperado anual
-    ## Será composto por 2 partes:
-    ## 1 - Regressão do EV/EBITDA a média histórica em x anos
-    ## 2 - Crescimento do EBITDA somado ao DY médio
 
-    ## Retorno esperado anual
-    Retorno_anual_esperado = Expansao_Multiplo*(1+CAGR_Medio)*(1+DY_medio)-1
+## main_ret em paralelo
 
-    ## Agora é necessário realizar algumas penalizações, são elas:
-    ## ROE -> Retorno sobre o patrimônio líquido
-    ## Dívida Líquida/EBITDA -> Dívida Líquida/EBITDA
+def _compartilhar_frame(df):
+    ## Copia um DataFrame numérico com índice de datas para um bloco de memória compartilhada:
+    ## primeiro o índice (int64) e depois os valores (float64, linha a linha)
+    n, k = df.shape
+    shm = shared_memory.SharedMemory(create=True, size=max(8*n*(k + 1), 1))
+    np.ndarray(n, dtype=np.int64, buffer=shm.buf)[:] = df.index.asi8
+    np.ndarray((n, k), dtype=np.float64, buffer=shm.buf, offset=8*n)[:] = df.to_numpy(dtype=np.float64)
+    meta = {"Nome": shm.name, "Forma": (n, k), "Colunas": list(df.columns),
+            "Nome_indice": df.index.name, "Freq": df.index.freqstr}
+    return shm, meta
 
-    ## Pegar os dados de Dívida Líquida/EBITDA
-    Divida_Liquida_EBITDA = df_multiplos.loc[data_simulacao,"DIV_liq_EBITDA"]
 
-    ## Se o ROE for menor que limite_ROE_inf, o beta é 0
-    ## Se o ROE for maior que limite_ROE_sup, o beta é 1
+def _frame_compartilhado(meta):
+    ## DataFrame (somente leitura) sobre o bloco de memória compartilhada criado por _compartilhar_frame
+    shm = shared_memory.SharedMemory(name=meta["Nome"])
+    n, k = meta["Forma"]
+    indice = pd.DatetimeIndex(np.ndarray(n, dtype="datetime64[ns]", buffer=shm.buf), name=meta["Nome_indice"], freq=meta["Freq"])
+    valores = np.ndarray((n, k), dtype=np.float64, buffer=shm.buf, offset=8*n)
+    valores.flags.writeable = False
+    return shm, pd.DataFrame(valores, index=indice, columns=meta["Colunas"], copy=False)
 
-    ## Se o ROE for entre limite_ROE_inf e limite_ROE_sup, 
-    # o beta é ((razao-limite_ROE_inf)/(limite_ROE_sup-limite_ROE_inf))
-    def penalizacao_ROE(razao):
-        if razao<=limite_ROE_inf:
-            beta = 0
-        elif razao>=limite_ROE_sup:
-            beta = 1
-        else:
-            beta = ((razao-limite_ROE_inf)/(limite_ROE_sup-limite_ROE_inf))
-        return beta
-    
-    ## Se a Dívida Líquida/EBITDA for menor que limite_divida, o beta é 1
-    ## Se a Dívida Líquida/EBITDA for maior que 2*limite_divida, o beta é 0
-    ## Se a Dívida Líquida/EBITDA for entre limite_divida e 2*limite_divida, o beta é 1-((razao-limite_divida)/(limite_divida))
-    def penalizacao_Divida_Liquida_EBITDA(razao):
-        if razao<=limite_divida:
-            beta = 1
-        elif razao>=2*limite_divida:
-            beta = 0
-        else:
-            beta = 1-((razao-limite_divida)/(limite_divida))
-        return beta
-    
-    ## Calculando as penalizações
-    beta_ROE = penalizacao_ROE(ROE)
-    beta_Divida_Liquida_EBITDA = penalizacao_Divida_Liquida_EBITDA(Divida_Liquida_EBITDA)
 
-    ## Retorno esperado anual
-    Retorno_anual_esperado = Retorno_anual_esperado*beta_ROE*beta_Divida_Liquida_EBITDA
+## Expectativa da SELIC dos processos do main_ret em paralelo: (bloco de memória compartilhada, DataFrame)
+_selic_processo = None
 
-    if Retorno_anual_esperado<0:
-        Retorno_anual_esperado = 0
+def _iniciar_processo_main_ret(meta):
+    global _selic_processo
+    ## Os processos do pool não mostram figuras
+    import matplotlib
+    matplotlib.use("Agg")
+    _selic_processo = _frame_compartilhado(meta)
 
-    ## Lista com os returns
-    lista_return = [Setor, Retorno_anual_esperado, ROE, Divida_Liquida_EBITDA,
-                    DY_medio, CAGR_Medio, Expansao_Multiplo, Multiplo_atual, Multiplo_medio, Desvio_multiplo]
+
+def _dados_ativo_seguro(estrategia, df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal, prev_n_steps_meses,
+                        regressao, renderizar, acumulador):
+    ## dados_ativo que devolve o erro (traceback) em vez de interromper
+    try:
+        dados, lista_figuras = dados_ativo(estrategia, df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal,
+                                           prev_n_steps_meses, regressao, renderizar, acumulador)
+        return dados, lista_figuras, None
+    except Exception:
+        return None, None, traceback.format_exc()
 
 
+def _dados_ativo_processo(tarefa):
+    estrategia, df_acao, df_multiplos, df_CAGR, prev_n_steps_meses, regressao, renderizar, acumulador = tarefa
+    return _dados_ativo_seguro(estrategia, df_acao, df_multiplos, df_CAGR, _selic_processo[1], prev_n_steps_meses,
+                               regressao, renderizar, acumulador)
 
-    return lista_return, lista_figuras 
 
 ## main retorno
 
-def main_ret(dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal):
+@instrumentar()
+def main_ret(dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal, renderizar=True, acumuladores=None,
+             estrategias_setores=ESTRATEGIAS_SETORES, n_processos=1, interromper=False, calendario=None):
     """
     Calcula a rentabilidade esperada de ativos com diferentes estratégias dependendo do setor.
 
@@ -656,12 +1167,25 @@ def main_ret(dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal):
     dict_df_acoes (dict): Dicionário com chaves sendo os ativos e valores contendo (df_acao, df_multiplos, df_CAGR).
     df_Selic (pd.DataFrame): DataFrame com as taxas SELIC.
     df_Expectativa_Selic_mensal (pd.DataFrame): DataFrame com a expectativa da SELIC mensal.
+    renderizar (bool): Se False (modo sem gráficos), dic_figuras guarda apenas as especificações dos gráficos de cada ativo,
+                       que podem ser desenhadas depois com figuras_do_ativo ou salvas com salvar_figuras_png. Padrão é True.
+    acumuladores (dict): Acumuladores dos múltiplos por (ativo, múltiplo), de acumuladores_multiplos. Os que estiverem na data
+                         da simulação fornecem o múltiplo médio e o desvio sem recalcular os pesos. Padrão é None.
+    estrategias_setores (dict): Estratégia e penalizações de cada setor. Padrão é ESTRATEGIAS_SETORES.
+    n_processos (int): Número de processos para calcular os ativos em paralelo. Com 1, os ativos são calculados em sequência.
+                       Em paralelo, a expectativa da SELIC fica em memória compartilhada entre os processos. Padrão é 1.
+    interromper (bool): Se True, um erro em um ativo interrompe a execução. Se False, o ativo é excluído do retorno
+                        e entra na lista de excluídos. Padrão é False.
+    calendario (CalendarioNegociacao): Calendário de pregões da janela de 4 anos das cotações ajustadas. Padrão é None
+                                       (montado com as datas de cotação de dict_df_acoes, ver calendario_negociacao).
 
     Retorna:
     info_main (list): Lista contendo informações para o processo principal, incluindo o DataFrame de retorno esperado, cotações ajustadas e setores.
-    info_verificao (list): Lista contendo informações para verificação, incluindo o DataFrame de retorno, cotações ajustadas, figuras e lista de excluídos.
+    info_verificao (list): Lista contendo informações para verificação, incluindo o DataFrame de retorno, cotações ajustadas, figuras e lista de excluídos
+                           (ativos cujo cálculo falhou).
 
-    A função calcula o retorno esperado dos ativos com diferentes estratégias dependendo do setor em que estão inseridos. Também fornece informações para verificação e informações essenciais para o processo principal.
+    A função calcula o retorno esperado dos ativos com diferentes estratégias dependendo do setor em que estão inseridos,
+    conforme a tabela estrategias_setores. Também fornece informações para verificação e informações essenciais para o processo principal.
 
     Exemplo de uso:
     info_main, info_verificao = main_ret(dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal)
@@ -673,98 +1197,101 @@ def main_ret(dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal):
     ## Obter a previsão da expectativa da SELIC
     prev_n_steps_meses = df_Expectativa_Selic_mensal.loc[df_Expectativa_Selic_mensal.index.max(),"1_mes"]
 
-    ## Criando o dataframe de retorno
-    df_retorno = pd.DataFrame(columns=[
-        "Setor","Retorno_anual_esperado", "ROE", "Multiplo_Divida",
-        "DY_medio", "CAGR_Medio", "Expansao_Multiplo", "Multiplo_atual","Multiplo_medio","Desvio_multiplo",])
-    df_cotacao_ajustado = pd.DataFrame()
+    dict_dados = {}
+    dict_precos = {}
     dic_figuras = {}
     lista_excluidos = []
+    if acumuladores is None:
+        acumuladores = {}
+
+    ## Estratégia de cada ativo, pelo setor; setores fora da tabela não entram
+    dict_estrategias = {}
     for ativo in lista_ativos_elegiveis:
-        ## Pegando os dados dos ativos
+        Setor = dict_df_acoes[ativo][0].loc[:,"Setor_Comdinheiro"][0]
+        if Setor in estrategias_setores:
+            dict_estrategias[ativo] = estrategias_setores[Setor]["Estrategia"]
+
+    def excluir(ativo, erro):
+        ## Ativo com erro: sai do retorno e entra na lista de excluídos
+        Setor = dict_df_acoes[ativo][0].loc[:,"Setor_Comdinheiro"][0]
+        print(f"Ticker: {ativo}, Setor: {Setor} foi excluído. {erro.strip().splitlines()[-1]}")
+        lista_excluidos.append(ativo)
+
+    ## Regressões do PVPA contra a expectativa da SELIC de todos os ativos da estratégia VPA, feitas de uma vez
+    dict_df_regressao = {}
+    for ativo, estrategia in list(dict_estrategias.items()):
+        if estrategia == "VPA":
+            try:
+                dict_df_regressao[ativo] = dados_regressao_VPA(dict_df_acoes[ativo][1], df_Expectativa_Selic_mensal)
+            except Exception:
+                excluir(ativo, traceback.format_exc())
+                if interromper:
+                    raise
+                del dict_estrategias[ativo]
+    df_regressoes = regressao_em_lote(dict_df_regressao, "Valor", "PVPA", prev_n_steps_meses)
+
+    ## Tarefas de cada ativo: estratégia, dados do ativo, regressão e acumulador do múltiplo
+    dict_tarefas = {}
+    for ativo, estrategia in dict_estrategias.items():
         [df_acao, df_multiplos, df_CAGR] = dict_df_acoes[ativo]
-        Setor = df_acao.loc[:,"Setor_Comdinheiro"][0]
+        regressao = df_regressoes.loc[ativo] if ativo in dict_df_regressao else None
+        acumulador = acumuladores.get((ativo, ESTRATEGIAS[estrategia]["Multiplo"]))
+        dict_tarefas[ativo] = (estrategia, df_acao, df_multiplos, df_CAGR, prev_n_steps_meses, regressao, renderizar, acumulador)
+
+    if n_processos == 1:
+        dict_resultados = {}
+        for ativo, tarefa in dict_tarefas.items():
+            estrategia, df_acao, df_multiplos, df_CAGR = tarefa[:4]
+            if interromper:
+                try:
+                    dados, lista_figuras = dados_ativo(estrategia, df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal,
+                                                       *tarefa[4:])
+                except:
+                    excluir(ativo, traceback.format_exc())
+                    raise
+                dict_resultados[ativo] = (dados, lista_figuras, None)
+            else:
+                dict_resultados[ativo] = _dados_ativo_seguro(estrategia, df_acao, df_multiplos, df_CAGR,
+                                                             df_Expectativa_Selic_mensal, *tarefa[4:])
+    else:
+        ## A expectativa da SELIC, comum a todos os ativos, vai para a memória compartilhada; os dados de cada ativo
+        ## são enviados apenas ao processo que calcula o ativo
+        shm, meta = _compartilhar_frame(df_Expectativa_Selic_mensal)
         try:
-            if Setor in ["Construção e Imóveis"]:
-                ## Retorno esperado anual
-                lista_return, lista_figuras = \
-                ret_VPA(df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal, prev_n_steps_meses)
-
-                ## Adicionando o retorno esperado
-                df_retorno.loc[ativo,:] = lista_return
-                dic_figuras[ativo] = lista_figuras
-
-                ## Adicionando a cotação ajustada
-                df_ativo = df_multiplos[["Fech_Ajustado"]].copy()
-                df_ativo.columns = [ativo]
-                df_cotacao_ajustado = pd.concat([df_cotacao_ajustado, df_ativo], axis=1, join="outer")
-
-
-            elif Setor in ["Bancos e Serviços Financeiros"]:
-                ## Retorno esperado anual
-                lista_return, lista_figuras = \
-                ret_PE(df_acao, df_multiplos, df_CAGR, df_Expectativa_Selic_mensal, prev_n_steps_meses)
-                ## Adicionando o retorno esperado
-                df_retorno.loc[ativo,:] = lista_return
-                dic_figuras[ativo] = lista_figuras
-
-                ## Adicionando a cotação ajustada
-                df_ativo = df_multiplos[["Fech_Ajustado"]].copy()
-                df_ativo.columns = [ativo]
-                df_cotacao_ajustado = pd.concat([df_cotacao_ajustado, df_ativo], axis=1, join="outer")
-
-
-            elif Setor in ["Energia e Serviços Básicos"]:
-                ## Retorno esperado anual
-                lista_return, lista_figuras = \
-                ret_EBITDA(df_acao, df_multiplos, df_CAGR, 0.02 , 0.1, 3)
-
-                ## Adicionando o retorno esperado
-                df_retorno.loc[ativo,:] = lista_return
-                dic_figuras[ativo] = lista_figuras
-
-                ## Adicionando a cotação ajustada
-                df_ativo = df_multiplos[["Fech_Ajustado"]].copy()
-                df_ativo.columns = [ativo]
-                df_cotacao_ajustado = pd.concat([df_cotacao_ajustado, df_ativo], axis=1, join="outer")
-
-            elif Setor in ["Biocombustíveis, Gás e Petróleo", "Mineração"]:
-                ## Retorno esperado anual
-                lista_return, lista_figuras = \
-                ret_EBITDA(df_acao, df_multiplos, df_CAGR, 0.15 , 0.3, 1.5)
-
-                ## Adicionando o retorno esperado
-                df_retorno.loc[ativo,:] = lista_return
-                dic_figuras[ativo] = lista_figuras
-
-                ## Adicionando a cotação ajustada
-                df_ativo = df_multiplos[["Fech_Ajustado"]].copy()
-                df_ativo.columns = [ativo]
-                df_cotacao_ajustado = pd.concat([df_cotacao_ajustado, df_ativo], axis=1, join="outer")
-
-            elif Setor in ["Serviços", "Celulose, Papel e Madeira", "Indústria"]:
-                ## Retorno esperado anual
-                lista_return, lista_figuras = \
-                ret_EBITDA(df_acao, df_multiplos, df_CAGR, 0.01 , 0.05, 2.5)
-
-                ## Adicionando o retorno esperado
-                df_retorno.loc[ativo,:] = lista_return
-                dic_figuras[ativo] = lista_figuras
-
-                ## Adicionando a cotação ajustada
-                df_ativo = df_multiplos[["Fech_Ajustado"]].copy()
-                df_ativo.columns = [ativo]
-                df_cotacao_ajustado = pd.concat([df_cotacao_ajustado, df_ativo], axis=1, join="outer")
-    
-        except:
-            print(f"Ticker: {ativo}, Setor: {Setor} foi excluído.")
-            raise
-           
-    
+            with ProcessPoolExecutor(max_workers=n_processos, initializer=_iniciar_processo_main_ret,
+                                     initargs=(meta,)) as executor:
+                chunksize = max(1, len(dict_tarefas)//(4*n_processos))
+                dict_resultados = dict(zip(dict_tarefas, executor.map(_dados_ativo_processo, dict_tarefas.values(),
+                                                                      chunksize=chunksize)))
+        finally:
+            shm.close()
+            shm.unlink()
+
+    for ativo, (dados, lista_figuras, erro) in dict_resultados.items():
+        if erro is not None:
+            excluir(ativo, erro)
+            if interromper:
+                raise RuntimeError(f"Ticker: {ativo} foi excluído.\n{erro}")
+            continue
+        dict_dados[ativo] = dados
+        dic_figuras[ativo] = lista_figuras
+        ## Adicionando a cotação ajustada
+        dict_precos[ativo] = dict_df_acoes[ativo][1]["Fech_Ajustado"]
+
+    ## Retorno esperado anual de todos os ativos, pela estratégia do setor
+    df_retorno = retorno_esperado_setores(dict_dados, estrategias_setores)
+
+    ## Painel das cotações ajustadas, montado de uma vez
+    df_cotacao_ajustado = montar_painel_precos(dict_precos, descartar_linhas_vazias=True)
+
     ## Informações para verificação
-    df_cotacao_ajustado.dropna(how="all",inplace=True)
     info_verificao = [df_retorno.copy(), df_cotacao_ajustado.copy(), dic_figuras, lista_excluidos]
 
+    ## Nenhum ativo calculado (todos excluídos ou universo vazio): informações para o main vazias
+    if len(df_retorno) == 0:
+        info_main = [pd.Series(dtype=float, name="Retorno_anual_esperado"), pd.DataFrame(), pd.Series(dtype=object, name="Setor")]
+        return info_main, info_verificao
+
     ## Informações para o main
     # Retirar ativos iguais e com rentabilidade esperada menor que 5%
 
@@ -787,9 +1314,12 @@ def main_ret(dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal):
 
     # Redefinir o df_cotacao_ajustado
     ativos = df_retorno_new.index
-    df_cot_new = df_cotacao_ajustado.loc[:,ativos].copy()
-    ## Filtrar os últimos 4 anos
-    df_cot_new = df_cot_new.iloc[-4*252:-5,:] # últimos 4 anos
+    ## Filtrar os últimos 4 anos até a última cotação, sem os 5 últimos pregões; a janela é uma fatia do painel
+    ## e só as colunas dos ativos são copiadas
+    if calendario is None:
+        calendario = calendario_negociacao(dict_df_acoes)
+    inicio, fim = calendario.limites(df_cotacao_ajustado.index.max(), anos=4)
+    df_cot_new = df_cotacao_ajustado.iloc[calendario.fatia(df_cotacao_ajustado.index, inicio, fim - 5),:].loc[:,ativos]
 
     ## Definir as informações que serão utilizadas para a montagem do portfólio
     info_main = [df_retorno_new["Retorno_anual_esperado"], df_cot_new, df_retorno_new["Setor"]]
@@ -1,8 +1,25 @@
 # %%
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from datetime import datetime
 import os
+import hashlib
+import json
+import signal
+import time
+import traceback
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+try:
+    from modules.Colher_tratar_dados.instrumentacao import instrumentar, etapa
+except ModuleNotFoundError:
+    ## Executado como script ou notebook: a raiz do repositório fica três pastas acima da pasta deste arquivo
+    ## (no notebook não há __file__, e a pasta de trabalho é a do próprio arquivo)
+    _pasta_arquivo = os.path.dirname(os.path.abspath(__file__)) if "__file__" in globals() else os.getcwd()
+    sys.path.insert(0, os.path.abspath(os.path.join(_pasta_arquivo, "..", "..", "..")))
+    from modules.Colher_tratar_dados.instrumentacao import instrumentar, etapa
 
 # %% [markdown]
 # # Definindo as funções
@@ -10,27 +27,57 @@ import os
 # %% [markdown]
 # ## Funções Básicas
 
+# %%
+## Pasta do dataset. O padrão é relativo à pasta deste arquivo, de onde o tratamento roda como notebook;
+## pode ser trocada com definir_diretorio_dataset ou com o parâmetro diretorio_dataset de tratar_universo
+DIRETORIO_DATASET = os.path.join("..","..","..","dataset")
+
+def definir_diretorio_dataset(diretorio):
+    global DIRETORIO_DATASET
+    DIRETORIO_DATASET = diretorio
+
 # %%
 def endereco_arquivos(Ticker):
     ## Arquivos de Dados
     # Dados Fundamentalistas
     ticker_Fund = f"{Ticker}_Fund.parquet"
-    arquivo_Fund = os.path.join("..","..","..","dataset", "BR", "ACOES", "Dados_Brutos",ticker_Fund)
+    arquivo_Fund = os.path.join(DIRETORIO_DATASET, "BR", "ACOES", "Dados_Brutos",ticker_Fund)
     # Cotações Diárias
     ticker_Cot = f"{Ticker}_Cot.parquet"
-    arquivo_Cot = os.path.join("..","..","..","dataset", "BR", "ACOES", "Dados_Brutos",ticker_Cot)
+    arquivo_Cot = os.path.join(DIRETORIO_DATASET, "BR", "ACOES", "Dados_Brutos",ticker_Cot)
     # Dados de Proventos
     ticker_Prov = f"{Ticker}_Prov.parquet"
-    arquivo_Prov = os.path.join("..","..","..","dataset", "BR", "ACOES", "Dados_Brutos",ticker_Prov)
+    arquivo_Prov = os.path.join(DIRETORIO_DATASET, "BR", "ACOES", "Dados_Brutos",ticker_Prov)
     # Dados de Eventos como desdobramentos e grupamentos
     ticker_Eventos = f"{Ticker}_Eventos.parquet"
-    arquivo_Eventos = os.path.join("..","..","..","dataset", "BR", "ACOES", "Dados_Brutos",ticker_Eventos)
+    arquivo_Eventos = os.path.join(DIRETORIO_DATASET, "BR", "ACOES", "Dados_Brutos",ticker_Eventos)
     # Dados de Subscrições
     ticker_Subscricao = f"{Ticker}_Subscricao.parquet"
-    arquivo_Subscricao = os.path.join("..","..","..","dataset", "BR", "ACOES", "Dados_Brutos",ticker_Subscricao)
+    arquivo_Subscricao = os.path.join(DIRETORIO_DATASET, "BR", "ACOES", "Dados_Brutos",ticker_Subscricao)
 
     return arquivo_Fund, arquivo_Cot, arquivo_Prov, arquivo_Eventos, arquivo_Subscricao
 
+# %%
+def endereco_tratados(Ticker):
+    ## Arquivos de Dados Tratados
+    # Dados Fundamentalistas normalizados
+    nome_arquivo = f"Dados_normalizados_acao_{Ticker}.parquet"
+    arquivo_por_acao = os.path.join(DIRETORIO_DATASET, "BR", "ACOES", "Dados_Tratados",nome_arquivo)
+    # Múltiplos diários
+    nome_arquivo = f"Multiplos_diarios_{Ticker}.parquet"
+    arquivo_multiplos = os.path.join(DIRETORIO_DATASET, "BR", "ACOES", "Dados_Tratados",nome_arquivo)
+    # CAGR
+    nome_arquivo = f"CAGR_{Ticker}.parquet"
+    arquivo_CAGR = os.path.join(DIRETORIO_DATASET, "BR", "ACOES", "Dados_Tratados",nome_arquivo)
+
+    return arquivo_por_acao, arquivo_multiplos, arquivo_CAGR
+
+# %%
+def endereco_particionado(tabela, Ticker):
+    ## Partição do ativo no dataset de uma tabela dos Dados Tratados
+    ## (Dados_normalizados_acao, Multiplos_diarios ou CAGR), no formato hive: <tabela>/Ticker=<Ticker>
+    return os.path.join(DIRETORIO_DATASET, "BR", "ACOES", "Dados_Tratados", "Particionado", tabela, f"Ticker={Ticker}")
+
 # %%
 def Func_Classe_acao(Ticker):
     if Ticker[4] == "3":
@@ -49,26 +96,128 @@ def Func_Classe_acao(Ticker):
     return Classe_acao
 
 # %% [markdown]
-# ## Tratar dados
+# ## Decodificar dados brutos
 
 # %%
-def tratar_Fund(arquivo_Fund):
-    # Lendo os arquivos
-    df_fund = pd.read_parquet(arquivo_Fund)
+def decodificar_colunas(df, colunas_numericas=(), colunas_datas=(), datas_no_indice=True):
+    ## Converte de uma só vez as colunas numéricas no formato brasileiro ("1234,56") e as colunas
+    ## de datas ("%d/%m/%Y"), empilhando as colunas de cada tipo em uma única série.
+    ## Células vazias viram NaN/NaT. As células que não puderam ser convertidas também, e são
+    ## devolvidas em um DataFrame de erros com a coluna, a linha e o valor original
+    df = df.copy()
+    lista_erros = []
+
+    def registrar_erros(colunas, valores, invalido):
+        posicao = np.flatnonzero(invalido)
+        lista_erros.append(pd.DataFrame({"Coluna": np.asarray(colunas, dtype=object)[posicao // len(df)],
+                                         "Linha": df.index[posicao % len(df)],
+                                         "Valor": valores[posicao]}))
+
+    ## Colunas numéricas ainda em texto
+    colunas_numericas = [col for col in colunas_numericas if not pd.api.types.is_numeric_dtype(df[col])]
+    if colunas_numericas:
+        valores = df[colunas_numericas].to_numpy(dtype=object).ravel(order="F")
+        texto = pd.Series(valores, dtype=object)
+        vazio = (texto.isna() | (texto == "")).to_numpy()
+        texto = texto[~vazio].astype(str).str.replace(",", ".", regex=False)
+        numeros = np.full(len(valores), np.nan)
+        try:
+            numeros[~vazio] = texto.astype(float).to_numpy()
+        except ValueError:
+            ## Há células inválidas: localizar e converter apenas as válidas
+            valido = pd.to_numeric(texto, errors="coerce").notna().to_numpy() | (texto.str.lower() == "nan").to_numpy()
+            convertido = np.full(len(texto), np.nan)
+            convertido[valido] = texto[valido].astype(float).to_numpy()
+            numeros[~vazio] = convertido
+            invalido = np.zeros(len(valores), dtype=bool)
+            invalido[np.flatnonzero(~vazio)[~valido]] = True
+            registrar_erros(colunas_numericas, valores, invalido)
+        df[colunas_numericas] = pd.DataFrame(numeros.reshape(len(colunas_numericas), len(df)).T,
+                                             index=df.index, columns=colunas_numericas)
+
+    ## Colunas de datas ainda em texto
+    colunas_datas = [col for col in colunas_datas if not pd.api.types.is_datetime64_any_dtype(df[col])]
+    if colunas_datas:
+        valores = df[colunas_datas].to_numpy(dtype=object).ravel(order="F")
+        texto = pd.Series(valores, dtype=object)
+        vazio = (texto.isna() | (texto == "")).to_numpy()
+        datas = pd.to_datetime(texto.where(~vazio), format="%d/%m/%Y", errors="coerce").to_numpy()
+        registrar_erros(colunas_datas, valores, ~vazio & np.isnat(datas))
+        for i, col in enumerate(colunas_datas):
+            df[col] = datas[i*len(df):(i+1)*len(df)]
+
+    ## Índice de datas
+    if datas_no_indice and not pd.api.types.is_datetime64_any_dtype(df.index):
+        valores = df.index.to_numpy(dtype=object)
+        datas = pd.to_datetime(pd.Series(valores, dtype=object), format="%d/%m/%Y", errors="coerce").to_numpy()
+        registrar_erros(["index"], valores, np.isnat(datas))
+        df.index = pd.DatetimeIndex(datas, name=df.index.name)
+
+    if lista_erros:
+        df_erros = pd.concat(lista_erros, axis=0, ignore_index=True)
+    else:
+        df_erros = pd.DataFrame(columns=["Coluna", "Linha", "Valor"])
+    return df, df_erros
+
+# %%
+def relatar_erros(df_erros, arquivo, interromper=False):
+    ## Mostra as células inválidas de um arquivo bruto; com interromper=True, interrompe o tratamento
+    if len(df_erros) == 0:
+        return
+    print(f"{len(df_erros)} células inválidas em {arquivo}")
+    for col, df_col in df_erros.groupby("Coluna", sort=False):
+        exemplos = ", ".join(f"{linha}: {valor!r}" for linha, valor in zip(df_col["Linha"][:3], df_col["Valor"][:3]))
+        print(f"    {col}: {len(df_col)} células ({exemplos})")
+    if interromper:
+        raise ValueError(f"{len(df_erros)} células inválidas em {arquivo}")
 
+# %%
+def ler_bruto_tipado(arquivo, colunas_numericas=(), colunas_datas=(), datas_no_indice=True):
+    ## Lê um arquivo bruto com as colunas já decodificadas (ver decodificar_colunas).
+    ## Uma cópia já decodificada fica na pasta Cache_tipado, ao lado do arquivo bruto, com a mesma data de
+    ## modificação dele, e é usada enquanto as datas forem iguais (um arquivo bruto restaurado de uma cópia
+    ## pode ser mais antigo do que o cache, e mesmo assim ter mudado). Arquivos com células inválidas não vão para o cache,
+    ## para que os erros continuem sendo relatados até o arquivo bruto ser corrigido.
+    ## Retorna o DataFrame e o DataFrame de erros
+    arquivo_cache = os.path.join(os.path.dirname(arquivo), "Cache_tipado", os.path.basename(arquivo))
+    mtime_bruto = os.stat(arquivo).st_mtime_ns
+    if os.path.exists(arquivo_cache) and os.stat(arquivo_cache).st_mtime_ns == mtime_bruto:
+        df = pd.read_parquet(arquivo_cache)
+        tipado = all(pd.api.types.is_numeric_dtype(df[col]) for col in colunas_numericas) and \
+            all(pd.api.types.is_datetime64_any_dtype(df[col]) for col in colunas_datas) and \
+            (not datas_no_indice or pd.api.types.is_datetime64_any_dtype(df.index))
+        if tipado:
+            return df, pd.DataFrame(columns=["Coluna", "Linha", "Valor"])
+
+    df, df_erros = decodificar_colunas(pd.read_parquet(arquivo), colunas_numericas, colunas_datas, datas_no_indice)
+    if len(df_erros) == 0:
+        os.makedirs(os.path.dirname(arquivo_cache), exist_ok=True)
+        arquivo_temporario = f"{arquivo_cache}.{os.getpid()}.tmp"
+        df.to_parquet(arquivo_temporario)
+        os.utime(arquivo_temporario, ns=(mtime_bruto, mtime_bruto))
+        os.replace(arquivo_temporario, arquivo_cache)
+    return df, df_erros
 
-    # Ao ler o arquivo Parquet, especifique o dtype usando o parâmetro dtype
-    df_fund = pd.read_parquet(arquivo_Fund)
+# %%
+class TempoEsgotado(BaseException):
+    ## Tempo limite do ativo esgotado (ver tratar_ativo). Deriva de BaseException, como KeyboardInterrupt,
+    ## para não ser capturada pelos except Exception do tratamento e das bibliotecas; os except genéricos
+    ## do tratamento a repassam
+    pass
 
-    # Excluir o que não tem Data_balanco
-    df_fund = df_fund.dropna(subset=["Data_balanco","Num_acoes","Market_value"])
+def _estourou_tempo(signum, frame):
+    raise TempoEsgotado("Tempo limite do ativo esgotado")
 
+# %% [markdown]
+# ## Tratar dados
+
+# %%
+@instrumentar()
+def tratar_Fund(arquivo_Fund):
     # Colunas que são datas
-    colunas_datas = ['Data_balanco', 'Data_demonstracao', 'Data_analise']  # Substitua pelos nomes reais das suas colunas de datas
-    df_fund.loc[:, colunas_datas] = df_fund.loc[:, colunas_datas].apply(pd.to_datetime, format='%d/%m/%Y')
-    df_fund.index = pd.to_datetime(df_fund.index, format='%d/%m/%Y')
+    colunas_datas = ['Data_balanco', 'Data_demonstracao', 'Data_analise']
 
-    # Suponha que você tenha uma lista de nomes de colunas que devem ser lidas como números
+    # Colunas que são números
     colunas_numericas = ['Num_acoes', 'Fator_equivalencia_acoes',
         'Market_value', 'PL', 'RL', 'EBITDA', 'D&A', 'EBIT', 'LL',
         'LL_controlador', 'LL_nao_controlador', 'ROIC', 'ROE', 'Div_Bruta',
@@ -78,17 +227,18 @@ def tratar_Fund(arquivo_Fund):
         'ret_12meses', 'ret_1mes_aa', 'ret_ano', 'ret_CDI_1m',
         'ret_CDI_12m', 'ret_CDI_ano', 'ret_IBOV_1mes', 'ret_IBOV_12m',
         'ret_IBOV_ano',
-        'meses']  # Substitua pelos nomes reais das suas colunas numéricas
-    df_fund.fillna(0,inplace=True)
-    for col in colunas_numericas:
-        # Substitua vírgulas por pontos e converta para float
-        try:
-            df_fund[col] = df_fund[col].str.replace(',', '.').astype(float)
-        except:
-            print(f"Erro na coluna {col}")
-        pass
+        'meses']
+
+    # Lendo os arquivos, com as datas e os números já convertidos
+    df_fund, df_erros = ler_bruto_tipado(arquivo_Fund, colunas_numericas, colunas_datas)
+    relatar_erros(df_erros, arquivo_Fund)
+
+    # Excluir o que não tem Data_balanco
+    df_fund = df_fund.dropna(subset=["Data_balanco","Num_acoes","Market_value"])
 
-    df_fund.fillna(0,inplace=True)
+    # Valores vazios viram 0, exceto nas datas
+    colunas_nao_datas = [col for col in df_fund.columns if col not in colunas_datas]
+    df_fund.loc[:, colunas_nao_datas] = df_fund.loc[:, colunas_nao_datas].fillna(0)
 
 
 
@@ -104,35 +254,26 @@ def tratar_Fund(arquivo_Fund):
     return df_fund
 
 # %%
+@instrumentar()
 def tratar_cot(arquivo_Cot):
-    # Lendo os arquivos de cotações
-    df_cot = pd.read_parquet(arquivo_Cot)
-    # Colunas que são datas
-    df_cot.index = pd.to_datetime(df_cot.index, format='%d/%m/%Y')
-
-    # Substitua os valores vazios ("" ou string vazia) por NaN em todas as colunas
-    df_cot.replace("", np.nan, inplace=True)
-
-    # Excluir o que não tem Fech_Historico
-    df_cot = df_cot.dropna(subset=["Fech_Historico"])
-
-
     # Colunas que são numéricas
     colunas_numericas = ['Fech_Ajustado', 'Variação(%)','Fech_Historico', 'Abertura_Ajustado',
         'Min_Ajustado', 'Medio_Ajustado', 'Max_Ajustado', 'Vol(MM_R$)',
         'Negocios', 'Fator']
-    for col in colunas_numericas:
-        # Substitua vírgulas por pontos e converta para float
-        try:
-            df_cot[col] = df_cot[col].str.replace(',', '.').astype(float)
-        except:
-            raise
+
+    # Lendo os arquivos de cotações, com as datas e os números já convertidos.
+    # Valores vazios viram NaN; uma célula inválida interrompe o tratamento do ativo
+    df_cot, df_erros = ler_bruto_tipado(arquivo_Cot, colunas_numericas)
+    relatar_erros(df_erros, arquivo_Cot, interromper=True)
+
+    # Excluir o que não tem Fech_Historico
+    df_cot = df_cot.dropna(subset=["Fech_Historico"])
 
 
     # Colunas que são porcentagem
     colunas_pct = ['Variação(%)']
     # Substitua os valores None por NaN em todas as colunas
-    df_cot.fillna(0, inplace=True)
+    df_cot = df_cot.fillna(0)
     df_cot.loc[:, colunas_pct] = df_cot.loc[:, colunas_pct].apply(lambda x: x/100)
 
     # Ordenar por index
@@ -141,6 +282,7 @@ def tratar_cot(arquivo_Cot):
     return df_cot
 
 # %%
+@instrumentar()
 def tratar_prov(arquivo_Prov, Classe_acao):
     # Lendo os arquivos de proventos
     try:
@@ -170,6 +312,8 @@ def tratar_prov(arquivo_Prov, Classe_acao):
             except:
                 raise
  
+    except TempoEsgotado:
+        raise
     except:
         Existe_prov = False
         df_prov = pd.DataFrame()
@@ -177,6 +321,7 @@ def tratar_prov(arquivo_Prov, Classe_acao):
     return df_prov, Existe_prov
 
 # %%
+@instrumentar()
 def tratar_even(arquivo_Eventos, Classe_acao):
     # Lendo os arquivos de eventos
     try:
@@ -198,6 +343,8 @@ def tratar_even(arquivo_Eventos, Classe_acao):
             except:
                 raise
 
+    except TempoEsgotado:
+        raise
     except:
         Existe_eventos = False
         df_eventos = pd.DataFrame()
@@ -206,6 +353,7 @@ def tratar_even(arquivo_Eventos, Classe_acao):
     return df_eventos, Existe_eventos
 
 # %%
+@instrumentar()
 def tratar_subs(arquivo_Subscricao):
     # Lendo os arquivos de subscrições
     try:
@@ -235,6 +383,8 @@ def tratar_subs(arquivo_Subscricao):
             except:
                 raise
         
+    except TempoEsgotado:
+        raise
     except:
         Existe_subscricao = False
         df_subscricao = pd.DataFrame()
@@ -247,64 +397,52 @@ def tratar_subs(arquivo_Subscricao):
 # ## Normalização
 
 # %%
+def fator_acumulado_eventos(df_eventos, datas):
+    ## Fator acumulado dos desdobramentos, grupamentos e bonificações para cada data.
+    ## Lembrar que a data do evento é a "data-com", portanto está incluída: uma data recebe
+    ## o produto dos fatores de todos os eventos com data maior ou igual a ela.
+    ## Cada linha de evento aplica o produto dos fatores da sua data
+    fator_por_linha = df_eventos.groupby(level=0)["Fator"].transform("prod")
+    fator_por_data = fator_por_linha.groupby(level=0).prod()
+
+    ## Produto acumulado reverso, do evento mais recente para o mais antigo
+    ## O último elemento (1) é usado pelas datas posteriores a todos os eventos
+    fator_reverso = np.append(np.cumprod(fator_por_data.values[::-1])[::-1], 1.0)
+
+    ## As-of: primeiro evento com data maior ou igual a cada data
+    posicao = np.searchsorted(fator_por_data.index.values, pd.DatetimeIndex(datas).values, side="left")
+    return fator_reverso[posicao]
+
+# %%
+@instrumentar()
 def normalizar_dados_fund(df_fund, df_eventos, Existe_eventos, Ticker):
     # Normalizar Dados Fundamentalistas e considerar os eventos
     df_Tratar_por_Acao = df_fund.copy()
 
     ## Calcular o número de ações Equivalentes atual
-    # Criar a Coluna de Número de Ações Equivalentes
-    df_Tratar_por_Acao.insert(3, "Num_acoes_equivalentes", 0)
-
     ## No caso de Units é necessário considerar o número de ações de cada classe
-    df_Tratar_por_Acao.loc[:, "Num_acoes_equivalentes"]= df_Tratar_por_Acao.apply(lambda x: x["Num_acoes"] / x["Fator_equivalencia_acoes"], axis=1)
-
-
+    df_Tratar_por_Acao.insert(3, "Num_acoes_equivalentes", df_Tratar_por_Acao["Num_acoes"] / df_Tratar_por_Acao["Fator_equivalencia_acoes"])
 
     ## Adicionar o Ticker
     df_Tratar_por_Acao.insert(0, "Ticker", Ticker)
 
-    ## Adicionar o Coluna de Proventos
-    df_Tratar_por_Acao.insert(len(df_Tratar_por_Acao.columns), "Prov_12meses", 0)
-    df_Tratar_por_Acao.insert(len(df_Tratar_por_Acao.columns), "Prov_24meses", 0)
-    df_Tratar_por_Acao.insert(len(df_Tratar_por_Acao.columns), "Prov_36meses", 0)
-    df_Tratar_por_Acao.insert(len(df_Tratar_por_Acao.columns), "Prov_48meses", 0)
-    df_Tratar_por_Acao.insert(len(df_Tratar_por_Acao.columns), "Prov_60meses", 0)
-
     ## Adicionar os proventos
-    df_Tratar_por_Acao.loc[:, "Prov_12meses"] = df_Tratar_por_Acao.apply(lambda x: x["DY_12m"]*x["Preco_fechamento"], axis=1)
-    df_Tratar_por_Acao.loc[:, "Prov_24meses"] = df_Tratar_por_Acao.apply(lambda x: x["DY_24m"]*x["Preco_fechamento"], axis=1)
-    df_Tratar_por_Acao.loc[:, "Prov_36meses"] = df_Tratar_por_Acao.apply(lambda x: x["DY_36m"]*x["Preco_fechamento"], axis=1)
-    df_Tratar_por_Acao.loc[:, "Prov_48meses"] = df_Tratar_por_Acao.apply(lambda x: x["DY_48m"]*x["Preco_fechamento"], axis=1)
-    df_Tratar_por_Acao.loc[:, "Prov_60meses"] = df_Tratar_por_Acao.apply(lambda x: x["DY_60m"]*x["Preco_fechamento"], axis=1)
+    df_Tratar_por_Acao.insert(len(df_Tratar_por_Acao.columns), "Prov_12meses", df_Tratar_por_Acao["DY_12m"]*df_Tratar_por_Acao["Preco_fechamento"])
+    df_Tratar_por_Acao.insert(len(df_Tratar_por_Acao.columns), "Prov_24meses", df_Tratar_por_Acao["DY_24m"]*df_Tratar_por_Acao["Preco_fechamento"])
+    df_Tratar_por_Acao.insert(len(df_Tratar_por_Acao.columns), "Prov_36meses", df_Tratar_por_Acao["DY_36m"]*df_Tratar_por_Acao["Preco_fechamento"])
+    df_Tratar_por_Acao.insert(len(df_Tratar_por_Acao.columns), "Prov_48meses", df_Tratar_por_Acao["DY_48m"]*df_Tratar_por_Acao["Preco_fechamento"])
+    df_Tratar_por_Acao.insert(len(df_Tratar_por_Acao.columns), "Prov_60meses", df_Tratar_por_Acao["DY_60m"]*df_Tratar_por_Acao["Preco_fechamento"])
 
     # Computar os desdobramentos, grupamentos e Bonificações
     if Existe_eventos:
-        ## Datas do Eventos com a condição de Classe de Ação
-        datas_eventos = df_eventos.loc[:].index
-
-
-        ## Loop para percorrer as datas dos eventos e alterar o número equivalente de ações
-        for data in datas_eventos:
-            
-            ## Fator do evento
-            condicao_even = (df_eventos.index == data)
-            fator_evento = df_eventos.loc[condicao_even,"Fator"].prod()
-
-            ## Condição para recalcular o número de ações equivalentes, no df_Tratar_por_Acao
-            ## Lembrar que "data" é a "data-com" do evento, portanto está incluída
-            condicao = df_Tratar_por_Acao.index <= data
-            ## Recalcular o número de ações equivalentes
-            df_Tratar_por_Acao.loc[condicao,"Num_acoes_equivalentes"] = df_Tratar_por_Acao.loc[condicao,"Num_acoes_equivalentes"]/fator_evento
-
-            ## Recalcular os proventos
-            df_Tratar_por_Acao.loc[condicao,"Prov_12meses"] = df_Tratar_por_Acao.loc[condicao,"Prov_12meses"]*fator_evento
-            df_Tratar_por_Acao.loc[condicao,"Prov_24meses"] = df_Tratar_por_Acao.loc[condicao,"Prov_24meses"]*fator_evento
-            df_Tratar_por_Acao.loc[condicao,"Prov_36meses"] = df_Tratar_por_Acao.loc[condicao,"Prov_36meses"]*fator_evento
-            df_Tratar_por_Acao.loc[condicao,"Prov_48meses"] = df_Tratar_por_Acao.loc[condicao,"Prov_48meses"]*fator_evento
-            df_Tratar_por_Acao.loc[condicao,"Prov_60meses"] = df_Tratar_por_Acao.loc[condicao,"Prov_60meses"]*fator_evento
-
+        fator_evento = fator_acumulado_eventos(df_eventos, df_Tratar_por_Acao.index)
 
+        ## Recalcular o número de ações equivalentes
+        df_Tratar_por_Acao["Num_acoes_equivalentes"] = df_Tratar_por_Acao["Num_acoes_equivalentes"]/fator_evento
 
+        ## Recalcular os proventos
+        for col in ["Prov_12meses", "Prov_24meses", "Prov_36meses", "Prov_48meses", "Prov_60meses"]:
+            df_Tratar_por_Acao[col] = df_Tratar_por_Acao[col]*fator_evento
 
     ## Adicionar o Ticker
     df_Tratar_por_Acao.insert(len(df_Tratar_por_Acao.columns), "Fonte", "Comdinheiro")
@@ -314,61 +452,45 @@ def normalizar_dados_fund(df_fund, df_eventos, Existe_eventos, Ticker):
     colunas_divididas = ['PL', 'RL', 'EBITDA', 'D&A', 'EBIT', 'LL',
                         'LL_controlador', 'LL_nao_controlador', 
                         'Div_Bruta', 'Div_liq', 'Div_Arrendamento', 'FCO', 'FCI', 'FCF']
-    for col in colunas_divididas:
-        df_Tratar_por_Acao.loc[:, col] = df_Tratar_por_Acao.apply(lambda row: row[col]/row['Num_acoes_equivalentes'], axis=1)
+    df_Tratar_por_Acao[colunas_divididas] = df_Tratar_por_Acao[colunas_divididas].div(df_Tratar_por_Acao["Num_acoes_equivalentes"], axis=0)
 
     return df_Tratar_por_Acao
 
 # %%
+@instrumentar()
 def ajuste_cotacoes(df_cot, df_Tratar_por_Acao, df_eventos, Existe_eventos, Ticker):
     ## Tratar o dataframe das cotações com os eventos
     df_cot_tratado = df_cot.loc[:,["Fech_Historico","Fech_Ajustado"]].copy()
     df_cot_tratado.columns = ["Fechamento_Equivalente","Fech_Ajustado"]
-    df_cot_tratado.insert(0,"Num_acoes_equivalentes",0)
 
-    ## Filtrar as datas do df_Tratar_por_Acao menores que a data do df_cot_tratado
-    datas_fund = df_Tratar_por_Acao.index
-    datas_cot = df_cot_tratado.index
-    ## Loop para percorrer as datas dos eventos e alterar o número equivalente de ações
-    ## Considerando a Classe da ação. Lembrar que o Num_acoes_equivalentes calculado anteriormente
+    ## Para cada cotação, o primeiro dado fundamentalista (na ordem do df_Tratar_por_Acao) com data menor
+    ## ou igual à da cotação. Lembrar que o Num_acoes_equivalentes calculado anteriormente
     ## só foi calculado para cada trimestre, aqui considera o número de ações equivalentes para cada dia
-    for data in datas_cot:
-        condicao = datas_fund <= data
-        # Se todos forem falso pode deletar a linha
-        if condicao.sum() > 0:
-            Num_acoes = df_Tratar_por_Acao.loc[condicao,"Num_acoes"][0]
-            Fator_equivalencia_acoes = df_Tratar_por_Acao.loc[condicao,"Fator_equivalencia_acoes"][0]
-            df_cot_tratado.loc[data,"Num_acoes_equivalentes"] = Num_acoes / Fator_equivalencia_acoes
-            #print(data, Num_acoes, Fator_equivalencia_acoes)
-        else:
-            df_cot_tratado.drop(data, inplace=True)
-            Num_acoes = 0
-            Fator_equivalencia_acoes = 0
-
+    datas_fund = df_Tratar_por_Acao.index.values.astype("datetime64[ns]").astype(np.int64)
+    menor_data_fund = np.minimum.accumulate(datas_fund)
+    posicao = np.searchsorted(-menor_data_fund, -df_cot_tratado.index.values.astype("datetime64[ns]").astype(np.int64), side="left")
+    ## Cotações sem dado fundamentalista anterior são descartadas
+    existe_fund = posicao < len(datas_fund)
+    df_cot_tratado = df_cot_tratado.loc[existe_fund, :]
+    posicao = posicao[existe_fund]
+    Num_acoes = df_Tratar_por_Acao["Num_acoes"].to_numpy()[posicao]
+    Fator_equivalencia_acoes = df_Tratar_por_Acao["Fator_equivalencia_acoes"].to_numpy()[posicao]
+    df_cot_tratado.insert(0, "Num_acoes_equivalentes", Num_acoes / Fator_equivalencia_acoes)
 
     ## Normalizar os dados pelo número de ações equivalentes, considerando os eventos
-
     if Existe_eventos:
-        datas_eventos = df_eventos.index
-        for data in datas_eventos:
-            
-            ## Fator do evento
-            condicao_evento = (df_eventos.index == data)
-            fator_evento = df_eventos.loc[condicao_evento,"Fator"].prod()
-
-            ## Condição para recalcular o Preço de Fechamento Histórico, no df_cot_tratado
-            condicao = df_cot_tratado.index <= data
-            ## Recalcular o preço Equivalente
-            df_cot_tratado.loc[condicao,"Fechamento_Equivalente"] = df_cot_tratado.loc[condicao,"Fechamento_Equivalente"]*fator_evento
-
-            ## Recalcular o número de ações equivalentes
-            df_cot_tratado.loc[condicao,"Num_acoes_equivalentes"] = df_cot_tratado.loc[condicao,"Num_acoes_equivalentes"]/fator_evento
-        
+        fator_evento = fator_acumulado_eventos(df_eventos, df_cot_tratado.index)
+
+        ## Recalcular o preço Equivalente
+        df_cot_tratado["Fechamento_Equivalente"] = df_cot_tratado["Fechamento_Equivalente"]*fator_evento
+
+        ## Recalcular o número de ações equivalentes
+        df_cot_tratado["Num_acoes_equivalentes"] = df_cot_tratado["Num_acoes_equivalentes"]/fator_evento
+
     ## Adicionar o Ticker
     df_cot_tratado.insert(0, "Ticker", Ticker)
     # Adicionar o Coluna de Market Value
-    df_cot_tratado.insert(len(df_cot_tratado.columns), "Market_value", 0)
-    df_cot_tratado.loc[:,"Market_value"] = df_cot_tratado.apply(lambda row: row["Fechamento_Equivalente"]*row["Num_acoes_equivalentes"], axis=1)
+    df_cot_tratado.insert(len(df_cot_tratado.columns), "Market_value", df_cot_tratado["Fechamento_Equivalente"]*df_cot_tratado["Num_acoes_equivalentes"])
 
     # Fonte
     df_cot_tratado.insert(len(df_cot_tratado.columns), "Fonte", "Comdinheiro")
@@ -377,6 +499,7 @@ def ajuste_cotacoes(df_cot, df_Tratar_por_Acao, df_eventos, Existe_eventos, Tick
 
 
 # %%
+@instrumentar()
 def ajuste_prov(df_prov, df_eventos, Existe_prov, Existe_eventos):
     
 
@@ -384,32 +507,69 @@ def ajuste_prov(df_prov, df_eventos, Existe_prov, Existe_eventos):
     if Existe_prov:
         ## Tratar o dataframe de proventos com os eventos
         df_prov_tratado = df_prov.copy()
-        df_prov_tratado.insert(0,"Provento_Efeitivo",0)
 
         ## Descontar imposto do JCP
-        df_prov_tratado.loc[:, "Provento_Efeitivo"] = \
-            df_prov_tratado.apply(lambda row: row["Valor_do_Provento"]*0.85 if row["Tipo_do_Provento"]=="JCP" else row["Valor_do_Provento"], axis=1)
+        df_prov_tratado.insert(0, "Provento_Efeitivo",
+            np.where(df_prov_tratado["Tipo_do_Provento"]=="JCP", df_prov_tratado["Valor_do_Provento"]*0.85, df_prov_tratado["Valor_do_Provento"]))
         
         if Existe_eventos:
-            datas_eventos = df_eventos.index
-            for data in datas_eventos:
-                
-                ## Fator do evento
-                condicao = (df_eventos.index == data)
-                fator_evento = df_eventos.loc[condicao,"Fator"].prod()
-
-                ## Condição para recalcular o Preço de Fechamento Histórico, no df_cot_tratado
-                condicao = df_prov_tratado.index <= data
-                ## Recalcular o número de ações equivalentes
-                df_prov_tratado.loc[condicao,"Provento_Efeitivo"] = df_prov_tratado.loc[condicao,"Provento_Efeitivo"]*fator_evento
+            ## Recalcular os proventos
+            fator_evento = fator_acumulado_eventos(df_eventos, df_prov_tratado.index)
+            df_prov_tratado["Provento_Efeitivo"] = df_prov_tratado["Provento_Efeitivo"]*fator_evento
 
         return df_prov_tratado
 
-
 # %% [markdown]
 # ## Múltiplos
 
 # %%
+def agregados_por_balanco(df_Tratar_por_Acao):
+    ## Cada Data_balanco distinta define o conjunto de balanços já publicados até ela.
+    ## Os agregados (último trimestre e últimos 4 trimestres) são calculados uma única vez
+    ## por balanço e depois associados às cotações por as-of
+    datas_balanco = df_Tratar_por_Acao["Data_balanco"].to_numpy(dtype="datetime64[ns]")
+    datas_publicacao = np.unique(datas_balanco)
+
+    ## Matriz (data de publicação x linha do df_Tratar_por_Acao) dos balanços disponíveis,
+    ## respeitando a ordem das linhas do df_Tratar_por_Acao (mais recente primeiro)
+    disponivel = datas_balanco[np.newaxis, :] <= datas_publicacao[:, np.newaxis]
+    ordem = np.cumsum(disponivel, axis=1)
+    posicao_primeiro = np.argmax(disponivel & (ordem == 1), axis=1)
+    ultimos_4 = (disponivel & (ordem <= 4))[:, :, np.newaxis]
+    ultimo_1 = (disponivel & (ordem == 1))[:, :, np.newaxis]
+
+    ## Valores do último balanço (sem tratar NaN)
+    colunas_ultimo = ["Div_liq", "Div_Arrendamento", "PL",
+                      "Prov_12meses", "Prov_24meses", "Prov_36meses", "Prov_48meses", "Prov_60meses"]
+    ## Somas dos últimos 4 e do último trimestre (NaN conta como zero)
+    colunas_4tri = ["RL", "EBITDA", "EBIT", "LL", "LL_controlador", "FCO", "FCI", "FCF"]
+    colunas_1tri = ["RL", "EBITDA", "EBIT", "LL", "LL_controlador",
+                    "Div_liq", "Div_Bruta", "Div_Arrendamento", "FCO", "FCI", "FCF"]
+
+    valores_4tri = np.nan_to_num(df_Tratar_por_Acao[colunas_4tri].to_numpy(dtype=float), nan=0.0, posinf=np.inf, neginf=-np.inf)
+    valores_1tri = np.nan_to_num(df_Tratar_por_Acao[colunas_1tri].to_numpy(dtype=float), nan=0.0, posinf=np.inf, neginf=-np.inf)
+
+    df_agregados = pd.DataFrame(index=pd.DatetimeIndex(datas_publicacao, name="Data_balanco"))
+    valores_ultimo = df_Tratar_por_Acao[colunas_ultimo].to_numpy(dtype=float)[posicao_primeiro]
+    for i, col in enumerate(colunas_ultimo):
+        df_agregados[col] = valores_ultimo[:, i]
+    soma_4tri = np.where(ultimos_4, valores_4tri[np.newaxis, :, :], 0.0).sum(axis=1)
+    for i, col in enumerate(colunas_4tri):
+        df_agregados[f"{col}_4tri"] = soma_4tri[:, i]
+    soma_1tri = np.where(ultimo_1, valores_1tri[np.newaxis, :, :], 0.0).sum(axis=1)
+    for i, col in enumerate(colunas_1tri):
+        df_agregados[f"{col}_1tri"] = soma_1tri[:, i]
+
+    return df_agregados
+
+# %%
+def divisao_multiplo(numerador, denominador):
+    ## Denominador zero resulta em múltiplo zero
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denominador != 0, numerador / denominador, 0)
+
+# %%
+@instrumentar()
 def multiplos_diarios(df_Tratar_por_Acao, df_cot_tratado, Ticker):
     # Coletando as datas de balanço e cotação
     data_cotacao = df_cot_tratado.index
@@ -417,135 +577,128 @@ def multiplos_diarios(df_Tratar_por_Acao, df_cot_tratado, Ticker):
     primeiro_balanco = data_balanco[-1]
     data_multiplos_diarios = data_cotacao[data_cotacao >= primeiro_balanco]
 
-    # Criando um DataFrame de múltiplos com as datas de balanço e cotação, Trimetre e Anual
-    df_multiplos_diarios_tri = pd.DataFrame(index=data_multiplos_diarios,
-    columns=["Num_acoes_equivalentes","Fechamento_Equivalente","Fech_Ajustado", 
+    # Colunas dos DataFrames de múltiplos, Trimestre e Anual
+    colunas_multiplos = ["Num_acoes_equivalentes","Fechamento_Equivalente","Fech_Ajustado",
              "Market_value", "EV", "EV_arrend",
             "PVPA","PSR","EV_EBITDA","EV_EBITDA_Arr","P_EBIT","PE", "PE_C",
             "FCO","FCI","FCF",
             "ROE", "Margem_liquida","Margem_EBITDA",
             "DIV_Bruta_PL","DIV_liq_EBITDA","DIV_Arrendamento_EBITDA",
-            'DY_12m', 'DY_24m', 'DY_36m', 'DY_48m', 'DY_60m', "DY_medio" ,"Fonte"])
+            'DY_12m', 'DY_24m', 'DY_36m', 'DY_48m', 'DY_60m', "DY_medio" ,"Fonte"]
 
-
-    ## Preenchendo os dados de cotação
-    df_multiplos_diarios_tri.insert(0, "Ticker", Ticker)
-    df_multiplos_diarios_tri.loc[:, "Fonte"] = "Comdinheiro"
+    ## Associar cada cotação ao último balanço publicado (as-of pela Data_balanco)
+    ## A última linha extra (NaN) é usada pelas cotações anteriores ao primeiro balanço publicado
+    df_agregados = agregados_por_balanco(df_Tratar_por_Acao)
+    posicao = np.searchsorted(df_agregados.index.values, data_multiplos_diarios.values, side="right") - 1
+    tem_balanco = posicao >= 0
+    valores_agregados = np.vstack([df_agregados.to_numpy(), np.full((1, len(df_agregados.columns)), np.nan)])
+    valores_agregados = valores_agregados[np.where(tem_balanco, posicao, len(df_agregados))]
+    agregados = {col: valores_agregados[:, i] for i, col in enumerate(df_agregados.columns)}
 
     # Preenchendo alguns valores
     lista_colunas = ["Num_acoes_equivalentes","Fechamento_Equivalente","Fech_Ajustado", "Market_value"]
-    df_multiplos_diarios_tri.loc[:, lista_colunas]\
-        = df_cot_tratado.loc[:, lista_colunas]
-
-    ## Criano o DF de múltiplos diários com os dados fundamentalistas anuais
+    df_cotacao = df_cot_tratado.loc[data_multiplos_diarios, lista_colunas]
+    Preco_equivalente = df_cotacao["Fechamento_Equivalente"].to_numpy(dtype=float)
+
+    ## EV = Market_value + Div_liq; Atenção que não foi considerado a dívida de arrendamento
+    EV = Preco_equivalente + agregados["Div_liq"]
+    EV_Arrend = EV + agregados["Div_Arrendamento"]
+
+    ## PVPA -> Preço / PL
+    PL = agregados["PL"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        PVPA = Preco_equivalente / PL
+
+    ## Dados Fundamentalistas de 1 ano
+    Receita_12meses = agregados["RL_4tri"]
+    EBITDA_12meses = agregados["EBITDA_4tri"]
+    EBIT_12meses = agregados["EBIT_4tri"]
+    LL_12meses = agregados["LL_4tri"]
+    LL_C_12meses = agregados["LL_controlador_4tri"]
+    Div_liq_12meses = agregados["Div_liq_1tri"]
+    Div_bruta_12meses = agregados["Div_Bruta_1tri"]
+    Div_liq_Arr_12meses = Div_liq_12meses + agregados["Div_Arrendamento_1tri"]
+    FCO_12meses = agregados["FCO_4tri"]
+    FCI_12meses = agregados["FCI_4tri"]
+    FCF_12meses = agregados["FCF_4tri"]
+
+    ## Dados Fundamentalistas de 3 meses
+    Receita_3meses = agregados["RL_1tri"]*4
+    EBITDA_3meses = agregados["EBITDA_1tri"]*4
+    EBIT_3meses = agregados["EBIT_1tri"]*4
+    LL_3meses = agregados["LL_1tri"]*4
+    LL_C_3meses = agregados["LL_controlador_1tri"]*4
+    Div_liq_3meses = Div_liq_12meses
+    Div_bruta_3meses = Div_bruta_12meses
+    Div_liq_Arr_3meses = Div_liq_Arr_12meses
+    FCO_3meses = agregados["FCO_1tri"]*4
+    FCI_3meses = agregados["FCI_1tri"]*4
+    FCF_3meses = agregados["FCF_1tri"]*4
+
+    # Criando os DataFrames de múltiplos com as datas de cotação, Trimestre e Anual
+    df_multiplos_diarios_tri = df_cotacao.reindex(columns=colunas_multiplos)
+    df_multiplos_diarios_tri["EV"] = EV
+    df_multiplos_diarios_tri["EV_arrend"] = EV_Arrend
+    df_multiplos_diarios_tri["PVPA"] = PVPA
     df_multiplos_diarios_anual = df_multiplos_diarios_tri.copy()
 
-    # Preenchendo os valores Absolutos
-    for data in data_multiplos_diarios:
-        condicao = df_Tratar_por_Acao.loc[:,"Data_balanco"] <= data
-        #print(data, condicao)
-        if condicao.sum()>0:
-            Preco_equivalente = df_multiplos_diarios_tri.loc[data,"Fechamento_Equivalente"]
-            ## EV = Market_value + Div_liq; Atenção que não foi considerado a dívida de arrendamento
-            EV = Preco_equivalente + df_Tratar_por_Acao.loc[condicao,"Div_liq"][0]
-            EV_Arrend = EV + df_Tratar_por_Acao.loc[condicao,"Div_Arrendamento"][0]
-
-            ## Atribuindo os valores de EV
-            df_multiplos_diarios_tri.loc[data,"EV"] = EV
-            df_multiplos_diarios_anual.loc[data,"EV"] = EV
-            df_multiplos_diarios_tri.loc[data,"EV_arrend"] = EV_Arrend
-            df_multiplos_diarios_anual.loc[data,"EV_arrend"] = EV_Arrend
-
-            ## PVPA -> Preço / PL
-            PL = df_Tratar_por_Acao.loc[condicao,"PL"][0]
-            PVPA = Preco_equivalente / PL
-            df_multiplos_diarios_tri.loc[data,"PVPA"] = PVPA
-            df_multiplos_diarios_anual.loc[data,"PVPA"] = PVPA
-
-
-            ## Dados Fundamentalistas de 1 ano
-            Receita_12meses = df_Tratar_por_Acao.loc[condicao,"RL"][:4].sum()
-            EBITDA_12meses = df_Tratar_por_Acao.loc[condicao,"EBITDA"][:4].sum()
-            EBIT_12meses = df_Tratar_por_Acao.loc[condicao,"EBIT"][:4].sum()
-            LL_12meses = df_Tratar_por_Acao.loc[condicao,"LL"][:4].sum()
-            LL_C_12meses = df_Tratar_por_Acao.loc[condicao,"LL_controlador"][:4].sum()
-            Div_liq_12meses = df_Tratar_por_Acao.loc[condicao,"Div_liq"][:1].sum()
-            Div_bruta_12meses = df_Tratar_por_Acao.loc[condicao,"Div_Bruta"][:1].sum()
-            Div_liq_Arr_12meses = Div_liq_12meses + df_Tratar_por_Acao.loc[condicao,"Div_Arrendamento"][:1].sum()
-            FCO_12meses = df_Tratar_por_Acao.loc[condicao,"FCO"][:4].sum()
-            FCI_12meses = df_Tratar_por_Acao.loc[condicao,"FCI"][:4].sum()
-            FCF_12meses = df_Tratar_por_Acao.loc[condicao,"FCF"][:4].sum()
-
-
-            ## Dados Fundamentalistas de 3 meses
-            Receita_3meses = df_Tratar_por_Acao.loc[condicao,"RL"][:1].sum()*4
-            EBITDA_3meses = df_Tratar_por_Acao.loc[condicao,"EBITDA"][:1].sum()*4
-            EBIT_3meses = df_Tratar_por_Acao.loc[condicao,"EBIT"][:1].sum()*4
-            LL_3meses = df_Tratar_por_Acao.loc[condicao,"LL"][:1].sum()*4
-            LL_C_3meses = df_Tratar_por_Acao.loc[condicao,"LL_controlador"][:1].sum()*4
-            Div_liq_3meses = Div_liq_12meses
-            Div_bruta_3meses = Div_bruta_12meses
-            Div_liq_Arr_3meses = Div_liq_Arr_12meses
-            FCO_3meses = df_Tratar_por_Acao.loc[condicao,"FCO"][:1].sum()*4
-            FCI_3meses = df_Tratar_por_Acao.loc[condicao,"FCI"][:1].sum()*4
-            FCF_3meses = df_Tratar_por_Acao.loc[condicao,"FCF"][:1].sum()*4
-
-            ## Registrando os dados de 1 ano
-            df_multiplos_diarios_anual.loc[data,"PSR"] = Preco_equivalente / Receita_12meses if Receita_12meses != 0 else 0
-            df_multiplos_diarios_anual.loc[data,"EV_EBITDA"] = EV / EBITDA_12meses if EBITDA_12meses != 0 else 0
-            df_multiplos_diarios_anual.loc[data,"EV_EBITDA_Arr"] = EV_Arrend / EBITDA_12meses if EBITDA_12meses != 0 else 0
-            df_multiplos_diarios_anual.loc[data,"P_EBIT"] = Preco_equivalente / EBIT_12meses if EBIT_12meses != 0 else 0
-            df_multiplos_diarios_anual.loc[data,"PE"] = Preco_equivalente / LL_12meses if LL_12meses != 0 else 0
-            df_multiplos_diarios_anual.loc[data,"PE_C"] = Preco_equivalente / LL_C_12meses if LL_C_12meses != 0 else 0
-            df_multiplos_diarios_anual.loc[data,"FCO"] = Preco_equivalente / FCO_12meses if FCO_12meses != 0 else 0
-            df_multiplos_diarios_anual.loc[data,"FCI"] = Preco_equivalente / FCI_12meses if FCI_12meses != 0 else 0
-            df_multiplos_diarios_anual.loc[data,"FCF"] = Preco_equivalente / FCF_12meses if FCF_12meses != 0 else 0
-            df_multiplos_diarios_anual.loc[data,"ROE"] = LL_12meses / PL if PL != 0 else 0
-            df_multiplos_diarios_anual.loc[data,"Margem_liquida"] = LL_12meses / Receita_12meses if Receita_12meses != 0 else 0
-            df_multiplos_diarios_anual.loc[data,"Margem_EBITDA"] = EBITDA_12meses / Receita_12meses if Receita_12meses != 0 else 0
-            df_multiplos_diarios_anual.loc[data,"DIV_Bruta_PL"] = Div_bruta_12meses / PL if PL != 0 else 0
-            df_multiplos_diarios_anual.loc[data,"DIV_liq_EBITDA"] = Div_liq_12meses / EBITDA_12meses if EBITDA_12meses != 0 else 0
-            df_multiplos_diarios_anual.loc[data,"DIV_Arrendamento_EBITDA"] = Div_liq_Arr_3meses / EBITDA_12meses if EBITDA_12meses != 0 else 0
-
-
-            ## Registrando os dados de 3 meses
-            df_multiplos_diarios_tri.loc[data,"PSR"] = Preco_equivalente / Receita_3meses if Receita_3meses != 0 else 0
-            df_multiplos_diarios_tri.loc[data,"EV_EBITDA"] = EV / EBITDA_3meses if EBITDA_3meses != 0 else 0
-            df_multiplos_diarios_tri.loc[data,"EV_EBITDA_Arr"] = EV_Arrend / EBITDA_3meses if EBITDA_3meses != 0 else 0
-            df_multiplos_diarios_tri.loc[data,"P_EBIT"] = Preco_equivalente / EBIT_3meses if EBIT_3meses != 0 else 0
-            df_multiplos_diarios_tri.loc[data,"PE"] = Preco_equivalente / LL_3meses if LL_3meses != 0 else 0
-            df_multiplos_diarios_tri.loc[data,"PE_C"] = Preco_equivalente / LL_C_3meses if LL_C_3meses != 0 else 0
-            df_multiplos_diarios_tri.loc[data,"FCO"] = Preco_equivalente / FCO_3meses if FCO_3meses != 0 else 0
-            df_multiplos_diarios_tri.loc[data,"FCI"] = Preco_equivalente / FCI_3meses if FCI_3meses != 0 else 0
-            df_multiplos_diarios_tri.loc[data,"FCF"] = Preco_equivalente / FCF_3meses if FCF_3meses != 0 else 0
-            df_multiplos_diarios_tri.loc[data,"ROE"] = LL_3meses / PL if PL != 0 else 0
-            df_multiplos_diarios_tri.loc[data,"Margem_liquida"] = LL_3meses / Receita_3meses if Receita_3meses != 0 else 0
-            df_multiplos_diarios_tri.loc[data,"Margem_EBITDA"] = EBITDA_3meses / Receita_3meses if Receita_3meses != 0 else 0
-            df_multiplos_diarios_tri.loc[data,"DIV_Bruta_PL"] = Div_bruta_3meses / PL if PL != 0 else 0
-            df_multiplos_diarios_tri.loc[data,"DIV_liq_EBITDA"] = Div_liq_3meses / EBITDA_3meses if EBITDA_3meses != 0 else 0
-            df_multiplos_diarios_tri.loc[data,"DIV_Arrendamento_EBITDA"] = Div_liq_Arr_3meses / EBITDA_3meses if EBITDA_3meses != 0 else 0
-            
-
-
-            ## Adicionar os proventos
-            df_multiplos_diarios_tri.loc[data, "DY_12m":"DY_60m"] = 0
-            # Proventos
-            Prov_1ano = df_Tratar_por_Acao.loc[condicao, "Prov_12meses"][0]
-            Prov_2ano = df_Tratar_por_Acao.loc[condicao, "Prov_24meses"][0]/2
-            Prov_3ano = df_Tratar_por_Acao.loc[condicao, "Prov_36meses"][0]/3
-            Prov_4ano = df_Tratar_por_Acao.loc[condicao, "Prov_48meses"][0]/4
-            Prov_5ano = df_Tratar_por_Acao.loc[condicao, "Prov_60meses"][0]/5
-
-            ## Salvando o DY médio
-
-            df_multiplos_diarios_anual.loc[data, "DY_12m"] = Prov_1ano/ Preco_equivalente
-            df_multiplos_diarios_anual.loc[data, "DY_24m"] = Prov_2ano/ (Preco_equivalente)
-            df_multiplos_diarios_anual.loc[data, "DY_36m"] = Prov_3ano/ (Preco_equivalente)
-            df_multiplos_diarios_anual.loc[data, "DY_48m"] = Prov_4ano/ (Preco_equivalente)
-            df_multiplos_diarios_anual.loc[data, "DY_60m"] = Prov_5ano/ (Preco_equivalente)
-
-            df_multiplos_diarios_anual.loc[data, "DY_medio"] = (Prov_2ano + Prov_3ano + Prov_4ano + Prov_5ano)/ (Preco_equivalente*4) ## Descartar o último ano para evitar distorções
+    ## Registrando os dados de 1 ano
+    df_multiplos_diarios_anual["PSR"] = divisao_multiplo(Preco_equivalente, Receita_12meses)
+    df_multiplos_diarios_anual["EV_EBITDA"] = divisao_multiplo(EV, EBITDA_12meses)
+    df_multiplos_diarios_anual["EV_EBITDA_Arr"] = divisao_multiplo(EV_Arrend, EBITDA_12meses)
+    df_multiplos_diarios_anual["P_EBIT"] = divisao_multiplo(Preco_equivalente, EBIT_12meses)
+    df_multiplos_diarios_anual["PE"] = divisao_multiplo(Preco_equivalente, LL_12meses)
+    df_multiplos_diarios_anual["PE_C"] = divisao_multiplo(Preco_equivalente, LL_C_12meses)
+    df_multiplos_diarios_anual["FCO"] = divisao_multiplo(Preco_equivalente, FCO_12meses)
+    df_multiplos_diarios_anual["FCI"] = divisao_multiplo(Preco_equivalente, FCI_12meses)
+    df_multiplos_diarios_anual["FCF"] = divisao_multiplo(Preco_equivalente, FCF_12meses)
+    df_multiplos_diarios_anual["ROE"] = divisao_multiplo(LL_12meses, PL)
+    df_multiplos_diarios_anual["Margem_liquida"] = divisao_multiplo(LL_12meses, Receita_12meses)
+    df_multiplos_diarios_anual["Margem_EBITDA"] = divisao_multiplo(EBITDA_12meses, Receita_12meses)
+    df_multiplos_diarios_anual["DIV_Bruta_PL"] = divisao_multiplo(Div_bruta_12meses, PL)
+    df_multiplos_diarios_anual["DIV_liq_EBITDA"] = divisao_multiplo(Div_liq_12meses, EBITDA_12meses)
+    df_multiplos_diarios_anual["DIV_Arrendamento_EBITDA"] = divisao_multiplo(Div_liq_Arr_3meses, EBITDA_12meses)
+
+    ## Registrando os dados de 3 meses
+    df_multiplos_diarios_tri["PSR"] = divisao_multiplo(Preco_equivalente, Receita_3meses)
+    df_multiplos_diarios_tri["EV_EBITDA"] = divisao_multiplo(EV, EBITDA_3meses)
+    df_multiplos_diarios_tri["EV_EBITDA_Arr"] = divisao_multiplo(EV_Arrend, EBITDA_3meses)
+    df_multiplos_diarios_tri["P_EBIT"] = divisao_multiplo(Preco_equivalente, EBIT_3meses)
+    df_multiplos_diarios_tri["PE"] = divisao_multiplo(Preco_equivalente, LL_3meses)
+    df_multiplos_diarios_tri["PE_C"] = divisao_multiplo(Preco_equivalente, LL_C_3meses)
+    df_multiplos_diarios_tri["FCO"] = divisao_multiplo(Preco_equivalente, FCO_3meses)
+    df_multiplos_diarios_tri["FCI"] = divisao_multiplo(Preco_equivalente, FCI_3meses)
+    df_multiplos_diarios_tri["FCF"] = divisao_multiplo(Preco_equivalente, FCF_3meses)
+    df_multiplos_diarios_tri["ROE"] = divisao_multiplo(LL_3meses, PL)
+    df_multiplos_diarios_tri["Margem_liquida"] = divisao_multiplo(LL_3meses, Receita_3meses)
+    df_multiplos_diarios_tri["Margem_EBITDA"] = divisao_multiplo(EBITDA_3meses, Receita_3meses)
+    df_multiplos_diarios_tri["DIV_Bruta_PL"] = divisao_multiplo(Div_bruta_3meses, PL)
+    df_multiplos_diarios_tri["DIV_liq_EBITDA"] = divisao_multiplo(Div_liq_3meses, EBITDA_3meses)
+    df_multiplos_diarios_tri["DIV_Arrendamento_EBITDA"] = divisao_multiplo(Div_liq_Arr_3meses, EBITDA_3meses)
 
+    ## Adicionar os proventos
+    df_multiplos_diarios_tri.loc[tem_balanco, "DY_12m":"DY_60m"] = 0
+    # Proventos
+    Prov_1ano = agregados["Prov_12meses"]
+    Prov_2ano = agregados["Prov_24meses"]/2
+    Prov_3ano = agregados["Prov_36meses"]/3
+    Prov_4ano = agregados["Prov_48meses"]/4
+    Prov_5ano = agregados["Prov_60meses"]/5
+
+    ## Salvando o DY médio
+    with np.errstate(divide="ignore", invalid="ignore"):
+        df_multiplos_diarios_anual["DY_12m"] = Prov_1ano/ Preco_equivalente
+        df_multiplos_diarios_anual["DY_24m"] = Prov_2ano/ (Preco_equivalente)
+        df_multiplos_diarios_anual["DY_36m"] = Prov_3ano/ (Preco_equivalente)
+        df_multiplos_diarios_anual["DY_48m"] = Prov_4ano/ (Preco_equivalente)
+        df_multiplos_diarios_anual["DY_60m"] = Prov_5ano/ (Preco_equivalente)
+
+        df_multiplos_diarios_anual["DY_medio"] = (Prov_2ano + Prov_3ano + Prov_4ano + Prov_5ano)/ (Preco_equivalente*4) ## Descartar o último ano para evitar distorções
+
+    ## Preenchendo os dados de identificação
+    for df_multiplos in [df_multiplos_diarios_tri, df_multiplos_diarios_anual]:
+        df_multiplos["Fonte"] = "Comdinheiro"
+        df_multiplos.insert(0, "Ticker", Ticker)
 
     return df_multiplos_diarios_tri, df_multiplos_diarios_anual
 
@@ -580,40 +733,105 @@ def CalculoCAGRnAnos(serie):
     return CAGR
 
 # %%
-def Func_CAGR(df_Tratar_por_Acao, Ticker):
-    df_CAGR = pd.DataFrame(columns=["Ticker","Fundamento","CAGR_1","CAGR_2","CAGR_4","CAGR_8"])
+def CAGR_janelas_moveis(datas, valores, Lista_anos_CAGR):
+    ## Inclinação da regressão log-linear (mesma de CalculoCAGRnAnos) para todas as datas,
+    ## todas as janelas e todos os fundamentos de uma só vez.
+    ## datas: DatetimeIndex; valores: matriz (datas x fundamentos)
+    ## Retorna uma matriz (datas x fundamentos x janelas) com o CAGR, na ordem de "datas"
+    ordem = np.argsort(datas.values, kind="stable")
+    datas_asc = datas.values[ordem]
+    valores_asc = np.asarray(valores, dtype=float)[ordem]
+    n_datas, n_fund = valores_asc.shape
+
+    ## Limites [inicio, fim) de cada janela na série ordenada
+    anos = np.asarray(Lista_anos_CAGR)
+    datas_inicio = np.array([[datetime(data.year - qtd_anos, data.month, data.day-10) for qtd_anos in anos]
+                             for data in pd.DatetimeIndex(datas_asc)], dtype="datetime64[ns]").reshape(n_datas, len(anos))
+    inicio = np.searchsorted(datas_asc, datas_inicio, side="left")
+    fim = np.searchsorted(datas_asc, datas_asc, side="right")[:, np.newaxis].repeat(len(anos), axis=1)
+    n = fim - inicio
+
+    ## Somas acumuladas para as janelas sem valores negativos
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_valores = np.log(valores_asc)
+    finito = np.isfinite(log_valores)
+    log_finito = np.where(finito, log_valores, 0.0)
+    posicao = np.arange(n_datas, dtype=float)[:, np.newaxis]
+    def acumulada(x):
+        return np.vstack([np.zeros((1, n_fund)), np.cumsum(x, axis=0)])
+    def soma_janela(acumulado):
+        return acumulado[fim] - acumulado[inicio]
+    qtd_negativos = soma_janela(acumulada(valores_asc < 0))
+    qtd_nao_negativos = soma_janela(acumulada(valores_asc >= 0))
+    qtd_nao_finitos = soma_janela(acumulada(~finito))
+    soma_y = soma_janela(acumulada(log_finito))
+    soma_xy = soma_janela(acumulada(posicao*log_finito)) - inicio[:, :, np.newaxis]*soma_y
+
+    ## Regressão de mínimos quadrados com x = 0, 1, ..., n-1
+    def inclinacao(n, soma_y, soma_xy):
+        soma_x = n*(n-1)/2
+        soma_xx = (n-1)*n*(2*n-1)/6
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (n*soma_xy - soma_x*soma_y)/(n*soma_xx - soma_x**2)
+    n_fundamentos = n[:, :, np.newaxis].astype(float)
+    expoente = inclinacao(n_fundamentos, soma_y, soma_xy)
+    expoente = np.where(qtd_nao_finitos > 0, np.nan, expoente)
+
+    ## Janelas com mínimo negativo: a série é deslocada em (máximo - mínimo)/2 antes do log
+    deslocadas = np.argwhere((qtd_negativos > 0) & (qtd_nao_negativos > 0))
+    if len(deslocadas):
+        i_data, i_janela, i_fund = deslocadas.T
+        tamanho = n[i_data, i_janela]
+        passo = np.arange(tamanho.max())
+        dentro = passo[np.newaxis, :] < tamanho[:, np.newaxis]
+        indices = np.minimum(inicio[i_data, i_janela][:, np.newaxis] + passo[np.newaxis, :], n_datas - 1)
+        serie = valores_asc[indices, i_fund[:, np.newaxis]]
+        maior_valor = np.nanmax(np.where(dentro, serie, np.nan), axis=1)
+        menor_valor = np.nanmin(np.where(dentro, serie, np.nan), axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_serie = np.log(serie + ((maior_valor - menor_valor)/2)[:, np.newaxis])
+        log_serie = np.where(dentro, log_serie, 0.0)
+        soma_y_desl = log_serie.sum(axis=1)
+        soma_xy_desl = (passo[np.newaxis, :]*log_serie).sum(axis=1)
+        expoente_desl = inclinacao(tamanho.astype(float), soma_y_desl, soma_xy_desl)
+        expoente_desl = np.where(np.isfinite(log_serie).all(axis=1), expoente_desl, np.nan)
+        expoente[i_data, i_janela, i_fund] = expoente_desl
+
+    CAGR = np.exp(expoente)**4 - 1
+    ## Maior valor menor que zero
+    CAGR = np.where((qtd_nao_negativos == 0) & (qtd_negativos > 0), -1.01, CAGR)
+    ## Janelas sem trimestres suficientes
+    CAGR = np.where(n[:, :, np.newaxis] >= anos[np.newaxis, :, np.newaxis]*4, CAGR, 0)
+
+    ## Voltar para a ordem original das datas, no formato (datas x fundamentos x janelas)
+    CAGR_ordem_original = np.empty_like(CAGR)
+    CAGR_ordem_original[ordem] = CAGR
+    return CAGR_ordem_original.transpose(0, 2, 1)
+
+# %%
+@instrumentar()
+def Func_CAGR(df_Tratar_por_Acao, Ticker, datas_novas=None):
+    ## Com datas_novas, calcula apenas as linhas dessas datas de balanço: só entra no cálculo o histórico
+    ## que cabe na maior janela (8 anos) da data nova mais antiga
     Lista_Fundamentos = ["RL", "EBITDA", "LL", "Proventos"]
     Lista_anos_CAGR = [1,2,4,8]
 
-    for fundamento in Lista_Fundamentos:
-        dados_fundamentalistas = df_Tratar_por_Acao.loc[:,fundamento]
-        dados_fundamentalistas = dados_fundamentalistas.copy()
-        df_CAGR_temp = pd.DataFrame(index=df_Tratar_por_Acao.index, columns=["Ticker","Fundamento","CAGR_1","CAGR_2","CAGR_4","CAGR_8"])
-        df_CAGR_temp.loc[:, "Ticker"] = Ticker
-        df_CAGR_temp.loc[:, "Fundamento"] = fundamento
-        for qtd_anos in Lista_anos_CAGR:
-            for data in df_Tratar_por_Acao.index:
-                ano = data.year
-                mes = data.month
-                dia = data.day
-                ## Data de início do corte
-                data_inicio = datetime(ano - qtd_anos, mes, dia-10)
-
-                condicao = (dados_fundamentalistas.index >= data_inicio) & \
-                (dados_fundamentalistas.index <= data)
-
-                ## Cálculo do CAGR
-                serie = dados_fundamentalistas.loc[condicao]
-                if len(serie) >= qtd_anos*4:
-                    CAGR = CalculoCAGRnAnos(serie)
-                else:
-                    CAGR = 0
-
-                ## Salvando os dados no df_CAGR
-                df_CAGR_temp.loc[data, f"CAGR_{qtd_anos}"] = CAGR
-
-        ##  Salvando os dados no df_CAGR
-        df_CAGR = pd.concat([df_CAGR, df_CAGR_temp], axis=0)
+    if datas_novas is not None:
+        limite = pd.DatetimeIndex(datas_novas).min() - pd.DateOffset(years=max(Lista_anos_CAGR), months=1)
+        df_Tratar_por_Acao = df_Tratar_por_Acao.loc[df_Tratar_por_Acao.index >= limite, :]
+
+    ## CAGR de todas as janelas e fundamentos
+    CAGR = CAGR_janelas_moveis(df_Tratar_por_Acao.index, df_Tratar_por_Acao.loc[:, Lista_Fundamentos].to_numpy(dtype=float), Lista_anos_CAGR)
+
+    lista_df_CAGR = []
+    for i, fundamento in enumerate(Lista_Fundamentos):
+        df_CAGR_temp = pd.DataFrame(CAGR[:, i, :], index=df_Tratar_por_Acao.index, columns=[f"CAGR_{qtd_anos}" for qtd_anos in Lista_anos_CAGR], dtype=np.float64)
+        df_CAGR_temp.insert(0, "Ticker", Ticker)
+        df_CAGR_temp.insert(1, "Fundamento", fundamento)
+        lista_df_CAGR.append(df_CAGR_temp)
+
+    ##  Salvando os dados no df_CAGR
+    df_CAGR = pd.concat(lista_df_CAGR, axis=0)
 
     ## Consertar os dados do CAGR do Provento
     df_CAGR.loc[df_CAGR["Fundamento"]=="Proventos", "CAGR_1":"CAGR_8"] = df_CAGR.loc[df_CAGR["Fundamento"]=="Proventos", "CAGR_1":"CAGR_8"].apply(lambda x: (1+x)**0.25-1)
@@ -628,16 +846,133 @@ def Func_CAGR(df_Tratar_por_Acao, Ticker):
 
     ## Calculando a média
     df_CAGR.loc[:, "CAGR_medio"] = df_CAGR.loc[:, "CAGR_2":"CAGR_8"].mean(axis=1)  ## Descartar o último ano para evitar distorções
+
+    if datas_novas is not None:
+        df_CAGR = df_CAGR.loc[df_CAGR.index.isin(datas_novas), :]
     return df_CAGR
 
+# %% [markdown]
+# ## Tipos das colunas dos dados tratados
+
+# %%
+## Colunas de texto que se repetem em todas as linhas, gravadas como categorias (codificadas por dicionário no parquet)
+COLUNAS_CATEGORICAS = ["Ticker", "Fonte", "Setor_Comdinheiro", "Fundamento"]
+## Múltiplos que podem ser gravados em float32 (razões e percentuais). Cotações, número de ações e valores
+## absolutos continuam em float64, pois acumulam erro em float32. No modo incremental, as colunas em float32
+## são comparadas depois de convertidas para float32 (ver historico_alterado)
+COLUNAS_FLOAT32 = ["PVPA","PSR","EV_EBITDA","EV_EBITDA_Arr","P_EBIT","PE", "PE_C",
+                   "ROE", "Margem_liquida","Margem_EBITDA",
+                   "DIV_Bruta_PL","DIV_liq_EBITDA","DIV_Arrendamento_EBITDA",
+                   'DY_12m', 'DY_24m', 'DY_36m', 'DY_48m', 'DY_60m', "DY_medio"]
+
+# %%
+def tipar_tratados(df, float32=False):
+    ## Esquema explícito dos dados tratados: as colunas de COLUNAS_CATEGORICAS viram categorias, as demais
+    ## colunas object que só contêm números viram float64 e, com float32=True, as colunas de COLUNAS_FLOAT32
+    ## são gravadas em float32
+    tipos = {}
+    for col in df.columns:
+        if col in COLUNAS_CATEGORICAS:
+            tipos[col] = "category"
+        elif df[col].dtype == object:
+            numeros = pd.to_numeric(df[col], errors="coerce")
+            if numeros.notna().sum() == df[col].notna().sum():
+                tipos[col] = np.float64
+        if float32 and col in COLUNAS_FLOAT32:
+            tipos[col] = np.float32
+    return df.astype(tipos)
+
+# %% [markdown]
+# ## Dataset particionado
+
+# %%
+def salvar_particionado(df, tabela, Ticker):
+    ## Salva a partição do ativo no dataset da tabela, ordenada pela data (coluna "Data", o índice)
+    ## em grupos de linhas de um ano de pregões, para que o leitor filtre as datas pelas estatísticas.
+    ## O Ticker fica no caminho da partição; a coluna "Posicao" guarda a ordem original das linhas
+    df_particao = df.drop(columns="Ticker").rename_axis("Data").reset_index()
+    df_particao.insert(1, "Posicao", np.arange(len(df_particao)))
+    df_particao = df_particao.sort_values("Data", kind="stable")
+
+    pasta_particao = endereco_particionado(tabela, Ticker)
+    os.makedirs(pasta_particao, exist_ok=True)
+    arquivo_particao = os.path.join(pasta_particao, "parte-0.parquet")
+    arquivo_temporario = f"{arquivo_particao}.{os.getpid()}.tmp"
+    pq.write_table(pa.Table.from_pandas(df_particao, preserve_index=False), arquivo_temporario,
+                   row_group_size=252, write_statistics=True)
+    os.replace(arquivo_temporario, arquivo_particao)
+
+# %% [markdown]
+# ## Modo incremental
+
+# %%
+@instrumentar()
+def ler_dados_tratados(Ticker):
+    ## Lê os arquivos já tratados do ativo. Retorna None se algum deles ainda não existir
+    arquivos = endereco_tratados(Ticker)
+    if not all(os.path.exists(arquivo) for arquivo in arquivos):
+        return None
+    ## O fastparquet grava o índice sem nome como "index": volta sem nome, como nos dados recém-tratados
+    lista_df = [pd.read_parquet(arquivo) for arquivo in arquivos]
+    return [df.rename_axis(None) if df.index.name == "index" else df for df in lista_df]
+
+# %%
+def historico_alterado(df_Tratar_por_Acao, df_cot_tratado, df_acao_anterior, df_multiplos_anterior, float32=False):
+    ## Verifica se os dados brutos atuais alteram o histórico já tratado, o que exige recalcular tudo:
+    ## - balanço reapresentado, removido ou com outras colunas (inclui a renormalização por um evento novo);
+    ## - balanço novo publicado (Data_balanco) antes da última cotação tratada;
+    ## - cotação equivalente ou ajustada da última data tratada diferente (evento ou provento novo).
+    if len(df_multiplos_anterior) == 0 or not df_Tratar_por_Acao.index.is_unique:
+        return True
+    if list(df_acao_anterior.columns) != list(df_Tratar_por_Acao.columns):
+        return True
+    if not df_acao_anterior.index.isin(df_Tratar_por_Acao.index).all():
+        return True
+
+    ## Balanços já tratados, com os tipos em que foram gravados (as colunas em float32 são comparadas já
+    ## arredondadas para float32, senão a diferença de precisão sempre apontaria histórico alterado)
+    df_atual = tipar_tratados(df_Tratar_por_Acao.loc[df_acao_anterior.index, :].replace([np.inf, -np.inf], np.nan), float32)
+    for col in df_atual.columns:
+        if pd.api.types.is_datetime64_any_dtype(df_atual[col]):
+            atual = df_atual[col].to_numpy(dtype="datetime64[ns]").astype(np.int64)
+            anterior = df_acao_anterior[col].to_numpy(dtype="datetime64[ns]").astype(np.int64)
+            if not np.array_equal(atual, anterior):
+                return True
+        elif pd.api.types.is_numeric_dtype(df_atual[col]):
+            if not np.allclose(df_atual[col].to_numpy(dtype=float), df_acao_anterior[col].to_numpy(dtype=float), rtol=1e-10, atol=0, equal_nan=True):
+                return True
+
+    ## Balanços novos
+    ultima_cotacao = df_multiplos_anterior.index.max()
+    balancos_novos = df_Tratar_por_Acao.loc[~df_Tratar_por_Acao.index.isin(df_acao_anterior.index), "Data_balanco"]
+    if (balancos_novos <= ultima_cotacao).any():
+        return True
+
+    ## Cotação da última data tratada
+    lista_colunas = ["Num_acoes_equivalentes", "Fechamento_Equivalente", "Fech_Ajustado"]
+    cotacao_atual = df_cot_tratado.loc[df_cot_tratado.index == ultima_cotacao, lista_colunas].to_numpy(dtype=float)
+    cotacao_anterior = df_multiplos_anterior.loc[df_multiplos_anterior.index == ultima_cotacao, lista_colunas].to_numpy(dtype=float)
+    if cotacao_atual.shape != cotacao_anterior.shape:
+        return True
+    if not np.allclose(cotacao_atual, cotacao_anterior, rtol=1e-10, atol=0, equal_nan=True):
+        return True
+
+    return False
+
 # %% [markdown]
 # ## Função para tratar dados diários
 
 # %%
-def Tratar_dados_diarios(Ticker):
+@instrumentar()
+def Tratar_dados_diarios(Ticker, incremental=False, float32=False):
+    ## Com incremental=True, aproveita os arquivos já tratados: calcula os múltiplos apenas das cotações
+    ## posteriores à última cotação tratada e o CAGR apenas dos balanços novos.
+    ## Se o histórico tiver mudado (ver historico_alterado), recalcula tudo.
+    ## Os arquivos são gravados com o esquema de tipar_tratados; float32=True grava os múltiplos em float32.
     ## Endereço dos arquivos
     arquivo_Fund, arquivo_Cot, arquivo_Prov, arquivo_Eventos, \
         arquivo_Subscricao = endereco_arquivos(Ticker)
+    arquivo_por_acao, arquivo_multiplos, arquivo_CAGR = endereco_tratados(Ticker)
     
     print(f"Entrou em {Ticker}")
     ## Verificando a classe da ação
@@ -668,54 +1003,257 @@ def Tratar_dados_diarios(Ticker):
     ## Ajustar os proventos
     df_prov_tratado = ajuste_prov(df_prov, df_eventos, Existe_prov, Existe_eventos)
 
-    ## Multiplos diários
-    df_multiplos_diarios_tri, df_multiplos_diarios_anual = multiplos_diarios(df_Tratar_por_Acao, df_cot_tratado, Ticker)
+    ## Dados já tratados, se o histórico não mudou
+    dados_anteriores = ler_dados_tratados(Ticker) if incremental else None
+    if dados_anteriores is not None and historico_alterado(df_Tratar_por_Acao, df_cot_tratado, dados_anteriores[0], dados_anteriores[1], float32):
+        print(f"Histórico de {Ticker} alterado, recalculando tudo")
+        dados_anteriores = None
 
-    ## CAGR
-    df_CAGR = Func_CAGR(df_Tratar_por_Acao, Ticker)
+    if dados_anteriores is None:
+        ## Multiplos diários
+        df_multiplos_diarios_tri, df_multiplos_diarios_anual = multiplos_diarios(df_Tratar_por_Acao, df_cot_tratado, Ticker)
 
-    ### Salvar os arquivos em parquet
-    # Salvar Fundamentos
-    nome_arquivo = f"Dados_normalizados_acao_{Ticker}.parquet"
-    arquivo_por_acao = os.path.join("..","..","..","dataset", "BR", "ACOES", "Dados_Tratados",nome_arquivo)
-    # Substitua os valores infinitos por NaN (ou qualquer outro valor desejado)
-    df_Tratar_por_Acao.replace([np.inf, -np.inf], np.nan, inplace=True)
-    df_Tratar_por_Acao.to_parquet(arquivo_por_acao, engine='fastparquet')
+        ## CAGR
+        df_CAGR = Func_CAGR(df_Tratar_por_Acao, Ticker)
+    else:
+        df_acao_anterior, df_multiplos_anterior, df_CAGR_anterior = dados_anteriores
+
+        ## Multiplos diários apenas das cotações novas
+        ultima_cotacao = df_multiplos_anterior.index.max()
+        df_cot_novo = df_cot_tratado.loc[df_cot_tratado.index > ultima_cotacao, :]
+        df_multiplos_diarios_tri, df_multiplos_novo = multiplos_diarios(df_Tratar_por_Acao, df_cot_novo, Ticker)
+        if len(df_multiplos_novo) == 0:
+            df_multiplos_diarios_anual = df_multiplos_anterior
+        else:
+            df_multiplos_diarios_anual = pd.concat([df_multiplos_novo, df_multiplos_anterior], axis=0)
 
-    ## Salvar Múltiplos diários
-    nome_arquivo = f"Multiplos_diarios_{Ticker}.parquet"
-    arquivo_multiplos = os.path.join("..","..","..","dataset", "BR", "ACOES", "Dados_Tratados",nome_arquivo)
-    # Substitua os valores infinitos por NaN (ou qualquer outro valor desejado)
-    df_multiplos_diarios_anual.replace([np.inf, -np.inf], np.nan, inplace=True)
-    df_multiplos_diarios_anual.to_parquet(arquivo_multiplos, engine='fastparquet')
+        ## CAGR apenas dos balanços novos, mantendo o arquivo agrupado por fundamento
+        datas_novas = df_Tratar_por_Acao.index[~df_Tratar_por_Acao.index.isin(df_acao_anterior.index)]
+        if len(datas_novas) == 0:
+            df_CAGR = df_CAGR_anterior
+        else:
+            df_CAGR_novo = Func_CAGR(df_Tratar_por_Acao, Ticker, datas_novas)
+            Lista_Fundamentos = pd.unique(df_CAGR_novo["Fundamento"])
+            df_CAGR = pd.concat([df_CAGR_novo, df_CAGR_anterior], axis=0)
+            ordem_fundamento = pd.Categorical(df_CAGR["Fundamento"], categories=Lista_Fundamentos).codes
+            df_CAGR = df_CAGR.iloc[np.argsort(ordem_fundamento, kind="stable"), :]
 
-    ## Salvar o CAGR
-    nome_arquivo = f"CAGR_{Ticker}.parquet"
-    arquivo_CAGR = os.path.join("..","..","..","dataset", "BR", "ACOES", "Dados_Tratados",nome_arquivo)
-    # Substitua os valores infinitos por NaN (ou qualquer outro valor desejado)
-    df_CAGR.replace([np.inf, -np.inf], np.nan, inplace=True)
-    df_CAGR.to_parquet(arquivo_CAGR, engine='fastparquet')
+    ### Salvar os arquivos em parquet
+    with etapa("salvar_parquet") as registro:
+        # Salvar Fundamentos
+        # Substitua os valores infinitos por NaN (ou qualquer outro valor desejado)
+        df_Tratar_por_Acao.replace([np.inf, -np.inf], np.nan, inplace=True)
+        df_Tratar_por_Acao = tipar_tratados(df_Tratar_por_Acao, float32)
+        df_Tratar_por_Acao.to_parquet(arquivo_por_acao, engine='fastparquet')
+
+        ## Salvar Múltiplos diários
+        # Substitua os valores infinitos por NaN (ou qualquer outro valor desejado)
+        df_multiplos_diarios_anual.replace([np.inf, -np.inf], np.nan, inplace=True)
+        df_multiplos_diarios_anual = tipar_tratados(df_multiplos_diarios_anual, float32)
+        df_multiplos_diarios_anual.to_parquet(arquivo_multiplos, engine='fastparquet')
+
+        ## Salvar o CAGR
+        # Substitua os valores infinitos por NaN (ou qualquer outro valor desejado)
+        df_CAGR.replace([np.inf, -np.inf], np.nan, inplace=True)
+        df_CAGR = tipar_tratados(df_CAGR, float32)
+        df_CAGR.to_parquet(arquivo_CAGR, engine='fastparquet')
+
+        ## Salvar as partições do ativo nos datasets de cada tabela
+        salvar_particionado(df_Tratar_por_Acao, "Dados_normalizados_acao", Ticker)
+        salvar_particionado(df_multiplos_diarios_anual, "Multiplos_diarios", Ticker)
+        salvar_particionado(df_CAGR, "CAGR", Ticker)
+        registro.linhas(saida=[df_Tratar_por_Acao, df_multiplos_diarios_anual, df_CAGR])
 
     
     return df_Tratar_por_Acao, df_multiplos_diarios_anual, df_CAGR
 
 # %% [markdown]
-# ### Lendo os arquivos dos dados Brutos
+# ## Manifesto do tratamento
 
 # %%
-## Ler os ativos que serão buscados
-arquivo_busca = os.path.join("..","..","..","dataset", "BR", "ACOES", "Dados_Brutos","Lista_Ativos_Busca.parquet")
-Lista_ativos_busca = pd.read_parquet(arquivo_busca)
-Lista_ativos_busca = Lista_ativos_busca["Ticker"].to_list()
-Lista_ativos_busca.sort()
-Lista_ativos_nao_deu_certo = []
+def versao_tratamento():
+    ## Versão do código do tratamento: hash deste arquivo. Qualquer mudança no código invalida o manifesto.
+    ## Fora de um arquivo (por exemplo, no notebook) não há versão, e nenhum ativo é aproveitado do manifesto
+    try:
+        with open(__file__, "rb") as arquivo:
+            return hashlib.sha256(arquivo.read()).hexdigest()
+    except NameError:
+        return None
 
-for Ticker in Lista_ativos_busca:
+# %%
+def hash_arquivo(arquivo):
+    ## Hash do conteúdo do arquivo; None se o arquivo não existir
+    if not os.path.exists(arquivo):
+        return None
+    hash_conteudo = hashlib.sha256()
+    with open(arquivo, "rb") as f:
+        for bloco in iter(lambda: f.read(1 << 20), b""):
+            hash_conteudo.update(bloco)
+    return hash_conteudo.hexdigest()
+
+# %%
+def hash_entradas(Ticker):
+    ## Hash dos cinco arquivos brutos do ativo
+    Lista_entradas = ["Fund", "Cot", "Prov", "Eventos", "Subscricao"]
+    return {entrada: hash_arquivo(arquivo) for entrada, arquivo in zip(Lista_entradas, endereco_arquivos(Ticker))}
+
+# %%
+def endereco_manifesto():
+    return os.path.join(DIRETORIO_DATASET, "BR", "ACOES", "Dados_Tratados","Manifesto_tratamento.json")
+
+# %%
+def ler_manifesto():
+    ## Manifesto por Ticker: hash das entradas brutas e versão do código que geraram os Dados_Tratados
+    arquivo_manifesto = endereco_manifesto()
+    if not os.path.exists(arquivo_manifesto):
+        return {}
+    with open(arquivo_manifesto, "r", encoding="utf-8") as arquivo:
+        return json.load(arquivo)
+
+# %%
+def salvar_manifesto(manifesto):
+    ## Grava em um arquivo temporário e troca, para não deixar um manifesto pela metade
+    arquivo_manifesto = endereco_manifesto()
+    with open(arquivo_manifesto + ".tmp", "w", encoding="utf-8") as arquivo:
+        json.dump(manifesto, arquivo, indent=1, sort_keys=True)
+    os.replace(arquivo_manifesto + ".tmp", arquivo_manifesto)
+
+# %%
+def ativo_inalterado(Ticker, manifesto, versao, entradas):
+    ## O ativo pode ser pulado se as entradas e a versão do código são as do manifesto
+    ## e os arquivos tratados ainda existem
+    registro = manifesto.get(Ticker)
+    if versao is None or registro is None:
+        return False
+    if registro.get("Versao") != versao or registro.get("Entradas") != entradas:
+        return False
+    return all(os.path.exists(arquivo) for arquivo in endereco_tratados(Ticker))
+
+# %% [markdown]
+# ## Processamento do universo de ativos
+
+# %%
+def tratar_ativo(Ticker, timeout=None, incremental=False, float32=False):
+    ## Trata um ativo e devolve a sua linha do relatório do universo
+    ## O timeout (em segundos) é aplicado dentro do processo que trata o ativo, com um único SIGALRM,
+    ## desarmado no finally. Um ativo que termina depois do tempo limite também fica com o status "timeout",
+    ## mesmo sem SIGALRM (Windows) ou se o alarme tiver sido engolido: o seu resultado não é confiável
+    ## e ele não entra no manifesto.
+    linha = {"Ticker": Ticker, "Status": "ok", "Tempo": np.nan,
+             "Linhas_acao": 0, "Linhas_multiplos": 0, "Linhas_CAGR": 0,
+             "Erro": None, "Traceback": None}
+    usar_alarme = timeout is not None and hasattr(signal, "SIGALRM")
+    inicio = time.perf_counter()
     try:
-        df_Tratar_por_Acao, df_multiplos_diarios_anual, df_CAGR = Tratar_dados_diarios(Ticker)
-        print(f"Deu certo {Ticker}")
-    except:
-        print(f"Não deu certo {Ticker}")
-        Lista_ativos_nao_deu_certo.append(Ticker)
+        try:
+            if usar_alarme:
+                signal.signal(signal.SIGALRM, _estourou_tempo)
+                signal.setitimer(signal.ITIMER_REAL, timeout)
+            df_Tratar_por_Acao, df_multiplos_diarios_anual, df_CAGR = Tratar_dados_diarios(Ticker, incremental, float32)
+        finally:
+            ## O alarme dispara uma única vez: se disparar aqui, antes de ser desarmado, a exceção vai para o
+            ## except TempoEsgotado abaixo e não há um segundo disparo
+            if usar_alarme:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        if timeout is not None and time.perf_counter() - inicio > timeout:
+            raise TempoEsgotado("Tempo limite do ativo esgotado")
+        linha["Linhas_acao"] = len(df_Tratar_por_Acao)
+        linha["Linhas_multiplos"] = len(df_multiplos_diarios_anual)
+        linha["Linhas_CAGR"] = len(df_CAGR)
+    except TempoEsgotado as erro:
+        linha["Status"] = "timeout"
+        linha["Erro"] = repr(erro)
+    except Exception as erro:
+        linha["Status"] = "erro"
+        linha["Erro"] = repr(erro)
+        linha["Traceback"] = traceback.format_exc()
+    linha["Tempo"] = time.perf_counter() - inicio
+
+    return linha
+
+# %%
+def tratar_universo(Lista_ativos, n_processos=None, timeout=None, incremental=False, forcar=False, float32=False,
+                    diretorio_dataset=None):
+    ## Trata os ativos em paralelo, em um pool de processos com n_processos (padrão: número de CPUs).
+    ## Com n_processos=1 os ativos são tratados em sequência, no próprio processo.
+    ## diretorio_dataset troca a pasta do dataset (ver definir_diretorio_dataset), também nos processos do pool.
+    ## Ativos cujas entradas brutas e versão do código não mudaram desde o último tratamento (ver o
+    ## manifesto) são pulados com o status "cache"; com forcar=True todos os ativos são tratados.
+    ## O modo float32 faz parte da versão gravada no manifesto: mudar o modo trata os ativos de novo.
+    ## Retorna um DataFrame, indexado pelo Ticker, com o status ("ok", "cache", "erro" ou "timeout"),
+    ## o tempo gasto, o número de linhas de cada arquivo tratado e o erro capturado de cada ativo
+    if diretorio_dataset is not None:
+        definir_diretorio_dataset(diretorio_dataset)
+    manifesto = ler_manifesto()
+    versao = versao_tratamento()
+    if float32 and versao is not None:
+        versao = f"{versao}:float32"
+    entradas = {Ticker: hash_entradas(Ticker) for Ticker in Lista_ativos}
+
+    linhas = {}
+    Lista_tratar = []
+    for Ticker in Lista_ativos:
+        if not forcar and ativo_inalterado(Ticker, manifesto, versao, entradas[Ticker]):
+            linhas[Ticker] = {"Ticker": Ticker, "Status": "cache", "Tempo": 0.0,
+                              "Linhas_acao": 0, "Linhas_multiplos": 0, "Linhas_CAGR": 0,
+                              "Erro": None, "Traceback": None}
+        else:
+            Lista_tratar.append(Ticker)
+    print(f"Manifesto: {len(Lista_ativos) - len(Lista_tratar)} ativos sem alteração, {len(Lista_tratar)} a tratar")
+
+    if n_processos == 1:
+        for Ticker in Lista_tratar:
+            linhas[Ticker] = tratar_ativo(Ticker, timeout, incremental, float32)
+            print(f"Deu certo {Ticker}" if linhas[Ticker]["Status"] == "ok" else f"Não deu certo {Ticker}")
+    elif Lista_tratar:
+        with ProcessPoolExecutor(max_workers=n_processos, initializer=definir_diretorio_dataset,
+                                 initargs=(DIRETORIO_DATASET,)) as executor:
+            futuros = {executor.submit(tratar_ativo, Ticker, timeout, incremental, float32): Ticker for Ticker in Lista_tratar}
+            for futuro in as_completed(futuros):
+                Ticker = futuros[futuro]
+                try:
+                    linhas[Ticker] = futuro.result()
+                except Exception as erro:
+                    ## Falha do próprio processo (por exemplo, falta de memória)
+                    linhas[Ticker] = {"Ticker": Ticker, "Status": "erro", "Tempo": np.nan,
+                                      "Linhas_acao": 0, "Linhas_multiplos": 0, "Linhas_CAGR": 0,
+                                      "Erro": repr(erro), "Traceback": None}
+                print(f"Deu certo {Ticker}" if linhas[Ticker]["Status"] == "ok" else f"Não deu certo {Ticker}")
+
+    ## Atualizar o manifesto com os ativos tratados; os que falharam saem do manifesto
+    for Ticker in Lista_tratar:
+        if linhas[Ticker]["Status"] == "ok":
+            manifesto[Ticker] = {"Versao": versao, "Entradas": entradas[Ticker]}
+        else:
+            manifesto.pop(Ticker, None)
+    salvar_manifesto(manifesto)
 
+    df_relatorio = pd.DataFrame([linhas[Ticker] for Ticker in Lista_ativos],
+                                columns=["Ticker", "Status", "Tempo", "Linhas_acao", "Linhas_multiplos", "Linhas_CAGR", "Erro", "Traceback"])
+    df_relatorio.set_index("Ticker", inplace=True)
+    return df_relatorio
 
+# %%
+def ler_lista_ativos_busca():
+    ## Ativos do universo, em ordem alfabética
+    arquivo_busca = os.path.join(DIRETORIO_DATASET, "BR", "ACOES", "Dados_Brutos","Lista_Ativos_Busca.parquet")
+    Lista_ativos_busca = pd.read_parquet(arquivo_busca)["Ticker"].to_list()
+    Lista_ativos_busca.sort()
+    return Lista_ativos_busca
+
+# %%
+def ativos_alterados_desde(Lista_ativos, data):
+    ## Ativos com algum arquivo bruto modificado a partir da data
+    limite = time.mktime(pd.Timestamp(data).timetuple())
+    return [Ticker for Ticker in Lista_ativos
+            if any(os.path.exists(arquivo) and os.path.getmtime(arquivo) >= limite for arquivo in endereco_arquivos(Ticker))]
+
+# %% [markdown]
+# ### Lendo os arquivos dos dados Brutos
+
+# %%
+if __name__ == "__main__":
+    ## Tratamento de todo o universo, com as opções padrão do executar_tratamento
+    ## (python -m modules.Colher_tratar_dados.Dados_Fund.executar_tratamento --help)
+    from modules.Colher_tratar_dados.Dados_Fund.executar_tratamento import main
+    main(["--dataset", DIRETORIO_DATASET])
@@ -0,0 +1,75 @@
+import os
+import sys
+import argparse
+
+## Ponto de entrada do tratamento em lote dos dados brutos (Tratar_dados.py é a biblioteca, sem efeitos na importação).
+##
+## Uso:
+## python -m modules.Colher_tratar_dados.Dados_Fund.executar_tratamento --dataset dataset --tickers PETR4 VALE3 --workers 8
+## python -m modules.Colher_tratar_dados.Dados_Fund.executar_tratamento --since 2024-01-01
+
+## Raiz do repositório no sys.path, para executar também como script
+RAIZ_REPO = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+if RAIZ_REPO not in sys.path:
+    sys.path.insert(0, RAIZ_REPO)
+
+from modules.Colher_tratar_dados.Dados_Fund.Tratar_dados import (definir_diretorio_dataset, ler_lista_ativos_busca,
+                                                                 ativos_alterados_desde, tratar_universo)
+from modules.Colher_tratar_dados.instrumentacao import ativar_instrumentacao, resumo_instrumentacao
+
+
+def argumentos(argv=None):
+    parser = argparse.ArgumentParser(description="Tratamento dos dados brutos das ações (Dados_Brutos -> Dados_Tratados)")
+    parser.add_argument("--dataset", default=os.path.join(RAIZ_REPO, "dataset"),
+                        help="Pasta do dataset, com BR/ACOES/Dados_Brutos (padrão: dataset na raiz do repositório)")
+    parser.add_argument("--tickers", nargs="+", default=None,
+                        help="Ativos a tratar (padrão: todos de Lista_Ativos_Busca)")
+    parser.add_argument("--since", default=None,
+                        help="Trata apenas os ativos com algum arquivo bruto modificado a partir desta data (AAAA-MM-DD)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Número de processos (padrão: número de CPUs; 1 trata em sequência)")
+    parser.add_argument("--timeout", type=float, default=30*60, help="Tempo limite por ativo, em segundos (padrão: 1800)")
+    parser.add_argument("--completo", action="store_true",
+                        help="Recalcula todo o histórico, sem aproveitar os arquivos já tratados")
+    parser.add_argument("--forcar", action="store_true",
+                        help="Trata também os ativos sem alteração desde o último tratamento (ver o manifesto)")
+    parser.add_argument("--float32", action="store_true", help="Grava os múltiplos em float32")
+    parser.add_argument("--instrumentacao", default=None,
+                        help="Log JSON-lines com o tempo de cada etapa e ativo; mostra as etapas e ativos mais lentos no fim")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    ## Retorna o relatório do tratar_universo; o código de saída do script é 1 se algum ativo falhou
+    args = argumentos(argv)
+    definir_diretorio_dataset(args.dataset)
+
+    Lista_ativos = args.tickers if args.tickers is not None else ler_lista_ativos_busca()
+    if args.since is not None:
+        Lista_ativos = ativos_alterados_desde(Lista_ativos, args.since)
+        print(f"{len(Lista_ativos)} ativos com arquivos brutos modificados desde {args.since}")
+
+    if args.instrumentacao is not None:
+        ativar_instrumentacao(args.instrumentacao)
+
+    df_relatorio = tratar_universo(Lista_ativos, n_processos=args.workers, timeout=args.timeout,
+                                   incremental=not args.completo, forcar=args.forcar, float32=args.float32,
+                                   diretorio_dataset=args.dataset)
+
+    Lista_ativos_nao_deu_certo = df_relatorio.index[~df_relatorio["Status"].isin(["ok", "cache"])].to_list()
+    print(df_relatorio["Status"].value_counts().to_string())
+    if Lista_ativos_nao_deu_certo:
+        print(f"Não deu certo: {Lista_ativos_nao_deu_certo}")
+
+    ## Etapas e ativos mais lentos
+    if args.instrumentacao is not None and os.path.exists(args.instrumentacao):
+        df_etapas, df_ativos_lentos, df_chamadas_lentas = resumo_instrumentacao(arquivo=args.instrumentacao)
+        print(df_etapas)
+        print(df_ativos_lentos)
+
+    return df_relatorio
+
+
+if __name__ == "__main__":
+    df_relatorio = main()
+    sys.exit(1 if (~df_relatorio["Status"].isin(["ok", "cache"])).any() else 0)
@@ -0,0 +1,263 @@
+import pandas as pd
+from datetime import datetime
+import os
+import json
+import time
+from contextlib import contextmanager
+import pyarrow as pa
+import pyarrow.feather as feather
+from modules.Colher_tratar_dados.load_data import (ler_indice_elegibilidade, ler_acoes, ler_selic, ler_expectativa_selic,
+                                                   arquivos_acao, tipar_lidos)
+
+## fcntl só existe em sistemas Unix: sem ele, a trava da construção é um arquivo criado com O_EXCL
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+## Cache Arrow dos Dados Tratados: um arquivo Feather (Arrow IPC sem compressão, em um único bloco) por tabela,
+## com os ativos do universo em sequência, mais as séries da Selic. Os arquivos são abertos com mapeamento de memória
+## e as colunas numéricas e de datas dos DataFrames devolvidos são visões do mapeamento, sem cópia: as páginas ficam
+## uma única vez no cache do sistema operacional, compartilhadas por todos os processos que abrem o cache.
+## O manifesto guarda a assinatura (data de modificação e tamanho) dos arquivos de origem; o cache é reconstruído
+## quando algum deles muda. A construção é feita sob uma trava exclusiva entre processos (ver _trava_construcao)
+
+PASTA_CACHE = os.path.join("dataset", "BR", "ACOES", "Dados_Tratados", "Cache_Arrow")
+TABELAS_ACOES = ["Dados_normalizados_acao", "Multiplos_diarios", "CAGR"]
+ARQUIVOS_SERIES = {"Selic": os.path.join("dataset", "BR", "Selic", "Selic.parquet"),
+                   "Expectativa_Selic": os.path.join("dataset", "BR", "Selic", "Expectativa_Selic_Diaria.parquet")}
+ARQUIVO_ELEGIVEL = os.path.join("dataset", "BR", "ACOES", "IBOV_Elegivel.parquet")
+
+
+def _assinatura(arquivo):
+    if not os.path.exists(arquivo):
+        return None
+    info = os.stat(arquivo)
+    return [info.st_mtime_ns, info.st_size]
+
+
+def assinatura_origem(lista_ativos):
+    ## Assinatura dos arquivos de onde o cache é construído: matriz de elegibilidade, séries da Selic
+    ## e os arquivos tratados de cada ativo (ver arquivos_acao)
+    assinatura = {"Elegivel": _assinatura(ARQUIVO_ELEGIVEL)}
+    assinatura.update({nome: _assinatura(arquivo) for nome, arquivo in ARQUIVOS_SERIES.items()})
+    assinatura.update({Ticker: [_assinatura(arquivo) for arquivo in arquivos_acao(Ticker)] for Ticker in lista_ativos})
+    return assinatura
+
+
+def ativos_universo():
+    ## Ativos elegíveis em alguma data da matriz de elegibilidade
+    return ler_indice_elegibilidade().uniao()
+
+
+def ler_manifesto_cache():
+    arquivo_manifesto = os.path.join(PASTA_CACHE, "manifesto.json")
+    if not os.path.exists(arquivo_manifesto):
+        return None
+    with open(arquivo_manifesto) as arquivo:
+        return json.load(arquivo)
+
+
+def arquivos_cache(identificador):
+    ## Arquivos Feather de uma construção do cache
+    return [os.path.join(PASTA_CACHE, f"{nome}-{identificador}.feather") for nome in TABELAS_ACOES + list(ARQUIVOS_SERIES)]
+
+
+def cache_atualizado(manifesto, data_inicial):
+    ## True se o cache foi construído com a mesma data inicial, os seus arquivos existem e nenhum arquivo de origem
+    ## mudou desde então. A matriz de elegibilidade é verificada antes, pois é ela que define os ativos do universo
+    if manifesto is None or manifesto["Data_inicial"] != pd.Timestamp(data_inicial).isoformat():
+        return False
+    if not all(os.path.exists(arquivo) for arquivo in arquivos_cache(manifesto["Identificador"])):
+        return False
+    if manifesto["Assinatura"]["Elegivel"] != _assinatura(ARQUIVO_ELEGIVEL):
+        return False
+    return manifesto["Assinatura"] == assinatura_origem(manifesto["Ativos"])
+
+
+def _vetor_arrow(serie):
+    ## Números e datas são gravados sem máscara de nulos (NaN e NaT ficam nos próprios valores), para que a leitura
+    ## seja feita sem cópia; categorias são codificadas por dicionário
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        return pa.array(serie.astype(object).to_numpy(), from_pandas=True).dictionary_encode()
+    if pd.api.types.is_datetime64_dtype(serie.dtype):
+        return pa.array(serie.to_numpy(dtype="datetime64[ns]").view("int64")).view(pa.timestamp("ns"))
+    if serie.dtype == object:
+        return pa.array(serie.to_numpy(), from_pandas=True)
+    return pa.array(serie.to_numpy())
+
+
+def _gravar_tabela(lista_df, arquivo):
+    ## Junta os DataFrames em um arquivo Feather de um único bloco. O índice é gravado na coluna "__indice__".
+    ## Retorna as linhas [início, fim) de cada DataFrame e as colunas/tipos que diferem dos da tabela junta
+    df = pd.concat(lista_df) if lista_df else pd.DataFrame()
+    nomes = ["__indice__"] + [str(coluna) for coluna in df.columns]
+    vetores = [_vetor_arrow(pd.Series(df.index))] + [_vetor_arrow(df[coluna]) for coluna in df.columns]
+    metadados = {"Indice": df.index.name, "Colunas": [str(coluna) for coluna in df.columns]}
+    tabela = pa.Table.from_arrays(vetores, names=nomes).replace_schema_metadata({"cache_arrow": json.dumps(metadados)})
+    feather.write_feather(tabela, arquivo, compression="uncompressed", chunksize=max(1, tabela.num_rows))
+
+    linhas, ajustes = [], []
+    inicio = 0
+    for df_parte in lista_df:
+        linhas.append([inicio, inicio + len(df_parte)])
+        inicio += len(df_parte)
+        ajuste = {}
+        if list(df_parte.columns) != list(df.columns):
+            ajuste["Colunas"] = [str(coluna) for coluna in df_parte.columns]
+        tipos = {str(coluna): str(tipo) for coluna, tipo in df_parte.dtypes.items()
+                 if not isinstance(tipo, pd.CategoricalDtype) and tipo != df[coluna].dtype}
+        if tipos:
+            ajuste["Tipos"] = tipos
+        ajustes.append(ajuste)
+    return linhas, ajustes
+
+
+@contextmanager
+def _trava_construcao(espera=0.05):
+    ## Trava exclusiva entre processos, mantida durante a construção do cache. Com fcntl, a trava é liberada
+    ## pelo sistema se o processo morrer; sem ele, o arquivo de trava é criado com O_EXCL e apagado no final
+    os.makedirs(PASTA_CACHE, exist_ok=True)
+    arquivo_trava = os.path.join(PASTA_CACHE, "construcao.lock")
+    if fcntl is not None:
+        with open(arquivo_trava, "a") as arquivo:
+            fcntl.flock(arquivo, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(arquivo, fcntl.LOCK_UN)
+        return
+    while True:
+        try:
+            descritor = os.open(arquivo_trava, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            time.sleep(espera)
+    try:
+        yield
+    finally:
+        os.close(descritor)
+        os.remove(arquivo_trava)
+
+
+def construir_cache_arrow(data_inicial=datetime(2006,1,1), n_threads=8, forcar=False):
+    ## Constrói o cache dos ativos do universo (ver ativos_universo), com os dados a partir de data_inicial,
+    ## se ele não existir ou estiver desatualizado; com forcar=True, constrói sempre.
+    ## Cada construção grava arquivos com um novo identificador e só então troca o manifesto, de forma atômica:
+    ## processos com o cache antigo aberto continuam lendo os arquivos antigos até reabrirem o cache.
+    ## Processos que encontram o cache desatualizado ao mesmo tempo esperam a trava, e só o primeiro reconstrói.
+    ## Retorna o manifesto
+    manifesto = ler_manifesto_cache()
+    if not forcar and cache_atualizado(manifesto, data_inicial):
+        return manifesto
+
+    with _trava_construcao():
+        ## Outro processo pode ter reconstruído o cache enquanto este esperava a trava
+        manifesto_anterior = ler_manifesto_cache()
+        if not forcar and cache_atualizado(manifesto_anterior, data_inicial):
+            return manifesto_anterior
+        return _construir(data_inicial, n_threads, manifesto_anterior)
+
+
+def _construir(data_inicial, n_threads, manifesto_anterior):
+    lista_ativos = ativos_universo()
+    ## A assinatura é tirada antes da leitura: um arquivo alterado durante a construção deixa o cache desatualizado
+    assinatura = assinatura_origem(lista_ativos)
+    identificador = f"{time.time_ns()}-{os.getpid()}"
+    manifesto = {"Identificador": identificador, "Data_inicial": pd.Timestamp(data_inicial).isoformat(),
+                 "Ativos": lista_ativos, "Assinatura": assinatura, "Linhas": {}, "Ajustes": {}}
+
+    dict_df_acoes, dict_nao_encontrados = ler_acoes(lista_ativos, data_inicial, pd.Timestamp.max, n_threads)
+    manifesto["Nao_encontrados"] = {Ticker: f"{type(erro).__name__}: {erro}" for Ticker, erro in dict_nao_encontrados.items()}
+    for i, tabela in enumerate(TABELAS_ACOES):
+        lista_ativos_lidos = list(dict_df_acoes)
+        linhas, ajustes = _gravar_tabela([dict_df_acoes[Ticker][i] for Ticker in lista_ativos_lidos],
+                                         os.path.join(PASTA_CACHE, f"{tabela}-{identificador}.feather"))
+        manifesto["Linhas"][tabela] = dict(zip(lista_ativos_lidos, linhas))
+        manifesto["Ajustes"][tabela] = {Ticker: ajuste for Ticker, ajuste in zip(lista_ativos_lidos, ajustes) if ajuste}
+
+    for nome, ler in [("Selic", ler_selic), ("Expectativa_Selic", ler_expectativa_selic)]:
+        _gravar_tabela([ler()], os.path.join(PASTA_CACHE, f"{nome}-{identificador}.feather"))
+
+    arquivo_manifesto = os.path.join(PASTA_CACHE, "manifesto.json")
+    with open(arquivo_manifesto + f".{identificador}", "w") as arquivo:
+        json.dump(manifesto, arquivo)
+    os.replace(arquivo_manifesto + f".{identificador}", arquivo_manifesto)
+
+    ## Apagar os arquivos da construção publicada antes desta (os mapeamentos já abertos continuam válidos)
+    if manifesto_anterior is not None:
+        for arquivo in arquivos_cache(manifesto_anterior["Identificador"]):
+            try:
+                os.remove(arquivo)
+            except OSError:
+                pass
+
+    return manifesto
+
+
+def _abrir_tabela(arquivo):
+    ## Abre um arquivo do cache com mapeamento de memória. Devolve os metadados, os vetores numpy
+    ## (visões do mapeamento) das colunas numéricas e de datas e as colunas Arrow das demais
+    tabela = feather.read_table(arquivo, memory_map=True)
+    metadados = json.loads(tabela.schema.metadata[b"cache_arrow"])
+    vetores, colunas_arrow = {}, {}
+    for nome in tabela.column_names:
+        coluna = tabela.column(nome)
+        if pa.types.is_dictionary(coluna.type) or pa.types.is_string(coluna.type) or coluna.null_count > 0:
+            colunas_arrow[nome] = coluna
+        elif coluna.num_chunks == 1:
+            vetores[nome] = coluna.chunk(0).to_numpy(zero_copy_only=not pa.types.is_boolean(coluna.type))
+        else:
+            vetores[nome] = coluna.to_numpy()
+    return metadados, vetores, colunas_arrow
+
+
+def _montar_frame(tabela_aberta, inicio, fim, ajuste=None):
+    ## DataFrame com as linhas [inicio, fim) de uma tabela aberta, no formato dos arquivos tratados.
+    ## As colunas numéricas e de datas (e o índice) são visões do mapeamento; as categorias e textos são copiados
+    metadados, vetores, colunas_arrow = tabela_aberta
+    if ajuste is None:
+        ajuste = {}
+
+    def coluna(nome):
+        if nome in vetores:
+            return vetores[nome][inicio:fim]
+        return colunas_arrow[nome].slice(inicio, fim - inicio).to_pandas().array
+
+    colunas = ajuste.get("Colunas", metadados["Colunas"])
+    df = pd.DataFrame({nome: coluna(nome) for nome in colunas},
+                      index=pd.Index(coluna("__indice__"), name=metadados["Indice"], copy=False), copy=False)
+    if "Tipos" in ajuste:
+        df = df.astype(ajuste["Tipos"], copy=False)
+    return tipar_lidos(df)
+
+
+class CacheArrow:
+    ## Cache Arrow aberto com mapeamento de memória (ver construir_cache_arrow). Os DataFrames devolvidos compartilham
+    ## a memória do mapeamento, que é somente leitura: eles não devem ser alterados no lugar.
+    ## Exemplo de uso:
+    ## manifesto = construir_cache_arrow()
+    ## cache = CacheArrow(manifesto)
+    ## df_acao, df_multiplos, df_CAGR = cache.dados_ativo("PETR4")
+    def __init__(self, manifesto=None):
+        self.manifesto = ler_manifesto_cache() if manifesto is None else manifesto
+        if self.manifesto is None:
+            raise FileNotFoundError(f"Cache Arrow não encontrado em {PASTA_CACHE}; ver construir_cache_arrow")
+        self.identificador = self.manifesto["Identificador"]
+        self._tabelas = {nome: _abrir_tabela(arquivo) for nome, arquivo
+                         in zip(TABELAS_ACOES + list(ARQUIVOS_SERIES), arquivos_cache(self.identificador))}
+
+    def dados_ativo(self, Ticker):
+        ## [df_acao, df_multiplos, df_CAGR] do ativo, com o mesmo formato de ler_acoes
+        if Ticker not in self.manifesto["Linhas"][TABELAS_ACOES[0]]:
+            erro = self.manifesto["Nao_encontrados"].get(Ticker, "ativo fora do universo do cache")
+            raise LookupError(f"{Ticker} não está no cache Arrow: {erro}")
+        return [_montar_frame(self._tabelas[tabela], *self.manifesto["Linhas"][tabela][Ticker],
+                              self.manifesto["Ajustes"][tabela].get(Ticker, {}))
+                for tabela in TABELAS_ACOES]
+
+    def serie(self, nome):
+        ## Série completa da Selic ("Selic") ou da sua expectativa diária ("Expectativa_Selic"),
+        ## com o mesmo formato de ler_selic e ler_expectativa_selic
+        metadados, vetores, colunas_arrow = self._tabelas[nome]
+        return _montar_frame(self._tabelas[nome], 0, len(vetores.get("__indice__", colunas_arrow.get("__indice__"))))
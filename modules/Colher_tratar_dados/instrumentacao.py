@@ -0,0 +1,222 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import time
+import tracemalloc
+import functools
+import inspect
+
+## resource só existe em sistemas Unix: sem ele, RSS_max_MB fica NaN
+try:
+    import resource
+except ImportError:
+    resource = None
+
+## Instrumentação das etapas do tratamento e da estratégia: para cada etapa e ativo, registra o tempo de relógio,
+## o tempo de CPU, as linhas de entrada e de saída e a memória. Fica desligada por padrão; desligada, o custo
+## de uma etapa instrumentada é uma verificação de variável global.
+##
+## Exemplo de uso:
+## ativar_instrumentacao("instrumentacao.jsonl")
+## df_relatorio = tratar_universo(Lista_ativos)
+## df_etapas, df_ativos, df_lentos = resumo_instrumentacao(arquivo="instrumentacao.jsonl")
+##
+## Os processos criados depois da ativação (fork) herdam o estado e escrevem no mesmo arquivo: cada registro
+## é uma linha gravada de uma vez, em modo append.
+
+_ativa = False
+_arquivo = None
+_memoria = False
+_registros = []
+_pilha = []
+
+
+def ativar_instrumentacao(arquivo=None, memoria=False):
+    ## Liga a instrumentação. Com arquivo, cada registro também é gravado como uma linha JSON no arquivo.
+    ## Com memoria=True, o pico de memória alocada pelo Python e pelo numpy em cada etapa é medido com tracemalloc,
+    ## que deixa a execução mais lenta; sem ele, é registrado só o pico de memória residente do processo (ru_maxrss)
+    global _ativa, _arquivo, _memoria
+    _ativa = True
+    _arquivo = arquivo
+    _memoria = memoria
+    if memoria and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def desativar_instrumentacao():
+    global _ativa, _memoria
+    _ativa = False
+    if _memoria and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _memoria = False
+
+
+def instrumentacao_ativa():
+    return _ativa
+
+
+def registros_instrumentacao(limpar=False):
+    ## Registros feitos neste processo
+    global _registros
+    registros = _registros
+    if limpar:
+        _registros = []
+    return registros
+
+
+def _linhas(objeto):
+    ## Linhas de um DataFrame/Series, ou a soma das linhas dos DataFrames em listas, tuplas e dicionários
+    if isinstance(objeto, (pd.DataFrame, pd.Series, np.ndarray)):
+        return len(objeto)
+    if isinstance(objeto, (list, tuple, dict)):
+        valores = objeto.values() if isinstance(objeto, dict) else objeto
+        contagens = [n for n in map(_linhas, valores) if n is not None]
+        return sum(contagens) if contagens else None
+    return None
+
+
+class etapa:
+    ## Context manager que registra uma etapa. Sem Ticker, a etapa herda o ativo da etapa que a contém.
+    ## As linhas de entrada e saída podem ser informadas na criação ou com linhas() dentro do bloco.
+    ## Exemplo de uso:
+    ## with etapa("salvar_parquet", Ticker) as e:
+    ##     df.to_parquet(arquivo)
+    ##     e.linhas(saida=df)
+    __slots__ = ("nome", "Ticker", "entrada", "saida", "_nivel", "_inicio", "_inicio_cpu", "_memoria_inicial", "_pico")
+
+    def __init__(self, nome, Ticker=None, entrada=None, saida=None):
+        self.nome = nome
+        self.Ticker = Ticker
+        self.entrada = entrada
+        self.saida = saida
+
+    def linhas(self, entrada=None, saida=None):
+        ## Linhas de entrada/saída da etapa: número ou objeto (DataFrame, lista, dicionário) cujas linhas são contadas
+        if entrada is not None:
+            self.entrada = entrada
+        if saida is not None:
+            self.saida = saida
+
+    def __enter__(self):
+        if not _ativa:
+            return self
+        if self.Ticker is None and _pilha:
+            self.Ticker = _pilha[-1].Ticker
+        ## Nível da etapa dentro das etapas do mesmo ativo (0 para a etapa mais externa do ativo)
+        self._nivel = sum(1 for externa in _pilha if externa.Ticker == self.Ticker)
+        if _memoria:
+            ## O pico acumulado até aqui pertence à etapa externa
+            atual, pico = tracemalloc.get_traced_memory()
+            if _pilha:
+                _pilha[-1]._pico = max(_pilha[-1]._pico, pico)
+            tracemalloc.reset_peak()
+            self._memoria_inicial = atual
+            self._pico = atual
+        _pilha.append(self)
+        self._inicio_cpu = time.process_time()
+        self._inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo_erro, erro, traceback):
+        if not _ativa or not _pilha or _pilha[-1] is not self:
+            return False
+        tempo = time.perf_counter() - self._inicio
+        tempo_cpu = time.process_time() - self._inicio_cpu
+        _pilha.pop()
+
+        registro = {"Etapa": self.nome, "Ticker": self.Ticker, "Nivel": self._nivel, "Processo": os.getpid(),
+                    "Inicio": time.time() - tempo,
+                    "Tempo": tempo, "Tempo_CPU": tempo_cpu,
+                    "Linhas_entrada": self.entrada if isinstance(self.entrada, (int, type(None))) else _linhas(self.entrada),
+                    "Linhas_saida": self.saida if isinstance(self.saida, (int, type(None))) else _linhas(self.saida),
+                    "RSS_max_MB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024 if resource is not None else np.nan,
+                    "Erro": tipo_erro.__name__ if tipo_erro is not None else None}
+        if _memoria:
+            pico = max(self._pico, tracemalloc.get_traced_memory()[1])
+            registro["Memoria_pico_MB"] = (pico - self._memoria_inicial)/1024**2
+            if _pilha:
+                _pilha[-1]._pico = max(_pilha[-1]._pico, pico)
+            tracemalloc.reset_peak()
+
+        _registros.append(registro)
+        if _arquivo is not None:
+            with open(_arquivo, "a") as arquivo:
+                arquivo.write(json.dumps(registro) + "\n")
+        return False
+
+
+def instrumentar(nome=None, entrada=None):
+    ## Decorador que registra cada chamada da função como uma etapa (por padrão, com o nome da função).
+    ## O ativo é o argumento Ticker (ou ticker) da função; sem ele, o da etapa que a contém ou, por fim,
+    ## o da coluna Ticker do primeiro DataFrame dos argumentos. As linhas de entrada são as do argumento
+    ## entrada (por padrão, o primeiro) e as de saída, as do retorno (ver _linhas)
+    def decorador(funcao):
+        nome_etapa = nome or funcao.__name__
+        parametros = list(inspect.signature(funcao).parameters)
+        posicao_ticker = next((i for i, parametro in enumerate(parametros) if parametro in ("Ticker", "ticker")), None)
+        posicao_entrada = parametros.index(entrada) if entrada is not None else 0
+
+        @functools.wraps(funcao)
+        def funcao_instrumentada(*args, **kwargs):
+            if not _ativa:
+                return funcao(*args, **kwargs)
+
+            Ticker = None
+            if posicao_ticker is not None:
+                Ticker = args[posicao_ticker] if posicao_ticker < len(args) else kwargs.get(parametros[posicao_ticker])
+            if Ticker is None and (not _pilha or _pilha[-1].Ticker is None):
+                df = next((arg for arg in args if isinstance(arg, pd.DataFrame)), None)
+                if df is not None and "Ticker" in df.columns and len(df) > 0:
+                    Ticker = str(df["Ticker"].iloc[0])
+
+            if posicao_entrada < len(args):
+                linhas_entrada = _linhas(args[posicao_entrada])
+            else:
+                linhas_entrada = _linhas(kwargs.get(parametros[posicao_entrada])) if parametros else None
+
+            with etapa(nome_etapa, Ticker, entrada=linhas_entrada) as registro:
+                resultado = funcao(*args, **kwargs)
+                registro.linhas(saida=_linhas(resultado))
+            return resultado
+
+        return funcao_instrumentada
+    return decorador
+
+
+def ler_registros(arquivo):
+    ## Registros de um log JSON-lines, em um DataFrame
+    with open(arquivo) as log:
+        return pd.DataFrame([json.loads(linha) for linha in log if linha.strip()])
+
+
+def resumo_instrumentacao(registros=None, arquivo=None, n=10):
+    ## Resumo dos registros (deste processo, de uma lista ou do log em arquivo):
+    ## df_etapas: por etapa, número de chamadas, tempo total, médio e máximo, tempo de CPU e linhas, do maior tempo total para o menor;
+    ## df_ativos: os n ativos com maior tempo, somando as etapas mais externas de cada ativo (Nivel 0), com a etapa interna mais lenta;
+    ## df_lentos: as n chamadas (etapa e ativo) mais lentas
+    if arquivo is not None:
+        df = ler_registros(arquivo)
+    else:
+        df = pd.DataFrame(_registros if registros is None else registros)
+    if df.empty:
+        return [pd.DataFrame(), pd.DataFrame(), pd.DataFrame()]
+
+    df_etapas = df.groupby("Etapa").agg(Chamadas=("Tempo", "size"), Tempo_total=("Tempo", "sum"),
+                                        Tempo_medio=("Tempo", "mean"), Tempo_maximo=("Tempo", "max"),
+                                        Tempo_CPU=("Tempo_CPU", "sum"), Linhas_entrada=("Linhas_entrada", "sum"),
+                                        Linhas_saida=("Linhas_saida", "sum"), Erros=("Erro", "count"))
+    if "Memoria_pico_MB" in df.columns:
+        df_etapas["Memoria_pico_MB"] = df.groupby("Etapa")["Memoria_pico_MB"].max()
+    df_etapas = df_etapas.sort_values("Tempo_total", ascending=False)
+
+    df_ativo = df.dropna(subset=["Ticker"])
+    df_ativos = df_ativo[df_ativo["Nivel"] == 0].groupby("Ticker").agg(Tempo_total=("Tempo", "sum"), Tempo_CPU=("Tempo_CPU", "sum"))
+    ## Etapa interna mais lenta de cada ativo (ou a etapa externa, se o ativo não tiver etapas internas)
+    df_ordenado = df_ativo.assign(Interna=df_ativo["Nivel"] > 0).sort_values(["Interna", "Tempo"], ascending=False)
+    df_ativos["Etapa_mais_lenta"] = df_ordenado.groupby("Ticker")["Etapa"].first()
+    df_ativos = df_ativos.sort_values("Tempo_total", ascending=False).head(n)
+
+    df_lentos = df.sort_values("Tempo", ascending=False).head(n)[["Etapa", "Ticker", "Tempo", "Tempo_CPU",
+                                                                  "Linhas_entrada", "Linhas_saida", "Erro"]]
+    return [df_etapas, df_ativos, df_lentos]
@@ -2,43 +2,31 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 import os
-from statsmodels.tsa.arima.model import ARIMA
+import time
+import calendar
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow.dataset as ds
+from modules.Colher_tratar_dados.Dados_Fund.Tratar_dados import ler_bruto_tipado, relatar_erros, COLUNAS_CATEGORICAS
+from modules.Colher_tratar_dados.instrumentacao import instrumentar
 import warnings
 # Suprimir temporariamente os avisos
 warnings.filterwarnings("ignore")
 
-def load_data(data_simulacao):
+@instrumentar()
+def load_data(data_simulacao, n_threads=8, retornar_nao_encontrados=False):
+    ## As leituras dos arquivos das ações são feitas em paralelo, com até n_threads leituras ao mesmo tempo.
+    ## Os ativos que não puderam ser lidos são mostrados com o erro; com retornar_nao_encontrados=True,
+    ## o dicionário Ticker -> erro também é retornado, como quarto elemento da lista
     ## Atribuir uma data inicial para a simulação, alguns dados antigos estão em desacordo
     data_inicial = datetime(2006,1,1)
 
     ## Pegar os ativos elegíveis
-    arquivo_Ativos_Elegiveis = os.path.join("dataset", "BR", "ACOES", "IBOV_Elegivel.parquet")
-    df_Elegivel = pd.read_parquet(arquivo_Ativos_Elegiveis)
-    condicao_selecao_data = (df_Elegivel.index <= data_simulacao) & (df_Elegivel.index >= data_inicial)
-    data_dos_Elegiveis = df_Elegivel.loc[condicao_selecao_data,:].index.max()
-    condicao_selecao_ativos = df_Elegivel.loc[data_dos_Elegiveis,:].values == 1
-    lista_ativos_elegiveis = df_Elegivel.loc[data_dos_Elegiveis,condicao_selecao_ativos].index.to_list()
+    lista_ativos_elegiveis = ler_indice_elegibilidade().elegiveis(data_simulacao, data_inicial)
 
  
     ## Dados da Selic
-    arquivo_Selic = os.path.join("dataset", "BR", "Selic","Selic.parquet")
-
-    df_Selic = pd.read_parquet(arquivo_Selic)
-    # Coluna data como índice
-    df_Selic.set_index('data', inplace=True)
-    df_Selic.index = pd.to_datetime(df_Selic.index, format='%d/%m/%Y')
-
-    # Lista de nomes de colunas que devem ser lidas como números
-    colunas_numericas = ['anula100', 'diario'] 
-    df_Selic.fillna(0,inplace=True)
-    for col in colunas_numericas:
-        # Substitua vírgulas por pontos e converta para float
-        try:
-            df_Selic[col] = df_Selic[col].str.replace(',', '.').astype(float)
-        except:
-            print(f"Erro na coluna {col}")
-        pass
-        
+    df_Selic = ler_selic()
 
     # Filtrar a data de simulação
     condicao_selecao_data = (df_Selic.index <= data_simulacao) & (df_Selic.index >= data_inicial)
@@ -47,8 +35,7 @@ def load_data(data_simulacao):
     ## (FIM) Dados da Selic
 
     ## Dados da Expectativa de Selic
-    arquivo_Expectativa_Selic = os.path.join("dataset","BR", "Selic", "Expectativa_Selic_Diaria.parquet")
-    df_Expectativa_Selic = pd.read_parquet(arquivo_Expectativa_Selic)
+    df_Expectativa_Selic = ler_expectativa_selic()
 
     # Filtrar a data
     condicao_selecao_data = (df_Expectativa_Selic.index <= data_simulacao) & (df_Expectativa_Selic.index >= data_inicial)
@@ -60,58 +47,517 @@ def load_data(data_simulacao):
     ## (FIM) Dados da Expectativa de Selic
 
     ## Dados das ações
-    dict_df_acoes = {}
-    Lista_nao_encontrados = []
-    for Ticker in lista_ativos_elegiveis:
-        try:
-           ## Ler os dados normalizados
-            arquivo_por_acao = os.path.join("dataset", "BR", "ACOES", "Dados_Tratados", "Dados_normalizados_acao_"+Ticker + ".parquet")
-            df_acao = pd.read_parquet(arquivo_por_acao)
-            ## Filtrar a data
-            condicao_selecao_data = (df_acao["Data_balanco"] <= data_simulacao) & (df_acao["Data_balanco"] >= data_inicial)
-            df_acao = df_acao.loc[condicao_selecao_data,:]
-        
-            ## Ler os dados dos múltiplos
-            arquivo_por_multiplos = os.path.join("dataset", "BR", "ACOES", "Dados_Tratados", "Multiplos_diarios_"+Ticker + ".parquet")
-            df_multiplos = pd.read_parquet(arquivo_por_multiplos)
-            ## Filtrar a data
-            condicao_selecao_data = (df_multiplos.index <= data_simulacao) & (df_multiplos.index >= data_inicial)
-            df_multiplos = df_multiplos.loc[condicao_selecao_data,:]
-
-            ## Ler o CAGR
-            arquivo_por_CAGR = os.path.join("dataset", "BR", "ACOES", "Dados_Tratados", "CAGR_"+Ticker + ".parquet")
-            df_CAGR = pd.read_parquet(arquivo_por_CAGR)
-            ## Filtrar a data
-            condicao_selecao_data = (df_CAGR.index <= data_simulacao) & (df_CAGR.index >= data_inicial)
-            df_CAGR = df_CAGR.loc[condicao_selecao_data,:]
-
-            ## Salvando os dados no dicionário
-            dict_df_acoes[Ticker] = [df_acao, df_multiplos, df_CAGR]
-        except:
-            Lista_nao_encontrados.append(Ticker)
-            pass
-
-
-    
+    dict_df_acoes, dict_nao_encontrados = ler_acoes(lista_ativos_elegiveis, data_inicial, data_simulacao, n_threads)
+
+    for Ticker, erro in dict_nao_encontrados.items():
+        print(f"Não encontrado {Ticker}: {type(erro).__name__}: {erro}")
+
+    if retornar_nao_encontrados:
+        return [dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal, dict_nao_encontrados]
     return [dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal]
 
 
+def ler_elegiveis():
+    ## Matriz de elegibilidade: datas x ativos, 1 para os ativos elegíveis na data
+    arquivo_Ativos_Elegiveis = os.path.join("dataset", "BR", "ACOES", "IBOV_Elegivel.parquet")
+    return pd.read_parquet(arquivo_Ativos_Elegiveis)
+
+
+class IndiceElegibilidade:
+    ## Índice compacto da matriz de elegibilidade: as datas em ordem crescente e, para cada data, um conjunto de bits
+    ## (np.packbits) com um bit por ativo, na ordem das colunas da matriz. As consultas são buscas binárias nas datas.
+    ## Exemplo de uso:
+    ## indice = IndiceElegibilidade(ler_elegiveis())
+    ## lista_ativos = indice.elegiveis(datetime(2020,6,30))
+    ## lista_precarregar = indice.uniao(datetime(2010,1,1), datetime(2023,12,31))
+    def __init__(self, df_Elegivel):
+        df_Elegivel = df_Elegivel.sort_index(kind="stable")
+        self.datas = pd.DatetimeIndex(df_Elegivel.index).values.astype("datetime64[ns]")
+        self.ativos = np.asarray(df_Elegivel.columns, dtype=object)
+        self.bits = np.packbits(df_Elegivel.to_numpy() == 1, axis=1)
+
+    def _posicao(self, data):
+        ## Posição da última data do índice <= data (-1 se não houver)
+        return int(np.searchsorted(self.datas, np.datetime64(pd.Timestamp(data), "ns"), side="right")) - 1
+
+    def _ativos(self, bits):
+        return self.ativos[np.unpackbits(bits, count=len(self.ativos)).astype(bool)].tolist()
+
+    def data_elegiveis(self, data_simulacao, data_inicial=None):
+        ## Última data do índice até data_simulacao (e a partir de data_inicial); NaT se não houver
+        posicao = self._posicao(data_simulacao)
+        if posicao < 0 or (data_inicial is not None and self.datas[posicao] < np.datetime64(pd.Timestamp(data_inicial), "ns")):
+            return pd.NaT
+        return pd.Timestamp(self.datas[posicao])
+
+    def elegiveis(self, data_simulacao, data_inicial=None):
+        ## Ativos elegíveis na última data do índice até data_simulacao, na ordem das colunas da matriz.
+        ## Com data_inicial, datas anteriores a ela não são consideradas; sem nenhuma data, levanta KeyError
+        data_dos_Elegiveis = self.data_elegiveis(data_simulacao, data_inicial)
+        if pd.isna(data_dos_Elegiveis):
+            raise KeyError(f"Nenhuma data de elegibilidade até {pd.Timestamp(data_simulacao).date()}")
+        return self._ativos(self.bits[self._posicao(data_simulacao)])
+
+    def uniao(self, data_inicio=None, data_fim=None):
+        ## Ativos elegíveis em alguma data de [data_inicio, data_fim], contando a composição vigente em data_inicio
+        ## (a da última data do índice até ela): são os ativos que elegiveis() pode devolver no intervalo.
+        ## Sem datas, todos os ativos elegíveis em alguma data da matriz
+        inicio = 0 if data_inicio is None else max(self._posicao(data_inicio), 0)
+        fim = len(self.datas) if data_fim is None else self._posicao(data_fim) + 1
+        if fim <= inicio:
+            return []
+        return self._ativos(np.bitwise_or.reduce(self.bits[inicio:fim], axis=0))
+
+
+_indice_elegibilidade = None  # (assinatura do arquivo, IndiceElegibilidade)
+
+def ler_indice_elegibilidade():
+    ## Índice da matriz de elegibilidade, guardado no processo e reconstruído quando o arquivo muda
+    global _indice_elegibilidade
+    arquivo_Ativos_Elegiveis = os.path.join(os.getcwd(), "dataset", "BR", "ACOES", "IBOV_Elegivel.parquet")
+    info = os.stat(arquivo_Ativos_Elegiveis)
+    assinatura = (arquivo_Ativos_Elegiveis, info.st_mtime_ns, info.st_size)
+    if _indice_elegibilidade is None or _indice_elegibilidade[0] != assinatura:
+        _indice_elegibilidade = (assinatura, IndiceElegibilidade(ler_elegiveis()))
+    return _indice_elegibilidade[1]
+
+
+def ativos_elegiveis(df_Elegivel, data_simulacao, data_inicial):
+    ## Ativos elegíveis na última data da matriz de elegibilidade até a data de simulação.
+    ## df_Elegivel pode ser a matriz ou o seu IndiceElegibilidade, que evita montar o índice a cada chamada
+    if not isinstance(df_Elegivel, IndiceElegibilidade):
+        df_Elegivel = IndiceElegibilidade(df_Elegivel)
+    return df_Elegivel.elegiveis(data_simulacao, data_inicial)
+
+
+def ler_selic():
+    ## Selic diária, com a data como índice
+    arquivo_Selic = os.path.join("dataset", "BR", "Selic","Selic.parquet")
+
+    # Datas e números no formato brasileiro já convertidos
+    df_Selic, df_erros = ler_bruto_tipado(arquivo_Selic, ['anula100', 'diario'], ['data'], datas_no_indice=False)
+    relatar_erros(df_erros, arquivo_Selic)
+    # Coluna data como índice
+    df_Selic.set_index('data', inplace=True)
+    return df_Selic
+
+
+def ler_expectativa_selic():
+    ## Expectativa diária da Selic
+    arquivo_Expectativa_Selic = os.path.join("dataset","BR", "Selic", "Expectativa_Selic_Diaria.parquet")
+    return pd.read_parquet(arquivo_Expectativa_Selic)
+
+
+@instrumentar()
+def ler_acoes(lista_ativos, data_inicial, data_final, n_threads=8):
+    ## Lê os dados tratados dos ativos, com datas entre data_inicial e data_final.
+    ## Ativos com partição nos datasets das três tabelas são lidos em bloco, com o filtro de datas feito pelo leitor;
+    ## os demais são lidos dos arquivos por ativo, em paralelo.
+    ## Retorna o dicionário Ticker -> [df_acao, df_multiplos, df_CAGR], na ordem de lista_ativos,
+    ## e o dicionário Ticker -> erro dos ativos que não puderam ser lidos
+    Lista_tabelas = ["Dados_normalizados_acao", "Multiplos_diarios", "CAGR"]
+    Lista_particionados = [Ticker for Ticker in lista_ativos
+                           if all(os.path.isdir(endereco_particionado(tabela, Ticker)) for tabela in Lista_tabelas)]
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        if Lista_particionados:
+            futuro_acao = executor.submit(ler_particionado, "Dados_normalizados_acao", Lista_particionados, "Data_balanco", data_inicial, data_final)
+            futuro_multiplos = executor.submit(ler_particionado, "Multiplos_diarios", Lista_particionados, "Data", data_inicial, data_final)
+            futuro_CAGR = executor.submit(ler_particionado, "CAGR", Lista_particionados, "Data", data_inicial, data_final)
+        futuros = {Ticker: executor.submit(ler_arquivos_acao, Ticker, data_inicial, data_final)
+                   for Ticker in lista_ativos if Ticker not in Lista_particionados}
+
+        dict_df_acoes = {}
+        dict_nao_encontrados = {}
+        dict_particionados = {}
+        if Lista_particionados:
+            try:
+                dict_acao, dict_multiplos, dict_CAGR = futuro_acao.result(), futuro_multiplos.result(), futuro_CAGR.result()
+            except Exception:
+                ## Um arquivo ilegível derruba a leitura em bloco: os ativos particionados são lidos um a um,
+                ## e só os que falharem ficam de fora, com o erro
+                futuros.update({Ticker: executor.submit(ler_particionado_ativo, Ticker, data_inicial, data_final)
+                                for Ticker in Lista_particionados})
+            else:
+                for Ticker in Lista_particionados:
+                    try:
+                        dict_particionados[Ticker] = [dict_acao[Ticker], dict_multiplos[Ticker], dict_CAGR[Ticker]]
+                    except KeyError as erro:
+                        dict_nao_encontrados[Ticker] = erro
+        for Ticker in lista_ativos:
+            if Ticker in dict_particionados:
+                dict_df_acoes[Ticker] = dict_particionados[Ticker]
+                continue
+            if Ticker in dict_nao_encontrados:
+                continue
+            try:
+                dict_df_acoes[Ticker] = futuros[Ticker].result()
+            except Exception as erro:
+                dict_nao_encontrados[Ticker] = erro
+
+    return dict_df_acoes, dict_nao_encontrados
+
+
+@instrumentar()
+def ler_particionado_ativo(Ticker, data_inicial, data_final):
+    ## Lê as partições de um único ativo nas três tabelas, no formato de ler_arquivos_acao
+    return [ler_particionado("Dados_normalizados_acao", [Ticker], "Data_balanco", data_inicial, data_final)[Ticker],
+            ler_particionado("Multiplos_diarios", [Ticker], "Data", data_inicial, data_final)[Ticker],
+            ler_particionado("CAGR", [Ticker], "Data", data_inicial, data_final)[Ticker]]
+
+
+def arquivos_acao(Ticker):
+    ## Arquivos de onde ler_acoes lê os dados do ativo: as partições, se existirem nas três tabelas, ou os arquivos por ativo
+    Lista_tabelas = ["Dados_normalizados_acao", "Multiplos_diarios", "CAGR"]
+    if all(os.path.isdir(endereco_particionado(tabela, Ticker)) for tabela in Lista_tabelas):
+        return [os.path.join(endereco_particionado(tabela, Ticker), "parte-0.parquet") for tabela in Lista_tabelas]
+    return [os.path.join("dataset", "BR", "ACOES", "Dados_Tratados", f"{tabela}_{Ticker}.parquet") for tabela in Lista_tabelas]
+
+
+def tipar_lidos(df):
+    ## As colunas de texto dos Dados Tratados são gravadas como categorias (ver tipar_tratados) e voltam
+    ## como categorias na leitura. As categorias são só os valores presentes, em ordem alfabética, para que a leitura
+    ## do dataset particionado (dicionário unificado de todos os ativos) e a dos arquivos tenham o mesmo tipo.
+    ## As colunas float32 já são preservadas pelo próprio parquet
+    tipos = {col: pd.CategoricalDtype(sorted(df[col].dropna().unique())) for col in COLUNAS_CATEGORICAS if col in df.columns}
+    return df.astype(tipos, copy=False) if tipos else df
+
+
+@instrumentar()
+def ler_arquivos_acao(Ticker, data_inicial, data_simulacao):
+    ## Lê os três arquivos tratados de um ativo, filtrando as datas
+    ## Ler os dados normalizados
+    arquivo_por_acao = os.path.join("dataset", "BR", "ACOES", "Dados_Tratados", "Dados_normalizados_acao_"+Ticker + ".parquet")
+    df_acao = tipar_lidos(pd.read_parquet(arquivo_por_acao))
+    ## Filtrar a data
+    condicao_selecao_data = (df_acao["Data_balanco"] <= data_simulacao) & (df_acao["Data_balanco"] >= data_inicial)
+    df_acao = df_acao.loc[condicao_selecao_data,:]
+
+    ## Ler os dados dos múltiplos
+    arquivo_por_multiplos = os.path.join("dataset", "BR", "ACOES", "Dados_Tratados", "Multiplos_diarios_"+Ticker + ".parquet")
+    df_multiplos = tipar_lidos(pd.read_parquet(arquivo_por_multiplos))
+    ## Filtrar a data
+    condicao_selecao_data = (df_multiplos.index <= data_simulacao) & (df_multiplos.index >= data_inicial)
+    df_multiplos = df_multiplos.loc[condicao_selecao_data,:]
+
+    ## Ler o CAGR
+    arquivo_por_CAGR = os.path.join("dataset", "BR", "ACOES", "Dados_Tratados", "CAGR_"+Ticker + ".parquet")
+    df_CAGR = tipar_lidos(pd.read_parquet(arquivo_por_CAGR))
+    ## Filtrar a data
+    condicao_selecao_data = (df_CAGR.index <= data_simulacao) & (df_CAGR.index >= data_inicial)
+    df_CAGR = df_CAGR.loc[condicao_selecao_data,:]
+
+    return [df_acao, df_multiplos, df_CAGR]
+
+
+def endereco_particionado(tabela, Ticker):
+    ## Partição do ativo no dataset de uma tabela dos Dados Tratados, no formato hive: <tabela>/Ticker=<Ticker>
+    return os.path.join("dataset", "BR", "ACOES", "Dados_Tratados", "Particionado", tabela, f"Ticker={Ticker}")
+
+
+@instrumentar()
+def ler_particionado(tabela, lista_ativos, coluna_data, data_inicial, data_final, colunas=None):
+    ## Lê de uma vez as partições dos ativos no dataset de uma tabela dos Dados Tratados.
+    ## O filtro de datas (em coluna_data; "Data" é o índice) e a seleção de colunas são feitos pelo próprio
+    ## leitor, que descarta os grupos de linhas fora do intervalo pelas estatísticas de cada grupo.
+    ## Retorna um dicionário Ticker -> DataFrame, no formato e na ordem das linhas dos arquivos por ativo
+    pasta_tabela = os.path.join("dataset", "BR", "ACOES", "Dados_Tratados", "Particionado", tabela)
+    arquivos = [os.path.join(endereco_particionado(tabela, Ticker), "parte-0.parquet") for Ticker in lista_ativos]
+    dataset = ds.dataset(arquivos, format="parquet", partitioning="hive", partition_base_dir=pasta_tabela)
+
+    filtro = (ds.field(coluna_data) >= data_inicial) & (ds.field(coluna_data) <= data_final)
+    if colunas is not None:
+        colunas = list(dict.fromkeys(["Ticker", "Data", "Posicao", coluna_data] + list(colunas)))
+    df = dataset.to_table(columns=colunas, filter=filtro).to_pandas()
+
+    ## Separar por ativo, voltando à ordem original das linhas
+    grupos = dict(tuple(df.groupby("Ticker", sort=False)))
+    dict_df = {}
+    for Ticker in lista_ativos:
+        df_ativo = grupos.get(Ticker, df.iloc[0:0])
+        df_ativo = df_ativo.sort_values("Posicao").drop(columns=["Ticker", "Posicao"]).set_index("Data")
+        df_ativo.index.name = "index"
+        df_ativo.insert(0, "Ticker", Ticker)
+        dict_df[Ticker] = tipar_lidos(df_ativo)
+
+    return dict_df
+
+
+def _preparar_fatia(df, datas):
+    ## Guarda o DataFrame com as datas usadas no filtro as-of e o sentido da ordenação delas
+    datas = pd.DatetimeIndex(datas)
+    if datas.is_monotonic_increasing:
+        ordem = "crescente"
+    elif datas.is_monotonic_decreasing:
+        ordem = "decrescente"
+    else:
+        ordem = None
+    return df, datas.values, ordem
+
+
+def _fatiar(fatia, data_simulacao):
+    ## Linhas com data <= data_simulacao: uma fatia (sem cópia) quando as datas estão ordenadas,
+    ## ou uma seleção por máscara quando não estão
+    df, datas, ordem = fatia
+    data = np.datetime64(pd.Timestamp(data_simulacao), "ns")
+    if ordem == "crescente":
+        return df.iloc[:np.searchsorted(datas, data, side="right")]
+    if ordem == "decrescente":
+        return df.iloc[len(datas) - np.searchsorted(datas[::-1], data, side="right"):]
+    return df.loc[datas <= data]
+
+
+class ArmazemSnapshot:
+    ## Guarda em memória o histórico completo dos dados do load_data e devolve, para cada data_simulacao,
+    ## visões as-of no mesmo formato: [dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal].
+    ## As visões são fatias das tabelas guardadas, e não cópias, por isso não devem ser alteradas.
+    ## Cada arquivo é relido quando a sua data de modificação muda. Os dados das ações ficam em um cache
+    ## limitado a memoria_maxima_mb; os ativos usados há mais tempo são descartados quando o limite é ultrapassado.
+    ## Com cache_arrow=True, os dados das ações e da Selic vêm do cache Arrow mapeado em memória (ver cache_arrow.py),
+    ## reconstruído quando os Dados Tratados mudam: processos paralelos compartilham uma única cópia dos dados.
+    ## Se o cache está atualizado é verificado no máximo uma vez a cada intervalo_cache_arrow segundos
+    ## (com None, só na primeira visão), pois a verificação consulta os arquivos de todos os ativos
+    def __init__(self, memoria_maxima_mb=4096, n_threads=8, cache_arrow=False, intervalo_cache_arrow=60):
+        self.data_inicial = datetime(2006,1,1)
+        self.memoria_maxima = memoria_maxima_mb * 1024**2
+        self.n_threads = n_threads
+        self.cache_arrow = cache_arrow
+        self.intervalo_cache_arrow = intervalo_cache_arrow
+        self._cache = None
+        self._verificacao_cache = None  # instante (time.monotonic) da última verificação do cache Arrow
+        self.memoria_usada = 0
+        self._acoes = OrderedDict()  # Ticker -> (datas de modificação, bytes, fatias de df_acao, df_multiplos e df_CAGR)
+        self._gerais = {}  # nome -> (data de modificação, valor)
+
+    def _geral(self, nome, arquivo, ler):
+        mtime = os.path.getmtime(arquivo)
+        if nome not in self._gerais or self._gerais[nome][0] != mtime:
+            self._gerais[nome] = (mtime, ler())
+        return self._gerais[nome][1]
+
+    def _preparar_serie(self, df):
+        ## Série a partir da data inicial, pronta para as fatias
+        df = df.loc[df.index >= self.data_inicial, :]
+        return _preparar_fatia(df, df.index)
+
+    def _abrir_cache_arrow(self):
+        ## Cache Arrow atualizado; quando ele é reconstruído, os ativos guardados são descartados
+        from modules.Colher_tratar_dados.cache_arrow import construir_cache_arrow, CacheArrow
+        agora = time.monotonic()
+        if self._cache is not None and (self.intervalo_cache_arrow is None
+                                        or agora - self._verificacao_cache < self.intervalo_cache_arrow):
+            return self._cache
+        self._verificacao_cache = agora
+        manifesto = construir_cache_arrow(self.data_inicial, self.n_threads)
+        if self._cache is None or self._cache.identificador != manifesto["Identificador"]:
+            try:
+                cache = CacheArrow(manifesto)
+            except FileNotFoundError:
+                ## Outro processo reconstruiu o cache e apagou os arquivos entre a leitura do manifesto e a abertura
+                cache = CacheArrow(construir_cache_arrow(self.data_inicial, self.n_threads))
+            self._cache = cache
+            self._gerais.clear()
+            self._acoes.clear()
+            self.memoria_usada = 0
+        return self._cache
+
+    def _carregar_acoes_cache_arrow(self, lista_ativos):
+        ## Ativos lidos do cache Arrow. Os dados são visões do mapeamento, que não ocupam a memória do processo,
+        ## por isso não contam no limite de memória
+        dict_nao_encontrados = {}
+        for Ticker in lista_ativos:
+            if Ticker in self._acoes:
+                continue
+            try:
+                df_acao, df_multiplos, df_CAGR = self._cache.dados_ativo(Ticker)
+            except LookupError as erro:
+                dict_nao_encontrados[Ticker] = erro
+                continue
+            fatias = [_preparar_fatia(df_acao, df_acao["Data_balanco"]),
+                      _preparar_fatia(df_multiplos, df_multiplos.index),
+                      _preparar_fatia(df_CAGR, df_CAGR.index)]
+            self._acoes[Ticker] = (self._cache.identificador, 0, fatias)
+        return dict_nao_encontrados
+
+    def _carregar_acoes(self, lista_ativos):
+        ## Carrega os ativos que não estão no cache ou cujos arquivos mudaram
+        if self.cache_arrow:
+            return self._carregar_acoes_cache_arrow(lista_ativos)
+        Lista_carregar = []
+        dict_mtimes = {}
+        for Ticker in lista_ativos:
+            dict_mtimes[Ticker] = tuple(os.path.getmtime(arquivo) if os.path.exists(arquivo) else None
+                                        for arquivo in arquivos_acao(Ticker))
+            if Ticker in self._acoes and self._acoes[Ticker][0] == dict_mtimes[Ticker]:
+                self._acoes.move_to_end(Ticker)
+            else:
+                Lista_carregar.append(Ticker)
+
+        dict_df_acoes, dict_nao_encontrados = ler_acoes(Lista_carregar, self.data_inicial, pd.Timestamp.max, self.n_threads)
+        for Ticker in Lista_carregar:
+            if Ticker in self._acoes:
+                self.memoria_usada -= self._acoes.pop(Ticker)[1]
+            if Ticker not in dict_df_acoes:
+                continue
+            df_acao, df_multiplos, df_CAGR = dict_df_acoes[Ticker]
+            tamanho = sum(int(df.memory_usage(deep=True).sum()) for df in dict_df_acoes[Ticker])
+            fatias = [_preparar_fatia(df_acao, df_acao["Data_balanco"]),
+                      _preparar_fatia(df_multiplos, df_multiplos.index),
+                      _preparar_fatia(df_CAGR, df_CAGR.index)]
+            self._acoes[Ticker] = (dict_mtimes[Ticker], tamanho, fatias)
+            self.memoria_usada += tamanho
+
+        ## Descartar os ativos usados há mais tempo, mantendo os da visão atual
+        conjunto_ativos = set(lista_ativos)
+        for Ticker in list(self._acoes):
+            if self.memoria_usada <= self.memoria_maxima:
+                break
+            if Ticker not in conjunto_ativos:
+                self.memoria_usada -= self._acoes.pop(Ticker)[1]
+
+        return dict_nao_encontrados
+
+    def _indice_elegibilidade(self):
+        return self._geral("Elegivel", os.path.join("dataset", "BR", "ACOES", "IBOV_Elegivel.parquet"),
+                           lambda: IndiceElegibilidade(ler_elegiveis()))
+
+    def precarregar(self, data_inicio, data_fim):
+        ## Carrega de uma vez, com as leituras em paralelo, os ativos que as visões de data_inicio a data_fim vão usar
+        ## (ver IndiceElegibilidade.uniao). Retorna o dicionário Ticker -> erro dos ativos que não puderam ser lidos
+        if self.cache_arrow:
+            self._abrir_cache_arrow()
+        return self._carregar_acoes(self._indice_elegibilidade().uniao(data_inicio, data_fim))
+
+    def visao(self, data_simulacao, retornar_nao_encontrados=False):
+        ## Mesmo retorno de load_data(data_simulacao)
+        if self.cache_arrow:
+            cache = self._abrir_cache_arrow()
+            ler_Selic, ler_Expectativa_Selic = (lambda: cache.serie("Selic")), (lambda: cache.serie("Expectativa_Selic"))
+        else:
+            ler_Selic, ler_Expectativa_Selic = ler_selic, ler_expectativa_selic
+
+        lista_ativos_elegiveis = self._indice_elegibilidade().elegiveis(data_simulacao, self.data_inicial)
+
+        fatia_Selic = self._geral("Selic", os.path.join("dataset", "BR", "Selic","Selic.parquet"),
+                                  lambda: self._preparar_serie(ler_Selic()))
+        df_Selic = _fatiar(fatia_Selic, data_simulacao)
+
+        fatia_Expectativa_Selic = self._geral("Expectativa_Selic", os.path.join("dataset","BR", "Selic", "Expectativa_Selic_Diaria.parquet"),
+                                              lambda: self._preparar_serie(ler_Expectativa_Selic()))
+        df_Expectativa_Selic_mensal = _fatiar(fatia_Expectativa_Selic, data_simulacao).resample('M').mean()
+
+        dict_nao_encontrados = self._carregar_acoes(lista_ativos_elegiveis)
+        dict_df_acoes = {Ticker: [_fatiar(fatia, data_simulacao) for fatia in self._acoes[Ticker][2]]
+                         for Ticker in lista_ativos_elegiveis if Ticker in self._acoes}
+
+        for Ticker, erro in dict_nao_encontrados.items():
+            print(f"Não encontrado {Ticker}: {type(erro).__name__}: {erro}")
+
+        if retornar_nao_encontrados:
+            return [dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal, dict_nao_encontrados]
+        return [dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal]
+
+
+def inicio_janela(datas, anos=0, meses=0):
+    ## Limite das janelas "últimos anos/meses até a data": a mesma data do calendário, anos e meses antes
+    ## (29/02 vira 28/02). A janela são as datas posteriores ao limite, até a data. Aceita uma data ou um índice de datas
+    if isinstance(datas, (pd.DatetimeIndex, pd.Series, np.ndarray)):
+        return datas - pd.DateOffset(years=anos, months=meses)
+    ## Uma data: a mesma conta do DateOffset, sem o custo dele, pois é feita a cada atualização das médias móveis
+    data = pd.Timestamp(datas)
+    ano, mes = divmod(data.year*12 + data.month - 1 - (12*anos + meses), 12)
+    return data.replace(year=ano, month=mes + 1, day=min(data.day, calendar.monthrange(ano, mes + 1)[1]))
+
+
+class CalendarioNegociacao:
+    ## Calendário de pregões da B3: as datas em ordem crescente, cada uma com a sua posição inteira.
+    ## Uma janela "últimos N anos/meses até a data" vira um par de posições (inicio, fim) do calendário, e as posições
+    ## de início das janelas de cada tamanho são calculadas uma única vez para todos os pregões. As mesmas posições
+    ## recortam as séries de todos os ativos (ver fatia) e os painéis montados sobre o calendário.
+    ## Exemplo de uso:
+    ## calendario = calendario_negociacao(dict_df_acoes)
+    ## inicio, fim = calendario.limites(datetime(2023,11,30), anos=4)
+    ## df_janela = df_multiplos.iloc[calendario.fatia(df_multiplos.index, inicio, fim)]
+    def __init__(self, datas):
+        self.datas = np.unique(pd.DatetimeIndex(datas).values.astype("datetime64[ns]"))
+        self._inicios = {}  # (anos, meses) -> posição do início da janela que termina em cada pregão
+
+    def __len__(self):
+        return len(self.datas)
+
+    def posicao(self, data):
+        ## Número de pregões até a data, inclusive: o fim (exclusivo) das fatias que terminam nela
+        return int(np.searchsorted(self.datas, np.datetime64(pd.Timestamp(data), "ns"), side="right"))
+
+    def _inicios_janela(self, anos, meses):
+        if (anos, meses) not in self._inicios:
+            limites = inicio_janela(pd.DatetimeIndex(self.datas), anos, meses).values
+            self._inicios[(anos, meses)] = np.searchsorted(self.datas, limites, side="right")
+        return self._inicios[(anos, meses)]
+
+    def limites(self, data, anos=0, meses=0):
+        ## Posições (inicio, fim) dos pregões da janela: posteriores a inicio_janela(data, anos, meses), até a data
+        fim = self.posicao(data)
+        if fim > 0 and self.datas[fim - 1] == np.datetime64(pd.Timestamp(data), "ns"):
+            return int(self._inicios_janela(anos, meses)[fim - 1]), fim
+        limite = np.datetime64(inicio_janela(pd.Timestamp(data), anos, meses), "ns")
+        return int(np.searchsorted(self.datas, limite, side="right")), fim
+
+    def fatia(self, indice, inicio, fim):
+        ## Fatia das linhas de um índice de datas crescente (as datas de um ativo, ou de um painel) que estão
+        ## entre os pregões inicio e fim-1 do calendário
+        valores = pd.DatetimeIndex(indice).values
+        if fim <= inicio:
+            return slice(0, 0)
+        return slice(int(np.searchsorted(valores, self.datas[inicio], side="left")),
+                     int(np.searchsorted(valores, self.datas[fim - 1], side="right")))
+
+
+def calendario_negociacao(dict_df_acoes):
+    ## Calendário de pregões montado com a união das datas de cotação (índices dos df_multiplos) dos ativos
+    lista_datas = [pd.DatetimeIndex(dados[1].index).values for dados in dict_df_acoes.values()]
+    return CalendarioNegociacao(np.concatenate(lista_datas) if lista_datas else np.array([], dtype="datetime64[ns]"))
+
+
+def montar_painel_precos(dict_precos, descartar_linhas_vazias=False):
+    ## Monta em um único passo o painel (datas x ativos) com as séries de preço de cada ativo
+    ## (dict ativo -> pd.Series indexada por data): um array float64 no índice de datas comum,
+    ## a união das datas em ordem crescente. Com descartar_linhas_vazias=True, as datas sem nenhum preço são descartadas.
+    ## Recortes de linhas do painel, como as janelas do CalendarioNegociacao, são fatias do array, sem cópia
+    ativos = list(dict_precos)
+    lista_datas = [pd.DatetimeIndex(serie.index).values for serie in dict_precos.values()]
+    if lista_datas:
+        datas = np.unique(np.concatenate(lista_datas))
+    else:
+        datas = np.array([], dtype="datetime64[ns]")
+
+    matriz = np.full((len(datas), len(ativos)), np.nan)
+    for j, (datas_ativo, serie) in enumerate(zip(lista_datas, dict_precos.values())):
+        matriz[np.searchsorted(datas, datas_ativo), j] = serie.to_numpy(dtype=float)
+
+    if descartar_linhas_vazias:
+        linhas_com_preco = ~np.isnan(matriz).all(axis=1)
+        datas, matriz = datas[linhas_com_preco], matriz[linhas_com_preco]
+
+    ## Nome do índice: o das séries, se for o mesmo em todas
+    nomes_indice = {serie.index.name for serie in dict_precos.values()}
+    nome_indice = nomes_indice.pop() if len(nomes_indice) == 1 else None
+    return pd.DataFrame(matriz, index=pd.DatetimeIndex(datas, name=nome_indice), columns=ativos)
+
+
 def load_data_backtest(data_simulacao, lista_ativos_elegiveis, meses=12):
-    df_cotacao_ajustado = pd.DataFrame()
+    ## Cotações ajustadas dos ativos entre a data de simulação e meses à frente, em um painel datas x ativos
+    data_x_meses_afrente = data_simulacao + pd.DateOffset(months=meses)
+    dict_precos = {}
     for ativo in lista_ativos_elegiveis:
         ## Ler os dados dos múltiplos
-        arquivo_por_multiplos = os.path.join("dataset", "BR", "ACOES", "Dados_Tratados", "Multiplos_diarios_"+Ticker + ".parquet")
-        df_multiplos = pd.read_parquet(arquivo_por_multiplos)
+        arquivo_por_multiplos = os.path.join("dataset", "BR", "ACOES", "Dados_Tratados", "Multiplos_diarios_"+ativo + ".parquet")
+        df_multiplos = pd.read_parquet(arquivo_por_multiplos, columns=["Fech_Ajustado"])
 
         ## Filtrar a data
-        data_x_meses_afrente = data_simulacao + pd.DateOffset(months=meses)
         condicao_selecao_data = \
             (df_multiplos.index <= data_x_meses_afrente) & (df_multiplos.index >= data_simulacao)
 
-        df_multiplos = df_multiplos.loc[condicao_selecao_data,:]
         ## Adicionando a cotação ajustada
-        df_ativo = df_multiplos[["Fech_Ajustado"]].copy()
-        df_ativo.columns = [ativo]
-        df_cotacao_ajustado = pd.concat([df_cotacao_ajustado, df_ativo], axis=1, join="outer")
+        dict_precos[ativo] = df_multiplos.loc[condicao_selecao_data, "Fech_Ajustado"]
 
-    return df_cotacao_ajustado
+    return montar_painel_precos(dict_precos)
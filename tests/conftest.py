@@ -0,0 +1,35 @@
+import os
+import sys
+import shutil
+import warnings
+
+import pytest
+
+## Pasta do repositório no sys.path, para importar modules, example e benchmarks
+RAIZ_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ_REPO)
+
+from benchmarks.gerar_dataset import gerar_dataset
+from modules.Colher_tratar_dados.Dados_Fund import Tratar_dados
+
+warnings.filterwarnings("ignore")
+
+
+@pytest.fixture(scope="session")
+def dataset_base(tmp_path_factory):
+    ## Universo sintético pequeno (ver benchmarks/gerar_dataset.py), gerado uma vez e copiado por cada teste
+    raiz = str(tmp_path_factory.mktemp("base"))
+    lista_ativos = gerar_dataset(raiz, n_ativos=4, anos=6, n_eventos=2, semente=0)
+    return raiz, lista_ativos
+
+
+@pytest.fixture
+def dataset(dataset_base, tmp_path, monkeypatch):
+    ## Cópia do universo sintético para o teste: o tratamento aponta para ela e a pasta de trabalho é a raiz,
+    ## de onde o load_data lê dataset/...
+    raiz_base, lista_ativos = dataset_base
+    raiz = str(tmp_path / "universo")
+    shutil.copytree(raiz_base, raiz)
+    monkeypatch.setattr(Tratar_dados, "DIRETORIO_DATASET", os.path.join(raiz, "dataset"))
+    monkeypatch.chdir(raiz)
+    return lista_ativos
@@ -0,0 +1,55 @@
+import os
+import multiprocessing
+from datetime import datetime
+
+from modules.Colher_tratar_dados.Dados_Fund import Tratar_dados
+from modules.Colher_tratar_dados.cache_arrow import construir_cache_arrow, CacheArrow, PASTA_CACHE, arquivos_cache
+from modules.Colher_tratar_dados.load_data import ArmazemSnapshot, endereco_particionado
+
+DATA_SIMULACAO = datetime(2023, 6, 30)
+
+
+def _construir(forcar):
+    return construir_cache_arrow(n_threads=1, forcar=forcar)["Identificador"]
+
+
+def test_construcoes_concorrentes(dataset):
+    Tratar_dados.tratar_universo(dataset, n_processos=1)
+    with multiprocessing.get_context("fork").Pool(4) as pool:
+        ## Cache inexistente: só um processo constrói, os demais esperam a trava e devolvem o mesmo manifesto
+        identificadores = pool.map(_construir, [False]*4)
+        assert len(set(identificadores)) == 1
+        ## Construções forçadas: cada uma apaga só os arquivos da construção publicada antes dela
+        pool.map(_construir, [True]*4)
+
+    manifesto = CacheArrow().manifesto
+    arquivos = sorted(os.path.join(PASTA_CACHE, nome) for nome in os.listdir(PASTA_CACHE) if nome.endswith(".feather"))
+    assert arquivos == sorted(arquivos_cache(manifesto["Identificador"]))
+    assert construir_cache_arrow(n_threads=1)["Identificador"] == manifesto["Identificador"]
+
+
+def test_cache_com_arquivo_apagado_e_reconstruido(dataset):
+    Tratar_dados.tratar_universo(dataset, n_processos=1)
+    manifesto = construir_cache_arrow(n_threads=1)
+    os.remove(arquivos_cache(manifesto["Identificador"])[0])
+
+    dict_df_acoes, df_Selic, _ = ArmazemSnapshot(cache_arrow=True, n_threads=1).visao(DATA_SIMULACAO)
+    assert dict_df_acoes and len(df_Selic)
+    assert CacheArrow().identificador != manifesto["Identificador"]
+
+
+def test_verificacao_do_cache_limitada_pelo_intervalo(dataset):
+    Tratar_dados.tratar_universo(dataset, n_processos=1)
+    armazem = ArmazemSnapshot(cache_arrow=True, n_threads=1, intervalo_cache_arrow=None)
+    armazem.visao(DATA_SIMULACAO)
+    identificador = armazem._cache.identificador
+    Ticker = armazem._cache.manifesto["Ativos"][0]
+
+    ## Com intervalo None, o cache só é verificado na primeira visão
+    os.utime(f"{endereco_particionado('CAGR', Ticker)}/parte-0.parquet", ns=(0, 0))
+    armazem.visao(DATA_SIMULACAO)
+    assert armazem._cache.identificador == identificador
+
+    armazem.intervalo_cache_arrow = 0
+    armazem.visao(DATA_SIMULACAO)
+    assert armazem._cache.identificador != identificador
@@ -0,0 +1,28 @@
+from datetime import datetime
+
+import pytest
+
+from example import Estrategia_retorno
+from modules.Colher_tratar_dados.Dados_Fund import Tratar_dados
+from modules.Colher_tratar_dados.load_data import load_data
+
+
+def _falhar(*args, **kwargs):
+    raise ValueError("falha no ativo")
+
+
+@pytest.mark.parametrize("universo_vazio", [False, True])
+def test_nenhum_ativo_calculado(dataset, monkeypatch, universo_vazio):
+    Tratar_dados.tratar_universo(dataset, n_processos=1)
+    dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal = load_data(datetime(2023, 6, 30))
+    if universo_vazio:
+        dict_df_acoes = {}
+    monkeypatch.setattr(Estrategia_retorno, "dados_ativo", _falhar)
+    monkeypatch.setattr(Estrategia_retorno, "dados_regressao_VPA", _falhar)
+
+    info_main, info_verificao = Estrategia_retorno.main_ret(dict_df_acoes, df_Selic, df_Expectativa_Selic_mensal,
+                                                            renderizar=False)
+
+    expec_retorno, cotacoes, setores = info_main
+    assert len(expec_retorno) == 0 and cotacoes.empty and len(setores) == 0
+    assert sorted(info_verificao[3]) == sorted(dict_df_acoes)
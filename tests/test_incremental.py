@@ -0,0 +1,61 @@
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+from modules.Colher_tratar_dados.Dados_Fund import Tratar_dados
+from modules.Colher_tratar_dados.load_data import tipar_lidos
+
+
+def _cortar(Ticker, tipo, manter):
+    ## Guarda uma cópia do arquivo bruto e deixa nele apenas as linhas com manter(datas) verdadeiro
+    arquivo = os.path.join(Tratar_dados.DIRETORIO_DATASET, "BR", "ACOES", "Dados_Brutos", f"{Ticker}_{tipo}.parquet")
+    df = pd.read_parquet(arquivo)
+    shutil.copy(arquivo, arquivo + ".orig")
+    df.loc[manter(pd.to_datetime(df.index, format="%d/%m/%Y"))].to_parquet(arquivo)
+    return arquivo
+
+
+def _restaurar(arquivo):
+    os.replace(arquivo + ".orig", arquivo)
+
+
+def _comparar(lista_incremental, lista_completo):
+    for df_incremental, df_completo in zip(lista_incremental, lista_completo):
+        pd.testing.assert_frame_equal(df_incremental, df_completo, check_exact=False, rtol=1e-9)
+
+
+CENARIOS = {
+    ## Uma cotação nova
+    "um_dia": [("Cot", lambda datas: datas < datas.max())],
+    ## Um trimestre novo: cotações e o último balanço
+    "trimestre": [("Cot", lambda datas: datas <= pd.Timestamp("2023-09-29")),
+                  ("Fund", lambda datas: datas < pd.Timestamp("2023-09-30"))],
+}
+
+
+@pytest.mark.parametrize("cenario", list(CENARIOS))
+def test_incremental_igual_ao_completo(dataset, cenario, capsys):
+    Ticker = dataset[1]
+    completo = Tratar_dados.Tratar_dados_diarios(Ticker)
+
+    arquivos = [_cortar(Ticker, tipo, manter) for tipo, manter in CENARIOS[cenario]]
+    Tratar_dados.Tratar_dados_diarios(Ticker)
+    for arquivo in arquivos:
+        _restaurar(arquivo)
+    incremental = Tratar_dados.Tratar_dados_diarios(Ticker, incremental=True)
+
+    assert "recalculando tudo" not in capsys.readouterr().out
+    _comparar(incremental, completo)
+    ## Lidas dos arquivos, as categorias voltam como texto e são refeitas como no load_data
+    _comparar([tipar_lidos(df) for df in Tratar_dados.ler_dados_tratados(Ticker)], completo)
+
+
+def test_float32_sem_mudanca_segue_incremental(dataset, capsys):
+    Ticker = dataset[1]
+    completo = Tratar_dados.Tratar_dados_diarios(Ticker, float32=True)
+    incremental = Tratar_dados.Tratar_dados_diarios(Ticker, incremental=True, float32=True)
+
+    assert "recalculando tudo" not in capsys.readouterr().out
+    _comparar(incremental, completo)
@@ -0,0 +1,18 @@
+import numpy as np
+
+from modules.Colher_tratar_dados import instrumentacao
+
+
+def test_rss_nan_sem_resource(monkeypatch):
+    ## Fora do Unix não há o módulo resource: a etapa é registrada com RSS_max_MB NaN
+    monkeypatch.setattr(instrumentacao, "resource", None)
+    instrumentacao.registros_instrumentacao(limpar=True)
+    instrumentacao.ativar_instrumentacao()
+    try:
+        with instrumentacao.etapa("etapa_teste", Ticker="AAAA3"):
+            pass
+        registros = instrumentacao.registros_instrumentacao(limpar=True)
+    finally:
+        instrumentacao.desativar_instrumentacao()
+    assert [registro["Etapa"] for registro in registros] == ["etapa_teste"]
+    assert np.isnan(registros[0]["RSS_max_MB"])
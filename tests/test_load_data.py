@@ -0,0 +1,35 @@
+from datetime import datetime
+
+import pandas as pd
+
+from modules.Colher_tratar_dados.Dados_Fund import Tratar_dados
+from modules.Colher_tratar_dados.load_data import load_data, ler_acoes, endereco_particionado, ler_indice_elegibilidade
+
+DATA_SIMULACAO = datetime(2023, 6, 30)
+
+
+def test_particao_ilegivel_fica_em_nao_encontrados(dataset):
+    Tratar_dados.tratar_universo(dataset, n_processos=1)
+    lista_ativos = ler_indice_elegibilidade().elegiveis(DATA_SIMULACAO)
+    dict_antes, _, _, dict_nao_encontrados = load_data(DATA_SIMULACAO, retornar_nao_encontrados=True)
+    assert len(lista_ativos) >= 2 and not dict_nao_encontrados
+
+    Ticker = lista_ativos[0]
+    with open(f"{endereco_particionado('CAGR', Ticker)}/parte-0.parquet", "wb") as arquivo:
+        arquivo.write(b"nao e parquet")
+
+    dict_df_acoes, _, _, dict_nao_encontrados = load_data(DATA_SIMULACAO, retornar_nao_encontrados=True)
+    assert list(dict_nao_encontrados) == [Ticker]
+    assert isinstance(dict_nao_encontrados[Ticker], Exception)
+    assert list(dict_df_acoes) == lista_ativos[1:]
+    for Ticker_lido in lista_ativos[1:]:
+        for df, df_antes in zip(dict_df_acoes[Ticker_lido], dict_antes[Ticker_lido]):
+            pd.testing.assert_frame_equal(df, df_antes)
+
+
+def test_ativos_mantem_a_ordem_da_lista(dataset):
+    Tratar_dados.tratar_universo(dataset, n_processos=1)
+    lista_ativos = list(reversed(dataset))
+    dict_df_acoes, dict_nao_encontrados = ler_acoes(lista_ativos + ["ZZZZ3"], datetime(2006, 1, 1), DATA_SIMULACAO)
+    assert list(dict_df_acoes) == lista_ativos
+    assert list(dict_nao_encontrados) == ["ZZZZ3"]
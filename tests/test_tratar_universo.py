@@ -0,0 +1,50 @@
+import time
+
+import pandas as pd
+
+from modules.Colher_tratar_dados.Dados_Fund import Tratar_dados
+
+
+def _leitura_lenta(monkeypatch, sufixo, atraso):
+    ## Leituras dos arquivos brutos terminados em sufixo passam a demorar atraso segundos
+    ler_parquet = pd.read_parquet
+
+    def leitura(arquivo, *args, **kwargs):
+        if str(arquivo).endswith(sufixo):
+            time.sleep(atraso)
+        return ler_parquet(arquivo, *args, **kwargs)
+
+    monkeypatch.setattr(Tratar_dados.pd, "read_parquet", leitura)
+
+
+def test_timeout_dentro_de_except_generico(dataset, monkeypatch):
+    ## O alarme dispara dentro do try/except genérico do tratar_even: o ativo deve sair como timeout, sem entrar no manifesto
+    Ticker = dataset[0]
+    _leitura_lenta(monkeypatch, "_Eventos.parquet", 1.0)
+
+    df_relatorio = Tratar_dados.tratar_universo([Ticker], n_processos=1, timeout=0.5)
+
+    assert df_relatorio.loc[Ticker, "Status"] == "timeout"
+    assert Ticker not in Tratar_dados.ler_manifesto()
+
+
+def test_timeout_com_alarme_engolido(dataset, monkeypatch):
+    ## Sem o alarme (engolido ou sem SIGALRM), um ativo que termina depois do tempo limite também é timeout
+    Ticker = dataset[0]
+    _leitura_lenta(monkeypatch, "_Eventos.parquet", 1.0)
+    monkeypatch.setattr(Tratar_dados, "_estourou_tempo", lambda signum, frame: None)
+
+    df_relatorio = Tratar_dados.tratar_universo([Ticker], n_processos=1, timeout=0.5)
+
+    assert df_relatorio.loc[Ticker, "Status"] == "timeout"
+    assert Ticker not in Tratar_dados.ler_manifesto()
+
+
+def test_sem_timeout_entra_no_manifesto(dataset):
+    Ticker = dataset[0]
+
+    df_relatorio = Tratar_dados.tratar_universo([Ticker], n_processos=1, timeout=60)
+
+    assert df_relatorio.loc[Ticker, "Status"] == "ok"
+    assert Ticker in Tratar_dados.ler_manifesto()
+    assert Tratar_dados.tratar_universo([Ticker], n_processos=1).loc[Ticker, "Status"] == "cache"